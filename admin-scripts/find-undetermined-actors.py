@@ -1,18 +1,54 @@
-import csv, json, sys
+""" List the orgs with an unknown scope, by number of activities
 
-with open("output/org-index.json", "r") as input:
-    data = json.load(input)
+Usage:
 
-orgs = []
+    python3 find-undetermined-actors.py [--db cache/activities.sqlite] > undetermined.csv
 
-for key, entry in data.items():
-    if entry["info"]["scope"] == "unknown":
-        count = 0
-        for type, activities in entry["activities"].items():
-            count += len(activities)
-        orgs.append([entry["info"]["name"], count])
+Reads output/org-index.json, or queries the database from iati3w.store
+if --db is given (much faster, since it doesn't load the whole index).
 
-orgs = sorted(orgs, key=lambda entry: entry[1], reverse=True)
+"""
+
+import argparse, csv, json, os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+UNDETERMINED_SQL = """
+SELECT orgs.name, COUNT(org_activities.identifier) AS activities
+FROM orgs LEFT JOIN org_activities ON org_activities.org = orgs.stub
+WHERE orgs.scope = 'unknown'
+GROUP BY orgs.stub
+ORDER BY activities DESC, orgs.rowid
+"""
+
+def from_index (filename):
+    """ Count the activities for each unknown-scope org from the org index """
+    with open(filename, "r") as input:
+        data = json.load(input)
+
+    orgs = []
+
+    for key, entry in data.items():
+        if entry["info"]["scope"] == "unknown":
+            count = 0
+            for type, activities in entry["activities"].items():
+                count += len(activities)
+            orgs.append([entry["info"]["name"], count])
+
+    return sorted(orgs, key=lambda entry: entry[1], reverse=True)
+
+def from_db (filename):
+    """ Count the activities for each unknown-scope org from the SQLite store """
+    from iati3w.store import query
+    columns, rows = query(filename, UNDETERMINED_SQL)
+    return [list(row) for row in rows]
+
+parser = argparse.ArgumentParser(description="List the orgs with an unknown scope, by number of activities")
+parser.add_argument("--db", help="query this database (from iati3w.store) instead of reading the org index")
+parser.add_argument("--index", default="output/org-index.json", help="org index to read without --db (default: output/org-index.json)")
+args = parser.parse_args()
+
+orgs = from_db(args.db) if args.db else from_index(args.index)
 
 #sys.stdout.reconfigure(encoding='utf-8')
 output = csv.writer(sys.stdout)
@@ -2,16 +2,90 @@
 
 For debugging/testing
 
+Also works on activity files (in any format that iati3w.formats can
+read), where it shows the keys used by any of the activities (or, with
+a key, the keys inside that property in any of them).
+
+With --db, query the database from iati3w.store instead: shows the keys
+used by any of the activities (or any entry's info, for the orgs and
+locations tables), without loading the JSON outputs.
+
+Usage:
+
+    python3 show-keys.py <json-file> [key]
+    python3 show-keys.py --db cache/activities.sqlite [table]
+
 """
 
-import json, sys
+import json, os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from iati3w.formats import read_activities, sniff_format
+
+DB_JSON_COLUMNS = {
+    "activities": "data",
+    "orgs": "info",
+    "locations": "info",
+}
+""" The column holding each row's JSON, for the tables that have one """
+
+if len(sys.argv) >= 2 and sys.argv[1] == "--db":
+    if len(sys.argv) != 3 and len(sys.argv) != 4:
+        print("Usage: {} --db <database> [table]".format(sys.argv[0]))
+        sys.exit(2)
+
+    from iati3w.store import query
+    table = sys.argv[3] if len(sys.argv) == 4 else "activities"
+    if not table in DB_JSON_COLUMNS:
+        print("Table must be one of {}".format(", ".join(DB_JSON_COLUMNS)))
+        sys.exit(2)
+    columns, rows = query(sys.argv[2], "SELECT DISTINCT json_each.key FROM {}, json_each({}.{}) ORDER BY json_each.key".format(
+        table, table, DB_JSON_COLUMNS[table]
+    ))
+    print(json.dumps([row[0] for row in rows], indent=4))
+    sys.exit(0)
+
+def load (filename):
+    """ Return the activities in an activity file (as a list), or the value in any other JSON file """
+    try:
+        format = sniff_format(filename)
+    except ValueError:
+        # e.g. an index written with indentation
+        format = None
+    if format == "jsonl":
+        # an index written in compact mode is one object on one line, like JSON Lines
+        activities = list(read_activities(filename))
+        if len(activities) == 1 and not "identifier" in activities[0]:
+            return activities[0]
+        return activities
+    elif format is not None:
+        return list(read_activities(filename))
+    with open(filename, "r", encoding="utf-8") as input:
+        return json.load(input)
 
 if len(sys.argv) != 2 and len(sys.argv) != 3:
-    print("Usage: {} <json-file>".format(sys.argv[0]))
+    print("Usage: {} <json-file> [key]".format(sys.argv[0]))
     sys.exit(2)
 
-with open(sys.argv[1], "r") as input:
-    data = json.load(input)
-    if len(sys.argv) == 3:
-        data = data.get(sys.argv[2])
+data = load(sys.argv[1])
+
+if len(sys.argv) == 3:
+    key = sys.argv[2]
+    if isinstance(data, list):
+        # the value of the key in each activity
+        data = [item[key] for item in data if isinstance(item, dict) and isinstance(item.get(key), dict)]
+    else:
+        data = data.get(key)
+    if data is None:
+        print("No {} in {}".format(key, sys.argv[1]))
+        sys.exit(1)
+
+if isinstance(data, list):
+    # a list of activities: show the keys from all of them
+    keys = set()
+    for item in data:
+        if isinstance(item, dict):
+            keys.update(item.keys())
+    print(json.dumps(sorted(keys), indent=4))
+else:
     print(json.dumps(sorted(data.keys()), indent=4))
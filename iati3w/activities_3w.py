@@ -2,13 +2,26 @@
 
 Usage:
 
-    python3 -m iati3w.activities_3w downloads/3w-*.csv > output/3w-data.json
+    python3 -m iati3w.activities_3w [--processes N | --threads N] [--format json|jsonl|compact] [--json-mode pretty|compact] downloads/3w-*.csv > output/3w-data.json
+
+Each file is read and its distinct orgs, clusters, etc. are resolved
+once before the activities are built. With --processes, build
+the activities in a pool of worker processes (0 means one per CPU
+core), or with --threads, in a pool of worker threads that share the
+resolved values instead of each getting a copy. The workers only build
+the activities from the values resolved first, in row order, so the
+output is the same either way. With --format=jsonl or
+--format=compact, write JSON Lines or the internal compact format (see
+iati3w.formats) instead of a JSON array. With --json-mode=compact,
+write the JSON array without indentation.
 
 """
 
-import hxl, hashlib, json, sys
+import argparse, functools, hxl, hashlib, json, multiprocessing, multiprocessing.pool, sys
 
 from .common import *
+from . import instrument
+from .formats import FORMATS, write_activities
 
 #
 # Utility functions
@@ -42,9 +55,153 @@ def get_entity_key (entity):
 #
 # Read Somalia 3W activities via the HXL Proxy (which adds HXL hashtags)
 #
+# hxl's Row.get() parses the tag pattern and checks it against every
+# column on each call, which used to be most of the conversion time. So
+# we find the columns for each tag once per file, pull the values out of
+# each row, and resolve each distinct value (org, cluster, etc.) once per
+# file rather than once per row. The admin1/admin2/loc reconciliation is
+# memoised in common.reconcile_locations(), and also resolved ahead of
+# time, in row order: the first spelling seen of an unrecognised location
+# decides its name for the rest (see common.register_location()), so it
+# has to be settled here rather than in whichever worker gets there first.
+#
+
+TAGS = [
+    "#activity+programme",
+    "#activity+project",
+    "#status",
+    "#sector",
+    "#adm1+name",
+    "#adm2+name",
+    "#loc+name",
+    "#org+impl",
+    "#org+prog",
+    "#org+funding",
+    "#date+start",
+    "#date+end",
+    "#modality",
+    "#targeted+ind+all",
+    "#targeted+hh+all",
+    "#targeted+f+adults",
+    "#targeted+m+adults",
+    "#targeted+f+children",
+    "#targeted+m+children",
+]
+""" The HXL tags that we read from each row """
+
+ORG_TAGS = [
+    ["#org+impl", "implementing"],
+    ["#org+prog", "programming"],
+    ["#org+funding", "funding"],
+]
+""" Tag and role for each participating org """
+
+TARGETED_TAGS = [
+    ["#targeted+ind+all", "total_individuals"],
+    ["#targeted+hh+all", "total_households"],
+    ["#targeted+f+adults", "women"],
+    ["#targeted+m+adults", "men"],
+    ["#targeted+f+children", "girls"],
+    ["#targeted+m+children", "boys"],
+]
+""" Tag and property for each targeted number """
+
+def parse_number (s):
+    """ Parse a targeted number, or return None if it's empty or not a number """
+    try:
+        s = normalise_string(s)
+        if not is_empty(s):
+            return int(s)
+    except:
+        pass
+    return None
+
+RESOLVERS = {
+    "cluster": fix_cluster_name,
+    "org": lambda name: lookup_org(name, create=True),
+    "modality": normalise_string,
+    "number": parse_number,
+    "locations": lambda names: reconcile_locations(*names),
+}
+""" Function to resolve each kind of value """
+
+RESOLVED_TAGS = dict(
+    [["#sector", "cluster"], ["#modality", "modality"]]
+    + [[tag, "org"] for tag, role in ORG_TAGS]
+    + [[tag, "number"] for tag, property in TARGETED_TAGS]
+)
+""" Kind of value for each tag that resolve_values() resolves ahead of time """
+
+LOCATION_TAGS = ["#adm1+name", "#adm2+name", "#loc+name",]
+""" Tags for the names that common.reconcile_locations() works out the locations from, together """
+
+def find_columns (columns):
+    """ Return the indexes of the columns that match each tag in TAGS """
+    result = {}
+    for tag in TAGS:
+        pattern = hxl.model.TagPattern.parse(tag)
+        result[tag] = [i for i, column in enumerate(columns) if pattern.match(column)]
+    return result
+
+def get_values (row, indexes):
+    """ Return the value of each tag in a row, the same as Row.get() (the first non-empty value, or None) """
+    row_values = row.values
+    values = {}
+    for tag, positions in indexes.items():
+        values[tag] = None
+        for i in positions:
+            if i < len(row_values) and row_values[i]:
+                values[tag] = row_values[i]
+                break
+    return values
+
+def read_values (filename):
+    """ Generate the tag values for each row in a 3W file """
+    columns = None
+    for row in instrument.timed_iter("3w.read_row", hxl.data(filename, allow_local=True)):
+        if row.columns is not columns:
+            columns = row.columns
+            indexes = find_columns(columns)
+        yield get_values(row, indexes)
+
+def resolve (resolved, kind, value):
+    """ Return the resolved version of a value, resolving it now if it isn't in the table yet
+    resolved is a dict of tables, keyed by kind (see RESOLVERS). The results
+    are shared between rows, so they must not be modified.
+
+    """
+    table = resolved[kind]
+    if not value in table:
+        table[value] = RESOLVERS[kind](value)
+    return table[value]
+
+@instrument.timed("3w.resolve_values")
+def resolve_values (rows):
+    """ Resolve each distinct value in a list of rows (from read_values()) once
+    Returns a dict of tables for resolve()
+
+    """
+    resolved = {kind: {} for kind in RESOLVERS}
+    org_names = []
+    for values in rows:
+        for tag, kind in RESOLVED_TAGS.items():
+            if kind == "org":
+                org_names.append(values[tag])
+            else:
+                resolve(resolved, kind, values[tag])
+        resolve(resolved, "locations", tuple(values[tag] for tag in LOCATION_TAGS))
+
+    # look up all of the org names at once
+    resolved["org"].update(zip(org_names, lookup_orgs_batch((None, name,) for name in org_names)))
+    return resolved
 
 def make_activity(row):
     """ Construct an activity object from the HXL row provided """
+    return make_activity_from_values(get_values(row, find_columns(row.columns)), {kind: {} for kind in RESOLVERS})
+
+@instrument.timed("3w.make_activity")
+def make_activity_from_values(values, resolved):
+    """ Construct an activity object from the tag values for a row (see read_values()) """
     
     # Rough in the activity object (fill in details later)
     data = {
@@ -52,9 +209,9 @@ def make_activity(row):
         "source": "3W",
         "reported_by": None,
         "humanitarian": True,
-        "title": row.get("#activity+programme", default=row.get("#activity+project")),
-        "description": row.get("#activity+project"),
-        "active": row.get("#status") == "Ongoing",
+        "title": values["#activity+programme"] or values["#activity+project"],
+        "description": values["#activity+project"],
+        "active": values["#status"] == "Ongoing",
         "orgs": {
             "implementing": [],
             "programming": [],
@@ -71,52 +228,25 @@ def make_activity(row):
             "countries": ["SO"],
         },
         "dates": {
-            "start": row.get("#date+start"),
-            "end": row.get("#date+end"),
+            "start": values["#date+start"],
+            "end": values["#date+end"],
         },
         "modalities": [],
         "targeted": {},
     }
 
     # add the clusters
-    add_unique(fix_cluster_name(row.get("#sector")), data["sectors"]["humanitarian"])
+    add_unique(resolve(resolved, "cluster", values["#sector"]), data["sectors"]["humanitarian"])
 
     # add the locations
-    admin1 =  lookup_location(row.get("#adm1+name"))
-    admin2 = lookup_location(row.get("#adm2+name"))
-    loc = lookup_location(row.get("#loc+name"))
-
-    if (admin2 is None or admin2["level"] != "admin2") and loc is not None:
-        if loc["level"] == "admin2":
-            # For Banadir, especially, the loc can really be the admin2
-            admin2 = loc
-            loc = None
-        elif loc.get("admin2", None) is not None:
-            # Or else the loc can imply the admin2
-            admin2 = lookup_location(loc["admin2"])
-
-    if "admin1" in admin2 and admin2["admin1"] != make_token(admin1["name"]):
-        # Trust the district over the region for 3W (if they conflict)
-        admin1 = lookup_location(admin2["admin1"])
-
-    if admin1 is not None and admin1["level"] == "admin1":
-        add_unique(get_entity_key(admin1), data["locations"]["admin1"])
-
-    if admin2 is not None and admin2["level"] == "admin2":
-        add_unique(get_entity_key(admin2), data["locations"]["admin2"])
-
-    if loc is not None and loc["level"] == "unclassified":
-        add_unique(get_entity_key(admin2), data["locations"]["admin2"])
+    for level, key in resolve(resolved, "locations", tuple(values[tag] for tag in LOCATION_TAGS)):
+        add_unique(key, data["locations"][level])
 
     # add the participating organisations
-    for params in [
-            ["#org+impl", "implementing"],
-            ["#org+prog", "programming"],
-            ["#org+funding", "funding"],
-    ]:
-        org_name = row.get(params[0])
+    for params in ORG_TAGS:
+        org_name = values[params[0]]
         if org_name:
-            org = lookup_org(org_name, create=True)
+            org = resolve(resolved, "org", org_name)
             if org is not None and not org.get("skip", False):
                 # Add the name here instead of the stub if the org isn't in the map
                 # lookup_org() will recreate the record for index-orgs.py, which
@@ -128,44 +258,72 @@ def make_activity(row):
                     data["reported_by"] = get_entity_key(org)
 
     # add modality (e.g. for cash programming)
-    modality = normalise_string(row.get("#modality"))
+    modality = resolve(resolved, "modality", values["#modality"])
     if modality and not is_empty(modality):
         data["modalities"].append(modality)
 
     # add intended targeted
-    for params in [
-            ["#targeted+ind+all", "total_individuals"],
-            ["#targeted+hh+all", "total_households"],
-            ["#targeted+f+adults", "women"],
-            ["#targeted+m+adults", "men"],
-            ["#targeted+f+children", "girls"],
-            ["#targeted+m+children", "boys"],
-    ]:
-        try:
-            s = normalise_string(row.get(params[0]))
-            if not is_empty(s):
-                v = int(s)
-                data["targeted"][params[1]] = v
-        except:
-            pass
-
+    for params in TARGETED_TAGS:
+        v = resolve(resolved, "number", values[params[0]])
+        if v is not None:
+            data["targeted"][params[1]] = v
 
     # Generate pseudo-identifier
     data["identifier"] = make_pseudo_identifier(data)
 
     return data
 
-    
 
-def fetch_3w(filenames):
-    """ Fetch 3W data from all the filenames provided """
+#
+# Optional worker processes or threads for building the activities
+#
+
+worker_resolved = None
+""" The resolved values for the file a worker process is converting """
+
+def init_worker (resolved):
+    """ Set up a worker process with the resolved values for a file """
+    global worker_resolved
+    worker_resolved = resolved
+
+def build_activities (rows, resolved):
+    """ Build the activities for a chunk of rows """
+    return [make_activity_from_values(values, resolved) for values in rows]
+
+def convert_rows (rows):
+    """ Build the activities for a chunk of rows in a worker process """
+    return build_activities(rows, worker_resolved)
+
+def iterate_3w (filenames, processes=1, chunk_size=1000, threads=1):
+    """ Generate the 3W activities from all the filenames provided, in order
+    Reads each file and resolves its distinct values first, in row order,
+    then builds the activities. If processes is more than 1, build them
+    in a pool of worker processes (0 means one per CPU core), chunk_size
+    rows at a time. If threads is more than 1 (or 0), use a pool of
+    worker threads instead, sharing the resolved values.
 
-    result = []
+    """
     for filename in filenames:
-        for row in hxl.data(filename, allow_local=True):
-            data = make_activity(row)
-            result.append(data)
-    return result
+        rows = list(read_values(filename))
+        resolved = resolve_values(rows)
+        if processes == 1 and threads == 1:
+            for values in rows:
+                yield make_activity_from_values(values, resolved)
+        else:
+            chunks = [rows[i:i+chunk_size] for i in range(0, len(rows), chunk_size)]
+            if threads != 1:
+                pool = multiprocessing.pool.ThreadPool(threads or None)
+                convert = functools.partial(build_activities, resolved=resolved)
+            else:
+                pool = multiprocessing.Pool(processes or None, initializer=init_worker, initargs=(resolved,))
+                convert = convert_rows
+            with pool:
+                for activities in pool.imap(convert, chunks):
+                    yield from activities
+
+def fetch_3w(filenames, processes=1, threads=1):
+    """ Fetch 3W data from all the filenames provided """
+    return list(iterate_3w(filenames, processes, threads=threads))
 
 
 #
@@ -173,8 +331,23 @@ def fetch_3w(filenames):
 #
 
 if __name__ == "__main__":
-    data = fetch_3w(sys.argv[1:])
-    print("Found {} 3W activities".format(len(data)), file=sys.stderr)
-    json.dump(data, sys.stdout, indent=4)
+    parser = argparse.ArgumentParser(description="Print a JSON summary of 3W activities")
+    parser.add_argument("-p", "--processes", type=int, default=1, help="number of worker processes (0 for one per CPU core)")
+    parser.add_argument("-t", "--threads", type=int, default=1, help="number of worker threads, instead of processes (0 for one per CPU core)")
+    parser.add_argument("-f", "--format", choices=FORMATS, default="json", help="output format (default: json)")
+    parser.add_argument("--json-mode", choices=JSON_MODES, help="layout for --format=json (default: pretty, or $IATI3W_JSON_MODE)")
+    parser.add_argument("files", nargs="+", help="3W files to convert")
+    args = parser.parse_args()
+
+    if args.processes != 1 and args.threads != 1:
+        parser.error("can't use both --processes and --threads")
+
+    instrument.start("activities_3w")
+
+    if args.json_mode:
+        set_json_mode(args.json_mode)
+
+    count = write_activities(iterate_3w(args.files, args.processes, threads=args.threads), sys.stdout, args.format)
+    print("Found {} 3W activities".format(count), file=sys.stderr)
 
 # end
@@ -2,13 +2,43 @@
 
 Usage:
 
-    python3 -m iati3w.activities_iati downloads/iati-*.xml > outputs/iati-data.json
+    python3 -m iati3w.activities_iati [--processes N | --threads N] [--cache-dir DIR] [--format json|jsonl|compact] [--json-mode pretty|compact] [--explain] downloads/iati-*.xml > outputs/iati-data.json
+    python3 -m iati3w.activities_iati --download=downloads [--concurrency N] [--processes N | --threads N] [--cache-dir DIR] ... > outputs/iati-data.json
+
+With --processes, convert the XML files in a pool of worker processes
+(0 means one per CPU core). With --threads, use a pool of worker
+threads instead: they share the lookup tables and verdicts already
+loaded in this process, so there's nothing to load in each worker or to
+send back. diterator parses the XML in pure Python (with pulldom), which
+holds the GIL, so the threads don't convert pages in parallel; they
+save the memory and start-up time of the processes, and overlap reading
+the files (or, with --download, the network) with the conversion. Use
+--processes to convert on several cores. With --cache-dir, save the converted
+activities for each XML file, and reconvert only the files that have
+changed (or whose maps have changed) since the last run, reusing the
+humanitarian verdict for any activity whose last-updated-datetime hasn't
+changed either. The output is the same either way, and is written as
+each file finishes. With
+--format=jsonl or --format=compact, write JSON Lines or the internal
+compact format (see iati3w.formats) instead of a JSON array. With
+--json-mode=compact, write the JSON array without indentation (see
+"JSON serialisation" in iati3w.common). With --explain, add a
+"humanitarian_rule" property to each activity with the name of the rule
+that made it humanitarian, or null (see iati3w.humanitarian).
+
+With --download, download the 3W and IATI data to a directory first
+(see iati3w.download), converting each IATI page as soon as it arrives
+instead of waiting for the whole download. The output is the same as
+downloading and then converting the files.
 
 """
 
-import diterator, json, sys
+import argparse, asyncio, collections, diterator, functools, json, multiprocessing, multiprocessing.pool, os, queue, sys, threading
 
 from .common import *
+from . import common, download, humanitarian, instrument
+from .compiled_maps import hash_files, write_atomically
+from .formats import FORMATS, write_activities
 
 #
 # Utility functions
@@ -18,37 +48,10 @@ def has_humanitarian_content (activity):
     """ More-thorough review of an activity to check if it seems humanitarian.
     Will return true if the activity is flagged humanitarian, any transaction
     is flagged humanitarian, a humantarian-scope is present, and/or it
-    mentions a humanitarian sector.
+    mentions a humanitarian sector (see iati3w.humanitarian for the rules).
 
     """
-
-    def is_humanitarian_sector (sector):
-        """ Check if a sector is humanitarian """
-        if sector.vocabulary == "10":
-            # humanitarian clusters
-            return True
-        elif sector.vocabulary in ["1", "2"] and sector.code != None and sector.code.startswith("7"):
-            # DAC humanitarian sectors
-            return True
-        else:
-            return False
-          
-    
-    if activity.humanitarian or len(activity.humanitarian_scopes) > 0:
-        return True
-
-    for sector in activity.sectors:
-        if is_humanitarian_sector(sector):
-            return True
-
-    for transaction in activity.transactions:
-        if transaction.humanitarian:
-            return True
-        for sector in transaction.sectors:
-            if is_humanitarian_sector(sector):
-                return True
-        
-    return False
+    return humanitarian.classify(activity) is not None
 
 def add_org (org, role, data):
     """ Add an org to the appropriate list """
@@ -78,15 +81,26 @@ def lookup_cluster (code):
     return map.get(code, None)
 
 
-def make_activity(activity):
+@instrument.timed("iati.make_activity")
+def make_activity(activity, explain=False, unrecognised=None):
+    """ Construct an activity object from a diterator Activity, or return None if it has no usable sectors
+    If explain is True, add the name of the rule that made the activity
+    humanitarian (or None) as "humanitarian_rule" (see iati3w.humanitarian).
+    If unrecognised is a list, the unrecognised locations keep their own
+    spelling, and a (token, name) pair for each one is added to the list
+    in lookup order, for name_locations() to settle later (even if the
+    activity isn't usable).
+
+    """
 
     org_map = activity.participating_orgs_by_role
+    humanitarian_rule = humanitarian.classify_cached(activity)
 
     data = {
         "identifier": activity.identifier,
         "source": "IATI",
         "reported_by": None,
-        "humanitarian": has_humanitarian_content(activity),
+        "humanitarian": humanitarian_rule is not None,
         "title": str(activity.title),
         "description": str(activity.description),
         "active": True if activity.activity_status == "2" else False,
@@ -113,12 +127,14 @@ def make_activity(activity):
         "targeted": {}, # TODO
     }
 
-    reporting_org = lookup_org(activity.reporting_org.ref, create=False) or lookup_org(str(activity.reporting_org.name), create=True)
-    if reporting_org is not None:
-        key = "name" if reporting_org.get("unrecognised", False) else "stub"
-        data["reported_by"] = reporting_org[key]
+    if explain:
+        data["humanitarian_rule"] = humanitarian_rule
 
-    # Add orgs
+    # Collect the (role, org) for the reporting org, the participating
+    # orgs, and the extra orgs from transactions, in order, then look them
+    # all up at once (the same few orgs often appear in hundreds of
+    # transactions)
+    orgs = [("reporting", activity.reporting_org,)]
     for params in [
             ["4", "implementing"],
             ["3", "programming"],
@@ -126,20 +142,27 @@ def make_activity(activity):
             ["1", "funding"]
     ]:
         for org in org_map.get(params[0], []):
-            info = lookup_org(org.ref) or lookup_org(org.name, create=True)
-            if info is not None and not info.get("skip", False):
-                add_org(info, params[1], data)
-
-    # Add any extra orgs from transactions
+            orgs.append((params[1], org,))
     for transaction in activity.transactions:
-        def try_org (org, type):
-            if org is not None:
-                info = lookup_org(org.ref) or lookup_org(org.name, create=True)
-                if info is not None:
-                    add_org(info, type, data)
         if transaction.type in ("1", "2", "3", "11"):
-            try_org(transaction.receiver_org, "implementing")
-            try_org(transaction.provider_org, "funding")
+            if transaction.receiver_org is not None:
+                orgs.append(("implementing", transaction.receiver_org,))
+            if transaction.provider_org is not None:
+                orgs.append(("funding", transaction.provider_org,))
+
+    # the reporting org's name is always a string, even if it's missing
+    pairs = [(org.ref, str(org.name) if role == "reporting" else org.name,) for role, org in orgs]
+    infos = lookup_orgs_batch(pairs)
+
+    reporting_org = infos[0]
+    if reporting_org is not None:
+        key = "name" if reporting_org.get("unrecognised", False) else "stub"
+        data["reported_by"] = reporting_org[key]
+
+    # Add orgs
+    for (role, org), info in zip(orgs[1:], infos[1:]):
+        if info is not None and not info.get("skip", False):
+            add_org(info, role, data)
 
     # Look up DAC sectors and humanitarian equivalents
     for vocab in ["1", "2"]:
@@ -157,26 +180,14 @@ def make_activity(activity):
             add_unique(info["name"], data["sectors"]["humanitarian"])
 
     # Look up location strings
-    for location in activity.locations:
-        if location.name is None or is_empty(str(location.name)):
-            continue
-        info = lookup_location(str(location.name))
-
-        # honour the "skip" flag
-        if info is None or info.get("skip", False):
-            continue
-
-        # Add the name here instead of the stub if the org isn't in the map
-        # lookup_org() will recreate the record for index-orgs.py, which
-        # will switch to the stub
-        key = "name" if info.get("unrecognised", False) else "stub"
-        add_unique(info[key], data["locations"][info["level"]])
-
-        #
-        # Add the ancestor admin1 and admin2 if they exist
-        for level in ["admin1", "admin2"]:
-            if level in info:
-                add_unique(info[level], data["locations"][level])
+    names = [str(location.name) for location in activity.locations if location.name is not None]
+    for info in lookup_locations_batch(names, register=unrecognised is None):
+        if unrecognised is not None and info is not None and info.get("unrecognised", False):
+            unrecognised.append((info["stub"], info["name"],))
+        # The location and its ancestors (uses the name instead of the stub if
+        # it isn't in the map; lookup_location() will recreate the record later)
+        for level, key in expand_location_info(info):
+            add_unique(key, data["locations"][level])
 
     # There must be at list one sector left to count this activity
     if len(data["sectors"]["humanitarian"]) + len(data["sectors"]["dac"]) > 0:
@@ -184,28 +195,358 @@ def make_activity(activity):
     else:
         return None
 
-def fetch_activities(files):
+def convert_file (file, identifiers_seen=None, explain=False):
+    """ Convert the activities in a single IATI XML file.
+    Skips secondary reporters and any identifier already in identifiers_seen
+    (which is updated as a side effect). Returns a list of (identifier,
+    data, unrecognised) tuples in document order, where data is None if
+    the activity didn't convert, and unrecognised is the list of
+    unrecognised locations for name_locations(). The result depends only
+    on the file (and the maps), not on the files converted before it.
+    explain is as for make_activity().
+
+    """
+
+    if identifiers_seen is None:
+        identifiers_seen = set()
 
     result = []
+
+    with open(file, "r") as input:
+        for activity in instrument.timed_iter("iati.parse_xml", diterator.XMLIterator(input)):
+            if activity.secondary_reporter:
+                instrument.count("iati.skipped_secondary_reporter")
+            elif activity.identifier in identifiers_seen:
+                instrument.count("iati.skipped_duplicate")
+            else:
+                unrecognised = []
+                result.append((activity.identifier, make_activity(activity, explain, unrecognised), unrecognised,))
+                identifiers_seen.add(activity.identifier)
+
+    return result
+
+def name_locations (data, unrecognised):
+    """ Give an activity's unrecognised locations the first name seen for each token, and return the activity
+    unrecognised is the list from make_activity(). Activities must come
+    here in output order, since the first one to register a token decides
+    its name for all of the rest (see common.register_location()). This
+    happens as the pages are merged, rather than as they're converted, so
+    the names don't depend on which worker converted which page, or on
+    which pages came from the cache.
+
+    """
+    renamed = {}
+    for token, name in unrecognised:
+        first = register_location(unrecognised_location(token, name, "unclassified"))["name"]
+        if first != name:
+            renamed[name] = first
+    if renamed and data is not None:
+        names = data["locations"]["unclassified"]
+        data["locations"]["unclassified"] = []
+        for name in names:
+            add_unique(renamed.get(name, name), data["locations"]["unclassified"])
+    return data
+
+#
+# Incremental conversion: cache the converted activities for each XML file
+#
+
+PAGE_CACHE_DEPENDS = [
+    "inputs/org-map.json",
+    "inputs/location-map.json",
+    "inputs/dac3-sector-map.json",
+    "inputs/humanitarian-cluster-map.json",
+    __file__,
+    os.path.join(os.path.dirname(__file__), "common.py"),
+    os.path.join(os.path.dirname(__file__), "humanitarian.py"),
+    os.path.join(os.path.dirname(__file__), "fuzzy.py"),
+]
+""" Files that affect the conversion of every page, besides the page itself """
+
+depends_hash = None
+
+def page_key (file):
+    """ Return the cache key for an XML file: a hash of the file and of everything its conversion depends on
+    Includes the approximate matching threshold, if it's on (see
+    common.FUZZY_THRESHOLD), since it changes which orgs and locations
+    are recognised.
+
+    """
+    global depends_hash
+    if depends_hash is None:
+        depends_hash = hash_files(PAGE_CACHE_DEPENDS)
+    key = hash_files([file]) + "-" + depends_hash
+    if common.FUZZY_THRESHOLD:
+        key += "-fuzzy{}".format(common.FUZZY_THRESHOLD)
+    return key
+
+def convert_page (file, cache_dir=None, explain=False):
+    """ Convert a single XML file on its own, reusing the cached result if the file and maps haven't changed
+    Returns the same list as convert_file(file, explain=explain). That
+    doesn't depend on the other files (the unrecognised locations keep
+    their own spelling until name_locations()), so neither does the
+    cached result.
+
+    """
+    if cache_dir is None:
+        return convert_file(file, explain=explain)
+
+    cache_file = os.path.join(cache_dir, os.path.basename(file) + ".json")
+    key = page_key(file) + ("-explain" if explain else "")
+
+    try:
+        with open(cache_file, "r", encoding="utf-8") as input:
+            fragment = json.load(input)
+        if fragment["key"] == key:
+            return [tuple(entry) for entry in fragment["activities"]]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    result = convert_file(file, explain=explain)
+    write_atomically(cache_file, encode_json({
+        "key": key,
+        "activities": result,
+    }, "compact").encode("utf-8"))
+    return result
+
+#
+# Humanitarian verdicts: with a cache directory, the verdict for each
+# activity is saved (see iati3w.humanitarian) and reused while the
+# activity's last-updated-datetime stays the same. Worker processes load
+# the saved verdicts when they start, and send their new verdicts back
+# with each page, so that the main process can save them all.
+#
+
+VERDICT_CACHE = "humanitarian-verdicts.json"
+""" File in the cache directory for the saved humanitarian verdicts """
+
+def load_verdicts (cache_dir):
+    """ Load the saved humanitarian verdicts, if there's a cache directory """
+    if cache_dir is not None:
+        humanitarian.load_verdicts(os.path.join(cache_dir, VERDICT_CACHE))
+
+def save_verdicts (cache_dir):
+    """ Save the humanitarian verdicts, if there's a cache directory """
+    if cache_dir is not None:
+        humanitarian.save_verdicts(os.path.join(cache_dir, VERDICT_CACHE))
+
+def init_worker (cache_dir):
+    """ Set up a worker process with the lookup tables and the saved verdicts """
+    preload_lookup_tables()
+    load_verdicts(cache_dir)
+
+def convert_page_in_worker (file, cache_dir=None, explain=False):
+    """ Convert a page in a worker process, and return (page, new verdicts) """
+    return convert_page(file, cache_dir, explain), humanitarian.take_new_verdicts()
+
+def make_pool (processes, cache_dir):
+    """ Start a pool of worker processes for convert_page_in_worker() (0 means one per CPU core)
+    Loads the saved verdicts in this process too, since it saves them all
+    at the end, and the workers only send back the new ones (none at all
+    for the pages that come from the page cache).
+
+    """
+    load_verdicts(cache_dir)
+    return multiprocessing.Pool(processes or None, initializer=init_worker, initargs=(cache_dir,))
+
+def merge_worker_page (result):
+    """ Keep the new verdicts from convert_page_in_worker() and return the page """
+    page, verdicts = result
+    humanitarian.add_verdicts(verdicts)
+    return page
+
+def make_thread_pool (threads, cache_dir):
+    """ Start a pool of worker threads for convert_page() (0 means one per CPU core)
+    The threads share this process's lookup tables and verdicts, so
+    they're loaded once here, and the pages need no merging afterwards.
+    The parsing and conversion are pure Python and hold the GIL, so only
+    the waits for I/O overlap, not the work itself. The threads don't
+    register unrecognised location names: that happens in the merge, in
+    page order (see name_locations()), so the output doesn't depend on
+    which thread finishes first.
+
+    """
+    preload_lookup_tables()
+    load_verdicts(cache_dir)
+    return multiprocessing.pool.ThreadPool(threads or None)
+
+def iterate_activities(files, processes=1, cache_dir=None, explain=False, threads=1):
+    """ Generate converted activities from a list of IATI XML files, in order.
+    If processes is more than 1, convert the files in a pool of worker
+    processes (0 means one per CPU core). If threads is more than 1 (or
+    0), use a pool of worker threads instead. If cache_dir is not None, reuse
+    the converted activities for any file that hasn't changed since the
+    last run, and the humanitarian verdict for any activity that hasn't
+    changed. Results are merged in file order, and the unrecognised
+    locations named as they're merged (see name_locations()), so the
+    output is always the same as for a single process without a cache.
+    explain is as for make_activity().
+
+    """
+
     identifiers_seen = set()
 
-    for file in files:
-        with open(file, "r") as input:
-            for activity in diterator.XMLIterator(input):
-                if not activity.identifier in identifiers_seen and not activity.secondary_reporter:
-                    data = make_activity(activity)
+    if processes == 1 and threads == 1 and cache_dir is None:
+        for file in files:
+            for identifier, data, unrecognised in convert_file(file, identifiers_seen, explain):
+                data = name_locations(data, unrecognised)
+                if data is not None:
+                    yield data
+        return
+
+    if threads != 1:
+        pool = make_thread_pool(threads, cache_dir)
+        pages = pool.imap(functools.partial(convert_page, cache_dir=cache_dir, explain=explain), files)
+    elif processes == 1:
+        load_verdicts(cache_dir)
+        pages = (convert_page(file, cache_dir, explain) for file in files)
+        pool = None
+    else:
+        pool = make_pool(processes, cache_dir)
+        pages = map(merge_worker_page, pool.imap(functools.partial(convert_page_in_worker, cache_dir=cache_dir, explain=explain), files))
+
+    try:
+        # each page is deduplicated only within itself, so check again here
+        for page in pages:
+            for identifier, data, unrecognised in page:
+                if not identifier in identifiers_seen:
+                    identifiers_seen.add(identifier)
+                    data = name_locations(data, unrecognised)
                     if data is not None:
-                        result.append(data)
-                    identifiers_seen.add(activity.identifier)
+                        yield data
+    finally:
+        if pool is not None:
+            pool.terminate()
 
-    return result
+    save_verdicts(cache_dir)
+
+def fetch_activities(files, processes=1, cache_dir=None, explain=False, threads=1):
+    """ Return a list of converted activities from a list of IATI XML files """
+    return list(iterate_activities(files, processes, cache_dir, explain, threads))
+
+#
+# Pipelined download and conversion
+#
+# The downloader runs its event loop in a background thread and reports
+# each IATI page as it's saved (in offset order, like the sorted file
+# list for the batch path). Pages go to the worker pool as soon as they
+# land, and the results are merged in page order with the same
+# de-duplication and naming as iterate_activities(), so the output is the same as
+# downloading first and converting afterwards.
+#
+
+def iterate_downloaded_activities(downloader, threew_url, iati_template, processes=1, cache_dir=None, explain=False, threads=1):
+    """ Download the 3W and IATI data, and generate the converted IATI activities while the download is still going
+    downloader is a download.Downloader; processes, cache_dir, explain,
+    and threads are as for iterate_activities(). Raises
+    download.DownloadError if the download fails.
+
+    """
+
+    events = queue.Queue()
+
+    def run_download ():
+        try:
+            page_count = asyncio.run(downloader.download_all(threew_url, iati_template, lambda file: events.put(("page", file,))))
+            events.put(("done", page_count,))
+        except Exception as e:
+            events.put(("error", e,))
+
+    thread = threading.Thread(target=run_download, daemon=True)
+    thread.start()
+
+    if threads != 1:
+        pool = make_thread_pool(threads, cache_dir)
+        convert, merge = convert_page, lambda page: page
+    elif processes == 1:
+        load_verdicts(cache_dir)
+        pool = None
+    else:
+        pool = make_pool(processes, cache_dir)
+        convert, merge = convert_page_in_worker, merge_worker_page
+
+    # pages converting or converted, in order (a pool AsyncResult, or the result itself)
+    pages = collections.deque()
+    identifiers_seen = set()
+    done = False
+
+    def notify (result):
+        events.put(("converted", None,))
+
+    try:
+        while not done or pages:
+            if not done:
+                event, value = events.get()
+                if event == "page":
+                    if pool is None:
+                        pages.append(convert_page(value, cache_dir, explain))
+                    else:
+                        pages.append(pool.apply_async(convert, (value, cache_dir, explain,), callback=notify, error_callback=notify))
+                elif event == "done":
+                    done = True
+                elif event == "error":
+                    raise value
+
+            # merge every finished page at the front of the queue (or wait for them all once the download is finished)
+            while pages and (pool is None or done or pages[0].ready()):
+                page = pages.popleft()
+                for identifier, data, unrecognised in (page if pool is None else merge(page.get())):
+                    if not identifier in identifiers_seen:
+                        identifiers_seen.add(identifier)
+                        data = name_locations(data, unrecognised)
+                        if data is not None:
+                            yield data
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    thread.join()
+    save_verdicts(cache_dir)
 
 #
 # Script entry point
 #
 if __name__ == "__main__":
-    data = fetch_activities(sys.argv[1:])
-    print("Found {} IATI activities".format(len(data)), file=sys.stderr)
-    json.dump(data, sys.stdout, indent=4)
+    parser = argparse.ArgumentParser(description="Print a JSON summary of IATI activities")
+    parser.add_argument("-p", "--processes", type=int, default=1, help="number of worker processes (0 for one per CPU core)")
+    parser.add_argument("-t", "--threads", type=int, default=1, help="number of worker threads, instead of processes (0 for one per CPU core)")
+    parser.add_argument("-c", "--cache-dir", help="directory for caching the converted activities from each file between runs")
+    parser.add_argument("-f", "--format", choices=FORMATS, default="json", help="output format (default: json)")
+    parser.add_argument("--json-mode", choices=JSON_MODES, help="layout for --format=json (default: pretty, or $IATI3W_JSON_MODE)")
+    parser.add_argument("--explain", action="store_true", help="add the name of the rule behind each humanitarian flag as humanitarian_rule")
+    parser.add_argument("-d", "--download", metavar="DIR", help="download the 3W and IATI data to DIR first, converting each IATI page as it arrives (instead of listing files)")
+    parser.add_argument("--concurrency", type=int, default=8, help="maximum requests at once with --download (default: 8)")
+    parser.add_argument("--threew-url", default=download.THREEW_URL, help="URL of the 3W CSV for --download")
+    parser.add_argument("--iati-url", default=download.IATI_URL, help="template for the IATI page URLs for --download, with %%d for the offset")
+    parser.add_argument("files", nargs="*", help="IATI XML files to convert")
+    args = parser.parse_args()
+
+    if args.download is None and not args.files:
+        parser.error("no IATI XML files to convert (or use --download)")
+    if args.download is not None and args.files:
+        parser.error("can't list files with --download")
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    if args.processes != 1 and args.threads != 1:
+        parser.error("can't use both --processes and --threads")
+
+    instrument.start("activities_iati")
+
+    if args.json_mode:
+        set_json_mode(args.json_mode)
+
+    if args.download is None:
+        activities = iterate_activities(args.files, args.processes, args.cache_dir, args.explain, args.threads)
+    else:
+        os.makedirs(args.download, exist_ok=True)
+        downloader = download.Downloader(args.download, args.concurrency)
+        activities = iterate_downloaded_activities(downloader, args.threew_url, args.iati_url, args.processes, args.cache_dir, args.explain, args.threads)
+
+    try:
+        count = write_activities(activities, sys.stdout, args.format)
+    except download.DownloadError as e:
+        print("Failed to download {}".format(e), file=sys.stderr)
+        sys.exit(1)
+    print("Found {} IATI activities".format(count), file=sys.stderr)
 
 # end
@@ -0,0 +1,353 @@
+""" Benchmark the pipeline on synthetic data
+
+Generates d-portal-style IATI XML pages and an HXL-tagged 3W CSV of a
+given size, with org, location, and sector names drawn from the maps
+in inputs/ (plus some unrecognised ones), then runs each stage of the
+pipeline on them in a separate process and reports the wall-clock
+time, CPU time, throughput, and peak memory (RSS) of each.
+
+Usage:
+
+    python3 -m iati3w.benchmark run [--activities N] [--seed S] [--processes P] [--work-dir DIR] [--report FILE]
+    python3 -m iati3w.benchmark generate [--activities N] [--seed S] DIR
+
+--activities is the number of IATI activities and the number of 3W
+rows to generate (default 1000). The same seed always produces the
+same data. The report is JSON, written to stdout unless --report is
+given. Nothing is downloaded, and the data in downloads/ and output/
+isn't touched. With --stages, the stages after the two converters need
+the converters' output from an earlier run in the same --work-dir.
+
+Run from the root of the distribution (the stages look for inputs/).
+
+"""
+
+import argparse, csv, json, os, platform, random, re, subprocess, sys, tempfile, time
+from xml.sax.saxutils import escape, quoteattr
+
+from .common import get_dataset
+
+PAGE_SIZE = 100
+""" Activities per IATI XML page (as in the d-portal downloads) """
+
+REPORT_VERSION = 1
+""" Version of the JSON report layout """
+
+STAGES = ["activities_iati", "activities_3w", "merge", "org_index", "sector_index", "location_index", "indexer",]
+""" The stages that the benchmark runs, in order """
+
+
+#
+# Synthetic data
+#
+
+def get_names ():
+    """ Return lists of org, location, DAC sector, and cluster names to draw from """
+    org_map = get_dataset("inputs/org-map.json")
+    location_map = get_dataset("inputs/location-map.json")
+
+    org_names = [info["name"] for info in org_map.values()] + list(org_map.keys())
+    org_names += ["Unknown Org {}".format(i) for i in range(50)]
+    org_names += ["  extra   spacing ngo ", "École Française de Test",]
+
+    org_refs = [info["iati_id"] for info in org_map.values() if "iati_id" in info]
+
+    location_names = []
+    for admin1, admin1_info in location_map["admin1"].items():
+        location_names.append(admin1)
+        for admin2, admin2_info in admin1_info.get("admin2", {}).items():
+            location_names.append(admin2)
+            location_names += list(admin2_info.get("unclassified", {}).keys())[:3]
+    location_names += ["Unknown Place {}".format(i) for i in range(30)]
+
+    admin1_names = {admin1: list(admin1_info.get("admin2", {}).keys()) for admin1, admin1_info in location_map["admin1"].items()}
+
+    dac_codes = list(get_dataset("inputs/dac3-sector-map.json").keys())
+    cluster_map = get_dataset("inputs/humanitarian-cluster-map.json")
+    cluster_codes = list(cluster_map.keys())
+    cluster_names = [info["name"] for info in cluster_map.values() if "name" in info] + ["WASH", "wash", "Shelter",]
+
+    return {
+        "orgs": org_names,
+        "org_refs": org_refs,
+        "locations": location_names,
+        "admin1": admin1_names,
+        "dac": dac_codes,
+        "clusters": cluster_codes,
+        "cluster_names": cluster_names,
+    }
+
+def generate_iati (directory, count, rng, names):
+    """ Write count synthetic IATI activities as numbered XML pages, like the d-portal downloads
+    About 5% of the activities repeat an earlier identifier, and about 5%
+    come from secondary reporters, so the de-duplication gets exercised.
+    Returns the list of filenames.
+
+    """
+
+    def org_element (tag, attributes=""):
+        ref = ' ref={}'.format(quoteattr(rng.choice(names["org_refs"]))) if names["org_refs"] and rng.random() < 0.4 else ''
+        return '<{}{}{}><narrative>{}</narrative></{}>'.format(tag, ref, attributes, escape(rng.choice(names["orgs"])), tag)
+
+    filenames = []
+    identifiers = []
+
+    for start in range(0, count, PAGE_SIZE):
+        filename = os.path.join(directory, "iati-som-{:05d}.xml".format(start))
+        filenames.append(filename)
+        with open(filename, "w") as output:
+            output.write('<?xml version="1.0"?>\n<iati-activities version="2.03">\n')
+            for i in range(start, min(count, start + PAGE_SIZE)):
+                if identifiers and rng.random() < 0.05:
+                    identifier = rng.choice(identifiers)
+                else:
+                    identifier = "XM-BENCH-{:07d}".format(i)
+                    identifiers.append(identifier)
+                humanitarian = ' humanitarian="1"' if rng.random() < 0.2 else ''
+                last_updated = ' last-updated-datetime="2021-{:02d}-{:02d}T00:00:00Z"'.format(i % 12 + 1, i % 28 + 1)
+                output.write('<iati-activity{}{}>\n<iati-identifier>{}</iati-identifier>\n'.format(humanitarian, last_updated, identifier))
+                secondary = ' secondary-reporter="1"' if rng.random() < 0.05 else ''
+                output.write(org_element("reporting-org", secondary) + "\n")
+                output.write('<title><narrative>Activity {}</narrative></title>\n'.format(i))
+                output.write('<description><narrative>Description of activity {}</narrative></description>\n'.format(i))
+                for _ in range(rng.randint(1, 4)):
+                    output.write(org_element("participating-org", ' role="{}"'.format(rng.randint(1, 4))) + "\n")
+                output.write('<activity-status code="{}"/>\n'.format(rng.randint(1, 4)))
+                output.write('<activity-date type="1" iso-date="2020-{:02d}-01"/>\n'.format(rng.randint(1, 12)))
+                output.write('<recipient-country code="SO"/>\n')
+                for _ in range(rng.randint(0, 3)):
+                    output.write('<location><name><narrative>{}</narrative></name></location>\n'.format(escape(rng.choice(names["locations"]))))
+                for _ in range(rng.randint(0, 3)):
+                    r = rng.random()
+                    if r < 0.6:
+                        output.write('<sector vocabulary="1" code="{}01"/>\n'.format(rng.choice(names["dac"])))
+                    elif r < 0.9:
+                        output.write('<sector vocabulary="10" code="{}"/>\n'.format(rng.choice(names["clusters"])))
+                    else:
+                        output.write('<sector vocabulary="99" code="X"/>\n')
+                if rng.random() < 0.1:
+                    output.write('<humanitarian-scope type="1" vocabulary="1-2" code="EP-2020-000012-001"/>\n')
+                for _ in range(rng.randint(0, 5)):
+                    transaction_humanitarian = ' humanitarian="1"' if rng.random() < 0.05 else ''
+                    output.write('<transaction{}><transaction-type code="{}"/><value>100</value>{}{}</transaction>\n'.format(
+                        transaction_humanitarian,
+                        rng.choice(["1", "2", "3", "4", "11",]),
+                        org_element("provider-org"),
+                        org_element("receiver-org"),
+                    ))
+                output.write('</iati-activity>\n')
+            output.write('</iati-activities>\n')
+
+    return filenames
+
+def generate_3w (filename, count, rng, names):
+    """ Write count synthetic rows to an HXL-tagged 3W CSV, like the HXL Proxy download """
+    admin1_names = list(names["admin1"].keys())
+    with open(filename, "w", newline="") as output:
+        writer = csv.writer(output)
+        writer.writerow([
+            "Programme", "Project", "Status", "Cluster", "Region", "District", "Location",
+            "Implementing", "Programming", "Funding", "Start", "End", "Modality",
+            "Individuals", "Households", "Women", "Men", "Girls", "Boys",
+        ])
+        writer.writerow([
+            "#activity+programme", "#activity+project", "#status", "#sector", "#adm1+name", "#adm2+name", "#loc+name",
+            "#org+impl", "#org+prog", "#org+funding", "#date+start", "#date+end", "#modality",
+            "#targeted+ind+all", "#targeted+hh+all", "#targeted+f+adults", "#targeted+m+adults", "#targeted+f+children", "#targeted+m+children",
+        ])
+        for i in range(count):
+            admin1 = rng.choice(admin1_names)
+            admin2 = rng.choice(names["admin1"][admin1] or [""]) if rng.random() < 0.9 else rng.choice(names["locations"])
+            location = rng.choice(names["locations"]) if rng.random() < 0.5 else ""
+            writer.writerow([
+                "Programme {}".format(i % 50),
+                "Project {}".format(i),
+                rng.choice(["Ongoing", "Completed",]),
+                rng.choice(names["cluster_names"]),
+                admin1,
+                admin2,
+                location,
+                rng.choice(names["orgs"]),
+                rng.choice(names["orgs"]),
+                rng.choice(names["orgs"] + [""]),
+                "2021-01-01",
+                "2021-12-31",
+                rng.choice(["", "Cash", " In kind ",]),
+                str(rng.randint(0, 500)),
+                rng.choice(["", "12", "x",]),
+                "1", "2", "3", "4",
+            ])
+    return filename
+
+def generate (directory, count, seed=1):
+    """ Generate count IATI activities and count 3W rows in directory
+    Returns (IATI filenames, 3W filename).
+
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    names = get_names()
+    iati_files = generate_iati(directory, count, rng, names)
+    threew_file = generate_3w(os.path.join(directory, "3w-som.csv"), count, rng, names)
+    return iati_files, threew_file
+
+
+#
+# Timing
+#
+
+def run_stage (args, stdout_filename, env):
+    """ Run one stage as a Python subprocess
+    Returns a dict with the wall-clock and CPU seconds, peak RSS (in KB, on
+    Linux), and what the stage wrote to stderr. Raises
+    subprocess.CalledProcessError if the stage fails.
+
+    """
+    with open(stdout_filename or os.devnull, "w") as output, tempfile.TemporaryFile("w+") as errors:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable] + args, stdout=output, stderr=errors, env=env)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        errors.seek(0)
+        messages = errors.read()
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, args, stderr=messages)
+
+    return {
+        "seconds": round(seconds, 3),
+        "cpu_seconds": round(usage.ru_utime + usage.ru_stime, 3),
+        "max_rss_kb": usage.ru_maxrss,
+        "stderr": messages,
+    }
+
+def found_count (messages):
+    """ Return the activity count from a converter's "Found N ... activities" message, or None """
+    match = re.search(r'Found (\d+) ', messages)
+    return int(match.group(1)) if match else None
+
+def run_benchmark (work_dir, count, seed=1, processes=1, stages=STAGES):
+    """ Generate the data and time each stage
+    Returns the report as a dict.
+
+    """
+
+    download_dir = os.path.join(work_dir, "downloads")
+    output_dir = os.path.join(work_dir, "output")
+    os.makedirs(output_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    iati_files, threew_file = generate(download_dir, count, seed)
+    generate_seconds = time.perf_counter() - start
+
+    # Keep compiled maps and caches out of the real cache directory
+    env = dict(os.environ)
+    env["IATI3W_CACHE_DIR"] = os.path.join(work_dir, "cache")
+
+    # Compile the lookup tables first, so that no stage pays for it
+    run_stage(["-m", "iati3w.compiled_maps", "build"], None, env)
+
+    iati_data = os.path.join(output_dir, "iati-data.json")
+    threew_data = os.path.join(output_dir, "3w-data.json")
+    indexer_dir = os.path.join(work_dir, "indexer")
+    os.makedirs(indexer_dir, exist_ok=True)
+
+    commands = {
+        "activities_iati": (["-m", "iati3w.activities_iati", "--processes={}".format(processes)] + iati_files, iati_data,),
+        "activities_3w": (["-m", "iati3w.activities_3w", threew_file], threew_data,),
+        "merge": (["-m", "iati3w.merge", iati_data, threew_data], os.path.join(output_dir, "activities.json"),),
+        "org_index": (["-m", "iati3w.org_index", iati_data, threew_data], os.path.join(output_dir, "org-index.json"),),
+        "sector_index": (["-m", "iati3w.sector_index", iati_data, threew_data], os.path.join(output_dir, "sector-index.json"),),
+        "location_index": (["-m", "iati3w.location_index", iati_data, threew_data], os.path.join(output_dir, "location-index.json"),),
+        "indexer": (["-m", "iati3w.indexer", indexer_dir, iati_data, threew_data], None,),
+    }
+
+    results = []
+    records = {}
+    for name in stages:
+        args, stdout_filename = commands[name]
+        result = run_stage(args, stdout_filename, env)
+
+        # What each stage's throughput is measured in
+        if name == "activities_iati":
+            records["iati"] = found_count(result["stderr"])
+            result["input_activities"] = count
+        elif name == "activities_3w":
+            records["3w"] = found_count(result["stderr"])
+            result["input_activities"] = count
+        elif len(records) == 2 and None not in records.values():
+            result["input_activities"] = records["iati"] + records["3w"]
+        else:
+            result["input_activities"] = None
+
+        if result["input_activities"] is not None and result["seconds"] > 0:
+            result["activities_per_second"] = round(result["input_activities"] / result["seconds"], 1)
+        else:
+            result["activities_per_second"] = None
+
+        del result["stderr"]
+        results.append(dict(stage=name, **result))
+        print("{}: {:.2f}s, {} KB".format(name, result["seconds"], result["max_rss_kb"]), file=sys.stderr)
+
+    return {
+        "version": REPORT_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "activities": count,
+        "seed": seed,
+        "processes": processes,
+        "records": records,
+        "generate_seconds": round(generate_seconds, 3),
+        "stages": results,
+    }
+
+
+#
+# Script entry point
+#
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic data")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="generate data and time each stage")
+    run_parser.add_argument("-n", "--activities", type=int, default=1000, help="IATI activities and 3W rows to generate (default: 1000)")
+    run_parser.add_argument("-s", "--seed", type=int, default=1, help="random seed (default: 1)")
+    run_parser.add_argument("-p", "--processes", type=int, default=1, help="worker processes for activities_iati (default: 1)")
+    run_parser.add_argument("-w", "--work-dir", help="directory for the generated data and outputs (default: a temporary directory)")
+    run_parser.add_argument("-r", "--report", help="write the JSON report to this file instead of stdout")
+    run_parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="stages to run (default: all, in order)")
+
+    generate_parser = subparsers.add_parser("generate", help="only generate the synthetic data")
+    generate_parser.add_argument("-n", "--activities", type=int, default=1000, help="IATI activities and 3W rows to generate (default: 1000)")
+    generate_parser.add_argument("-s", "--seed", type=int, default=1, help="random seed (default: 1)")
+    generate_parser.add_argument("directory", help="directory for the generated files")
+
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        iati_files, threew_file = generate(args.directory, args.activities, args.seed)
+        print("Generated {} IATI pages and {}".format(len(iati_files), threew_file), file=sys.stderr)
+        sys.exit(0)
+
+    try:
+        if args.work_dir:
+            report = run_benchmark(args.work_dir, args.activities, args.seed, args.processes, args.stages)
+        else:
+            with tempfile.TemporaryDirectory(prefix="iati3w-benchmark-") as work_dir:
+                report = run_benchmark(work_dir, args.activities, args.seed, args.processes, args.stages)
+    except subprocess.CalledProcessError as e:
+        print("*** Stage failed: {}\n{}".format(" ".join(e.cmd[:2]), e.stderr), file=sys.stderr)
+        sys.exit(1)
+
+    if args.report:
+        with open(args.report, "w") as output:
+            json.dump(report, output, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+
+# end
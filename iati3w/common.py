@@ -2,12 +2,19 @@
 
 """
 
-import json, re, string
+import collections, functools, itertools, json, os, re, string, threading
 
 from hxl.datatypes import is_empty
 
 from unidecode import unidecode
 
+from . import compiled_maps, fuzzy, instrument
+
+try:
+    import orjson
+except ImportError:
+    orjson = None # optional: only makes compact JSON faster
+
 #
 # Keys for classifying things
 #
@@ -24,6 +31,190 @@ ORG_BLOCKLIST = [
 ]
 
 
+#
+# Maximum number of results to keep in each lookup cache (see memoise())
+# 0 disables the caches. Override with the IATI3W_LOOKUP_CACHE_SIZE environment variable.
+#
+LOOKUP_CACHE_SIZE = int(os.environ.get("IATI3W_LOOKUP_CACHE_SIZE", 65536))
+
+#
+# Minimum score for matching an org or location name that isn't in the
+# map to the closest one that is (see iati3w.fuzzy), from 0 to 1. 0 (the
+# default) turns approximate matching off. Override with the
+# IATI3W_FUZZY_THRESHOLD environment variable, or set_fuzzy_threshold().
+#
+FUZZY_THRESHOLD = float(os.environ.get("IATI3W_FUZZY_THRESHOLD", 0))
+
+#
+# Maximum number of made-up records for unrecognised location names to
+# remember (see register_unrecognised()). None means no limit.
+#
+UNRECOGNISED_REGISTRY_SIZE = 65536
+
+
+#
+# Memoisation for the hot lookup functions
+#
+
+memoised_functions = {}
+""" The original and cached versions of each memoised function, keyed by name """
+
+def memoise (f):
+    """ Decorator to cache a function's results in a bounded LRU cache
+    The arguments must be hashable. Use set_lookup_cache_size() to resize
+    the caches, and lookup_cache_stats() to see the hit/miss counters.
+
+    """
+    name = f.__name__
+    memoised_functions[name] = [f, functools.lru_cache(maxsize=LOOKUP_CACHE_SIZE)(f)]
+
+    @functools.wraps(f)
+    def wrapper (*args):
+        return memoised_functions[name][1](*args)
+
+    return wrapper
+
+def set_lookup_cache_size (size):
+    """ Resize (and clear) all of the lookup caches
+    0 disables caching, and None makes the caches unbounded.
+
+    """
+    global LOOKUP_CACHE_SIZE
+    LOOKUP_CACHE_SIZE = size
+    for entry in memoised_functions.values():
+        entry[1] = functools.lru_cache(maxsize=size)(entry[0])
+
+def clear_lookup_caches ():
+    """ Empty all of the lookup caches and reset the counters """
+    for entry in memoised_functions.values():
+        entry[1].cache_clear()
+
+def forget_lookups ():
+    """ Empty the lookup caches and the registry of unrecognised locations, as at the start of a run
+    Each unrecognised location then gets the record for the first name
+    seen for it from here on, just as in a new process.
+
+    """
+    clear_lookup_caches()
+    clear_registry(unrecognised_locations)
+
+def set_fuzzy_threshold (threshold):
+    """ Change the approximate matching threshold (0 turns it off), and forget the earlier lookups """
+    global FUZZY_THRESHOLD
+    FUZZY_THRESHOLD = threshold
+    # the registry remembers unrecognised names, which might match now
+    forget_lookups()
+
+def lookup_cache_stats ():
+    """ Return the hits, misses, and size of each lookup cache, keyed by function name """
+    result = {}
+    for name, entry in memoised_functions.items():
+        info = entry[1].cache_info()
+        result[name] = {
+            "hits": info.hits,
+            "misses": info.misses,
+            "maxsize": info.maxsize,
+            "currsize": info.currsize,
+        }
+    return result
+
+
+#
+# Read-only lookup records
+#
+# The lookup tables, the lookup caches, and the indexes all share the same
+# record for each org or location, between callers, threads, and forked
+# worker processes, so the records can't be changed once they're made.
+# They're still a dict and lists, so callers use them (and encode them as
+# JSON) like the maps they came from.
+#
+
+def read_only (self, *args, **kwargs):
+    """ Refuse to change a read-only record """
+    raise TypeError("lookup records are read-only")
+
+class Record (dict):
+    """ A read-only dict for a lookup record (see freeze()) """
+
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = __ior__ = read_only
+    clear = pop = popitem = setdefault = update = read_only
+
+    def __reduce__ (self):
+        # the default for a dict subclass would set each item after creating it
+        return (Record, (dict(self),))
+
+    def __copy__ (self):
+        return self
+
+    def __deepcopy__ (self, memo):
+        return self
+
+class FrozenList (list):
+    """ A read-only list inside a lookup record (see freeze()) """
+
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = read_only
+    append = clear = extend = insert = pop = remove = reverse = sort = read_only
+
+    def __reduce__ (self):
+        return (FrozenList, (list(self),))
+
+    def __copy__ (self):
+        return self
+
+    def __deepcopy__ (self, memo):
+        return self
+
+def freeze (value):
+    """ Return a read-only version of a JSON-style value (dicts, lists, and scalars) """
+    if isinstance(value, Record) or isinstance(value, FrozenList):
+        return value
+    elif isinstance(value, dict):
+        return Record((key, freeze(v)) for key, v in value.items())
+    elif isinstance(value, list):
+        return FrozenList(freeze(v) for v in value)
+    else:
+        return value
+
+
+#
+# Bounded registries for the records made up for unrecognised names
+#
+
+def make_registry (size=UNRECOGNISED_REGISTRY_SIZE):
+    """ Make an empty registry, keeping at most size records (None for no limit) """
+    return {
+        "size": size,
+        "records": collections.OrderedDict(),
+        "lock": threading.Lock(),
+    }
+
+def register_unrecognised (registry, token, record):
+    """ Return the registered record for a token, registering record first if there isn't one
+    The first record for a token wins, so every later lookup of the same
+    name gets the same record, however it's spelt. The least-recently
+    used records are dropped when there are too many.
+
+    """
+    with registry["lock"]:
+        records = registry["records"]
+        if token in records:
+            records.move_to_end(token)
+            return records[token]
+        records[token] = record
+        if registry["size"] is not None and len(records) > registry["size"]:
+            records.popitem(last=False)
+        return record
+
+def clear_registry (registry):
+    """ Forget all of the records in a registry """
+    with registry["lock"]:
+        registry["records"].clear()
+
+
 #
 # Utility functions
 #
@@ -47,26 +238,185 @@ def normalise_string (s):
     else:
         return re.sub(r'\s+', ' ', s.strip())
 
+@instrument.timed("make_token")
+@memoise
 def make_token (s):
     """ Create a lookup token from a string.
     Normalise space, convert to lowercase, and remove punctuation
     Use max 64 characters.
+    Memoised, since we see the same few thousand strings over and over.
 
     """
     return re.sub(r'\W+', ' ', unidecode(s))[:64].lower().strip().replace(' ', '-')
 
+
+#
+# JSON serialisation
+#
+# Everything the stages write goes through encode_json(), in one of two
+# modes: "pretty" (indented by 4 spaces, ASCII only: exactly what
+# json.dump(..., indent=4) writes) or "compact" (no whitespace, UTF-8).
+# Compact mode uses orjson if it's installed, which is many times faster
+# than the stdlib encoder. The two give the same bytes for everything the
+# pipeline writes (strings, integers, booleans, and null). Choose the mode
+# with IATI3W_JSON_MODE or a script's --json-mode option, and force the
+# stdlib encoder with IATI3W_JSON_BACKEND=stdlib.
+#
+
+JSON_MODES = ["pretty", "compact",]
+""" The JSON output modes """
+
+JSON_MODE = os.environ.get("IATI3W_JSON_MODE", "pretty")
+""" The default JSON output mode """
+
+if JSON_MODE not in JSON_MODES:
+    raise ValueError("IATI3W_JSON_MODE must be one of {}".format(", ".join(JSON_MODES)))
+
+JSON_BACKEND = "orjson" if orjson is not None and os.environ.get("IATI3W_JSON_BACKEND") != "stdlib" else "stdlib"
+""" The encoder for compact mode ("orjson" or "stdlib") """
+
+def set_json_mode (mode):
+    """ Change the default JSON output mode """
+    global JSON_MODE
+    if mode not in JSON_MODES:
+        raise ValueError("Unknown JSON mode: {}".format(mode))
+    JSON_MODE = mode
+
+@instrument.timed("json_encode")
+def encode_json (value, mode=None):
+    """ Return the JSON text for a value, in the mode given (default JSON_MODE) """
+    if (mode or JSON_MODE) == "pretty":
+        return json.dumps(value, indent=4)
+    if JSON_BACKEND == "orjson":
+        try:
+            return orjson.dumps(value).decode("utf-8")
+        except TypeError:
+            pass # e.g. integers too big for orjson: let the stdlib handle them
+    return json.dumps(value, separators=(",", ":",), ensure_ascii=False)
+
+JSON_CHUNKS = 4096
+""" Number of encoder chunks to join for each write in pretty mode (see dump_json()) """
+
+def dump_json (value, output, mode=None):
+    """ Write a value to a stream as JSON, in the mode given (default JSON_MODE)
+    Pretty mode writes the text a few thousand pieces at a time as it's
+    encoded, instead of building all of it first (the indented text of
+    an index takes more memory than the index itself). Compact mode
+    still builds the text in one go, which is much faster (especially
+    with orjson) and a lot smaller.
+
+    """
+    if (mode or JSON_MODE) == "pretty":
+        chunks = json.JSONEncoder(indent=4).iterencode(value)
+        while True:
+            text = "".join(itertools.islice(chunks, JSON_CHUNKS))
+            if not text:
+                break
+            output.write(text)
+    else:
+        output.write(encode_json(value, mode))
+
+def dump_json_list (items, output, mode=None):
+    """ Write the items from an iterable as a JSON array, one at a time.
+    Produces the same text as dump_json(list(items), output, mode)
+    without holding all of the items in memory. Returns the number of
+    items written.
+
+    """
+    pretty = (mode or JSON_MODE) == "pretty"
+    count = 0
+    for item in items:
+        if pretty:
+            output.write("[\n" if count == 0 else ",\n")
+            # JSON strings can't contain raw newlines, so it's safe to indent this way
+            output.write("    " + encode_json(item, "pretty").replace("\n", "\n    "))
+        else:
+            output.write("[" if count == 0 else ",")
+            output.write(encode_json(item, "compact"))
+        count += 1
+    if count == 0:
+        output.write("[]")
+    else:
+        output.write("\n]" if pretty else "]")
+    return count
+
+class JSONObjectWriter:
+    """ Write a JSON object to a stream one property at a time.
+    Produces the same text as dump_json(dict, output, mode) without
+    holding all of the values in memory. Call close() after the last
+    property. level is how deeply the object is nested (for the
+    indentation in pretty mode: see write_object()).
+
+    """
+
+    def __init__ (self, output, mode=None, level=0):
+        self.output = output
+        self.mode = mode
+        self.pretty = (mode or JSON_MODE) == "pretty"
+        self.level = level
+        self.indent = "\n" + "    " * (level + 1)
+        self.count = 0
+
+    def write_key (self, key):
+        """ Write the separator and the key for the next property """
+        if self.pretty:
+            self.output.write(("{" if self.count == 0 else ",") + self.indent + json.dumps(key) + ": ")
+        else:
+            self.output.write(("{" if self.count == 0 else ",") + encode_json(key, "compact") + ":")
+        self.count += 1
+
+    def encode (self, value):
+        """ Return the JSON text for a property value, indented for this object """
+        if self.pretty:
+            # JSON strings can't contain raw newlines, so it's safe to indent this way
+            return encode_json(value, "pretty").replace("\n", self.indent)
+        else:
+            return encode_json(value, "compact")
+
+    def write (self, key, value):
+        """ Write one property """
+        self.write_key(key)
+        self.output.write(self.encode(value))
+
+    def write_object (self, key):
+        """ Start a property whose value is another object, and return a writer for it (close it before the next property) """
+        self.write_key(key)
+        return JSONObjectWriter(self.output, self.mode, self.level + 1)
+
+    def close (self):
+        """ Finish the object """
+        if self.count == 0:
+            self.output.write("{}")
+        elif self.pretty:
+            self.output.write("\n" + "    " * self.level + "}")
+        else:
+            self.output.write("}")
+
 #
 # Look up and manage JSON datasets
 #
+# The datasets and tables are loaded on first use, and may be first used
+# from several threads at once (see iati3w.activities_iati). Each getter
+# checks for a loaded one without locking, and only takes loader_lock to
+# load it, checking again once it has the lock in case another thread
+# got there first. A dataset or table is only stored once it's complete.
+#
+
+loader_lock = threading.RLock()
+""" Held while loading a dataset or table (reentrant, because some tables are built from others) """
 
 datasets_loaded = {}
 
+@instrument.timed("get_dataset")
 def get_dataset (path):
-    global datasets_loaded
-    if not path in datasets_loaded:
-        with open(path, "r") as input:
-            datasets_loaded[path] = json.load(input)
-    return datasets_loaded[path]
+    dataset = datasets_loaded.get(path)
+    if dataset is None:
+        with loader_lock:
+            if not path in datasets_loaded:
+                with open(path, "r") as input:
+                    datasets_loaded[path] = json.load(input)
+            dataset = datasets_loaded[path]
+    return dataset
 
 
 #
@@ -78,10 +428,20 @@ lookup_tables_loaded = {}
 def get_lookup_table (path):
     """ Make a lookup table, including synonyms
     Keys will be tokenized
+    Uses the compiled version of the table if it's up to date (see iati3w.compiled_maps)
 
     """
 
-    global lookup_tables_loaded
+    table = lookup_tables_loaded.get(path)
+    if table is None:
+        with loader_lock:
+            if not path in lookup_tables_loaded:
+                lookup_tables_loaded[path] = compiled_maps.load_table("lookup", path, [path, __file__], lambda: build_lookup_table(path))
+            table = lookup_tables_loaded[path]
+    return table
+
+def build_lookup_table (path):
+    """ Build a lookup table from a JSON map, including synonyms """
 
     def add(name, info, result):
         """ Add a tokenised name to the map """
@@ -91,32 +451,40 @@ def get_lookup_table (path):
         else:
             result.setdefault(make_token(name), info) # don't overwrite
 
-    if not path in lookup_tables_loaded:
-        result = {}
-        map = get_dataset(path)
-        for key, info in map.items():
-            add(key, info, result)
-            if "name" in info:
-                add(info["name"], info, result)
-            if "shortname" in info:
-                add(info["shortname"], info, result)
-                if make_token(info["name"]) != make_token(info["shortname"]):
-                    # construct the "Full name (Acronym)" variant if appropriate
-                    add("{} ({})".format(info["name"], info["shortname"]), info, result)
-            for synonym in info.get("synonyms", []):
-                add(synonym, info, result)
-        lookup_tables_loaded[path] = result
-
-    return lookup_tables_loaded[path]
+    result = {}
+    map = get_dataset(path)
+    for key, info in map.items():
+        # one read-only record for all of the entry's names, with its stub
+        if "name" in info:
+            info = dict(info, stub=info.get("stub", make_token(info.get("shortname", info["name"]))))
+        info = freeze(info)
+        add(key, info, result)
+        if "name" in info:
+            add(info["name"], info, result)
+        if "shortname" in info:
+            add(info["shortname"], info, result)
+            if make_token(info["name"]) != make_token(info["shortname"]):
+                # construct the "Full name (Acronym)" variant if appropriate
+                add("{} ({})".format(info["name"], info["shortname"]), info, result)
+        for synonym in info.get("synonyms", []):
+            add(synonym, info, result)
 
+    return result
 
+
+@instrument.timed("lookup_org")
 def lookup_org (name, create=False):
-    """ Look up an org by name """
+    """ Look up an org by name
+    The lookups are memoised, and the record is shared and read-only (see Record).
+
+    """
     if name is None:
         return None
+    return find_org(str(name), create)
 
-    name = str(name)
-
+@memoise
+def find_org (name, create):
+    """ Look up an org by name (the memoised part of lookup_org) """
     for pattern in ORG_BLOCKLIST:
         if re.match(pattern, name, flags=re.I):
             return None
@@ -126,25 +494,56 @@ def lookup_org (name, create=False):
     token = make_token(name)
     table = get_lookup_table("inputs/org-map.json")
 
+    # Not found as is: if the caller would get an unrecognised record, try
+    # the closest match instead (if approximate matching is on). Lookups
+    # without create are for identifiers, which are exact or nothing.
+    if not token in table and create:
+        token = find_fuzzy("inputs/org-map.json", token) or token
+
     if token in table:
-        # Found
-        info = table[token]
-        # add a stub if it doesn't exist already
-        info.setdefault("stub", make_token(info.get("shortname", info["name"])))
-        return info
+        # Found (the table's records already have their stubs)
+        return table[token]
     elif create:
         # Not found, but caller wants a new record
-        return {
+        return freeze({
             "name": normalise_string(name),
             "shortname": normalise_string(name),
             "scope": "unknown",
             "unrecognised": True,
             "synonyms": [],
             "stub": make_token(name),
-        }
+        })
     else:
         return None
-    
+
+def find_org_pair (ref, name):
+    """ Look up an org by its identifier (exactly), and then by its name (creating a record if needed) """
+    info = None
+    if ref is not None:
+        info = find_org(ref, False)
+    if info is None and name is not None:
+        info = find_org(name, True)
+    return info
+
+@instrument.timed("lookup_orgs_batch")
+def lookup_orgs_batch (pairs):
+    """ Look up many orgs at once, from (ref, name) pairs
+    Same as lookup_org(ref) or lookup_org(name, create=True) for each
+    pair (either may be None), but each distinct pair is resolved only
+    once, so an activity that names the same few orgs in hundreds of
+    transactions doesn't look them up hundreds of times. Returns the
+    records (or None) in the same order as the pairs.
+
+    """
+    resolved = {}
+    result = []
+    for ref, name in pairs:
+        key = (None if ref is None else str(ref), None if name is None else str(name),)
+        if not key in resolved:
+            resolved[key] = find_org_pair(*key)
+        result.append(resolved[key])
+    return result
+
 
 #
 # Special lookup tables for locations (which are hierarchical)
@@ -152,14 +551,31 @@ def lookup_org (name, create=False):
 
 location_lookup_table = None
 
+unrecognised_locations = make_registry()
+""" Records for the location names that aren't in the map (see find_location()) """
+
 def get_location_lookup_table ():
-    """ Load and transform the location table if needed, then return """
+    """ Load and transform the location table if needed, then return
+    Uses the compiled version of the table if it's up to date (see iati3w.compiled_maps)
+
+    """
 
     global location_lookup_table
 
     # if it's already loaded, just return
-    if location_lookup_table is not None:
-        return location_lookup_table
+    table = location_lookup_table
+    if table is None:
+        with loader_lock:
+            if location_lookup_table is None:
+                path = "inputs/location-map.json"
+                location_lookup_table = compiled_maps.load_table("location", path, [path, __file__], build_location_lookup_table)
+            table = location_lookup_table
+    return table
+
+def build_location_lookup_table ():
+    """ Build the flat location lookup table from the hierarchical location map """
+
+    table = {}
 
     def add_entry(info, key, admin1=None, admin2=None):
         """ Construct a single, flat entry for a location, and add it under the name and synonyms """
@@ -175,19 +591,18 @@ def get_location_lookup_table ():
             if key not in ["admin1", "admin2", "unclassified"]:
                 entry.setdefault(key, info[key])
         entry.setdefault("stub", make_token(info["name"]))
+        entry = freeze(entry)
 
         # Add the main name
-        location_lookup_table.setdefault(make_token(key), entry)
-        location_lookup_table.setdefault(make_token(info["name"]), entry)
+        table.setdefault(make_token(key), entry)
+        table.setdefault(make_token(info["name"]), entry)
 
         # Add the synonyms
         for synonym in info.get("synonyms", []):
-            location_lookup_table.setdefault(make_token(synonym), entry)
+            table.setdefault(make_token(synonym), entry)
 
         if "iati_id" in info:
-            locaation_lookup_table.setdefault(make_token(info["iati_id"]), entry)
-
-    location_lookup_table = {}
+            table.setdefault(make_token(info["iati_id"]), entry)
 
     map = get_dataset("inputs/location-map.json")
 
@@ -218,25 +633,219 @@ def get_location_lookup_table ():
     for name, info in map["unclassified"].items():
         add_entry(info, key=name)
 
-    return location_lookup_table
+    return table
+
+
+#
+# Approximate matching (see iati3w.fuzzy)
+#
 
+fuzzy_indexes = {}
+""" Trigram index for each map, keyed by path """
 
+def get_fuzzy_index (path):
+    """ Return the trigram index over the tokens in the lookup table for a map
+    Uses the compiled version of the index if it's up to date (see iati3w.compiled_maps)
+
+    """
+    index = fuzzy_indexes.get(path)
+    if index is None:
+        with loader_lock:
+            if not path in fuzzy_indexes:
+                fuzzy_indexes[path] = compiled_maps.load_table("trigram", path, [path, __file__, fuzzy.__file__], lambda: build_fuzzy_index(path))
+            index = fuzzy_indexes[path]
+    return index
+
+def build_fuzzy_index (path):
+    """ Build the trigram index for a map from its lookup table """
+    if path == "inputs/location-map.json":
+        return fuzzy.build_index(get_location_lookup_table())
+    else:
+        return fuzzy.build_index(get_lookup_table(path))
+
+def find_fuzzy (path, token):
+    """ Return the closest token to an unknown one in the lookup table for a map, or None
+    Always None unless FUZZY_THRESHOLD is set.
+
+    """
+    if not FUZZY_THRESHOLD:
+        return None
+    matches = fuzzy.search(get_fuzzy_index(path), token, FUZZY_THRESHOLD, limit=1)
+    if not matches:
+        return None
+    instrument.count("fuzzy_matches")
+    return matches[0][1]
+
+def compiled_tables ():
+    """ Return (kind, path, depends, build) for each table that iati3w.compiled_maps manages """
+    tables = []
+    for path in ("inputs/org-map.json", "inputs/humanitarian-cluster-map.json",):
+        tables.append(("lookup", path, [path, __file__], lambda path=path: build_lookup_table(path),))
+    path = "inputs/location-map.json"
+    tables.append(("location", path, [path, __file__], build_location_lookup_table,))
+    for path in ("inputs/org-map.json", "inputs/location-map.json",):
+        tables.append(("trigram", path, [path, __file__, fuzzy.__file__], lambda path=path: build_fuzzy_index(path),))
+    return tables
+
+
+@instrument.timed("lookup_location")
 def lookup_location (name, loctype="unclassified"):
-    """ Look up a location name and see what we can do with it """
+    """ Look up a location name and see what we can do with it
+    The lookups are memoised, and the record is shared and read-only (see Record).
+
+    """
 
     # we don't care about empty names
     if is_empty(name):
         return None
 
+    return find_location(name, loctype)
+
+def find_location (name, loctype):
+    """ Look up a location name (lookup_location() without the timing)
+    Unrecognised names are matched to the closest location in the map if
+    FUZZY_THRESHOLD is set, and otherwise get a made-up record from the
+    unrecognised_locations registry (so the first name and type seen for
+    a token stick, as they would in the map).
+
+    """
+    return register_location(match_location(name, loctype))
+
+@memoise
+def match_location (name, loctype):
+    """ Look up a location name without registering it (the memoised part of find_location())
+    Returns the record from the map, or else a made-up record with this
+    spelling of the name (see unrecognised_location()).
+
+    """
+
     # return the lookup if it exists, or just a cleaned-up name
     token = make_token(name)
     lookup = get_location_lookup_table()
     if not token in lookup:
-        lookup[token] = {
-            "level": loctype,
-            "name": normalise_string(name),
-            "unrecognised": True,
-            "stub": token,
-        }
-    lookup[token].setdefault("stub", token)
-    return lookup[token]
+        # try the closest match, if approximate matching is on
+        token = find_fuzzy("inputs/location-map.json", token) or token
+    if token in lookup:
+        return lookup[token]
+    return unrecognised_location(token, name, loctype)
+
+def unrecognised_location (token, name, loctype):
+    """ Make up the record for a location name that isn't in the map """
+    return freeze({
+        "level": loctype,
+        "name": normalise_string(name),
+        "unrecognised": True,
+        "stub": token,
+    })
+
+def register_location (info):
+    """ Return the registered record for a location record from match_location() (or None)
+    A recognised location's record is returned as it is. An unrecognised
+    one gets the record for the first name registered with the same token.
+
+    """
+    if info is None or not info.get("unrecognised", False):
+        return info
+    return register_unrecognised(unrecognised_locations, info["stub"], info)
+
+def find_location_or_none (name):
+    """ Like lookup_location() for an unclassified location, without the timing (for the hot paths) """
+    return None if is_empty(name) else find_location(name, "unclassified")
+
+@instrument.timed("lookup_locations_batch")
+def lookup_locations_batch (names, loctype="unclassified", register=True):
+    """ Look up many location names at once
+    Same as lookup_location(name, loctype) for each name, but each
+    distinct name is resolved only once. Returns the records (or None)
+    in the same order as the names. If register is False, unrecognised
+    names keep their own spelling (as from match_location()), for a
+    caller that registers them itself later, in its own order.
+
+    """
+    lookup = find_location if register else match_location
+    resolved = {}
+    result = []
+    for name in names:
+        if not name in resolved:
+            resolved[name] = None if is_empty(name) else lookup(name, loctype)
+        result.append(resolved[name])
+    return result
+
+def location_key (info):
+    """ Use the stub for a recognised location, or the name for an unrecognised one """
+    return info["name"] if info.get("unrecognised", False) else info["stub"]
+
+@memoise
+def reconcile_locations (admin1_name, admin2_name, loc_name):
+    """ Work out the locations for a 3W row from its admin1, admin2, and loc names
+    Decides whether the loc is really an admin2, whether it implies the
+    admin2, and whether the admin2 overrides a conflicting admin1. Most
+    rows repeat the same few combinations, so the results are memoised
+    (see lookup_cache_stats()). Returns a tuple of (level, key) pairs to
+    add to the activity, in order.
+
+    """
+    admin1 = find_location_or_none(admin1_name)
+    admin2 = find_location_or_none(admin2_name)
+    loc = find_location_or_none(loc_name)
+
+    if (admin2 is None or admin2["level"] != "admin2") and loc is not None:
+        if loc["level"] == "admin2":
+            # For Banadir, especially, the loc can really be the admin2
+            admin2 = loc
+            loc = None
+        elif loc.get("admin2", None) is not None:
+            # Or else the loc can imply the admin2
+            admin2 = find_location_or_none(loc["admin2"])
+
+    if "admin1" in admin2 and admin2["admin1"] != make_token(admin1["name"]):
+        # Trust the district over the region for 3W (if they conflict)
+        admin1 = find_location_or_none(admin2["admin1"])
+
+    result = []
+
+    if admin1 is not None and admin1["level"] == "admin1":
+        result.append(("admin1", location_key(admin1),))
+
+    if admin2 is not None and admin2["level"] == "admin2":
+        result.append(("admin2", location_key(admin2),))
+
+    if loc is not None and loc["level"] == "unclassified":
+        result.append(("admin2", location_key(admin2),))
+
+    return tuple(result)
+
+@memoise
+def expand_location (name):
+    """ Return the location for a name plus its ancestor admin1 and admin2 (if any)
+    Returns a tuple of (level, key) pairs to add to an activity, in order,
+    or an empty tuple if the location is empty or flagged "skip".
+
+    """
+    return expand_location_info(find_location_or_none(name))
+
+def expand_location_info (info):
+    """ Like expand_location(), but for a location record that's already been looked up (or None) """
+
+    # honour the "skip" flag
+    if info is None or info.get("skip", False):
+        return ()
+
+    # Add the name here instead of the stub if the location isn't in the map
+    result = [(info["level"], location_key(info),)]
+
+    # Add the ancestor admin1 and admin2 if they exist
+    for level in ["admin1", "admin2"]:
+        if level in info:
+            result.append((level, info[level],))
+
+    return tuple(result)
+
+
+def preload_lookup_tables ():
+    """ Load all of the maps and lookup tables up front (e.g. once per worker process) """
+    get_lookup_table("inputs/org-map.json")
+    get_lookup_table("inputs/humanitarian-cluster-map.json")
+    get_location_lookup_table()
+    get_dataset("inputs/dac3-sector-map.json")
+    get_dataset("inputs/humanitarian-cluster-map.json")
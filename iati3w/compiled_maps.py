@@ -0,0 +1,137 @@
+""" Precompiled lookup tables for the JSON maps
+
+Building the lookup tables means tokenising every key, name, shortname,
+and synonym in inputs/org-map.json and inputs/location-map.json, and
+every pipeline stage used to pay that cost at start-up. The first
+process to need a table now saves it as a pickle in the cache
+directory, and later processes load it from there. Each compiled table
+records a SHA-256 hash of the files it was built from, and is rebuilt
+automatically when any of them change.
+
+Usage:
+
+    python3 -m iati3w.compiled_maps build   # (re)compile all of the tables
+    python3 -m iati3w.compiled_maps verify  # check the tables against the maps
+
+Set IATI3W_CACHE_DIR to change the cache directory (default "cache"),
+or IATI3W_COMPILED_MAPS=0 to always build the tables from the maps.
+
+"""
+
+import hashlib, os, pickle, sys, tempfile
+
+FORMAT_VERSION = 1
+""" Bump this to invalidate all existing compiled tables """
+
+CACHE_DIR = os.environ.get("IATI3W_CACHE_DIR", "cache")
+""" Root directory for compiled artefacts """
+
+ENABLED = os.environ.get("IATI3W_COMPILED_MAPS", "1") != "0"
+""" If False, always build the tables from the maps """
+
+
+#
+# Utility functions
+#
+
+def hash_files (paths):
+    """ Return a SHA-256 hex digest of the contents of a list of files """
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as input:
+            digest.update(input.read())
+    return digest.hexdigest()
+
+def compiled_path (kind, path):
+    """ Return the path of the compiled table for a map file """
+    basename = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(CACHE_DIR, "maps", "{}-{}.pickle".format(kind, basename))
+
+def read_compiled (kind, path):
+    """ Return the saved {"version", "hash", "table"} record for a map, or None if there isn't one """
+    try:
+        with open(compiled_path(kind, path), "rb") as input:
+            return pickle.load(input)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+def write_atomically (filename, data):
+    """ Write bytes to a file via a temporary file and a rename, so that parallel processes never see a partial file """
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(filename) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as output:
+            output.write(data)
+        os.replace(tmpname, filename)
+    except:
+        os.unlink(tmpname)
+        raise
+
+def save_compiled (kind, path, digest, table):
+    """ Save a compiled table atomically """
+    write_atomically(compiled_path(kind, path), pickle.dumps({
+        "version": FORMAT_VERSION,
+        "hash": digest,
+        "table": table,
+    }, protocol=pickle.HIGHEST_PROTOCOL))
+
+def load_table (kind, path, depends, build):
+    """ Return a lookup table, from its compiled version if it's up to date
+    kind is a short label for the type of table, path is the map file,
+    depends is the list of files that the table is built from, and
+    build is a function that builds the table from scratch.
+
+    """
+    if not ENABLED:
+        return build()
+
+    digest = hash_files(depends)
+    record = read_compiled(kind, path)
+    if record is not None and record.get("version") == FORMAT_VERSION and record.get("hash") == digest:
+        return record["table"]
+
+    table = build()
+    save_compiled(kind, path, digest, table)
+    return table
+
+
+#
+# Script entry point
+#
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 2 or sys.argv[1] not in ("build", "verify",):
+        print("Usage: {} build|verify".format(sys.argv[0]), file=sys.stderr)
+        sys.exit(2)
+
+    from . import common
+
+    status = 0
+
+    for kind, path, depends, build in common.compiled_tables():
+        digest = hash_files(depends)
+        if sys.argv[1] == "build":
+            save_compiled(kind, path, digest, build())
+            print("Compiled {}".format(compiled_path(kind, path)), file=sys.stderr)
+        else:
+            record = read_compiled(kind, path)
+            if record is None:
+                problem = "missing"
+            elif record.get("version") != FORMAT_VERSION:
+                problem = "wrong format version"
+            elif record.get("hash") != digest:
+                problem = "out of date"
+            elif record["table"] != build():
+                problem = "does not match a fresh build"
+            else:
+                problem = None
+            if problem:
+                print("*** {}: {}".format(compiled_path(kind, path), problem), file=sys.stderr)
+                status = 1
+            else:
+                print("OK {}".format(compiled_path(kind, path)), file=sys.stderr)
+
+    sys.exit(status)
+
+# end
@@ -0,0 +1,333 @@
+""" A sparse count cube of orgs, sectors, and locations by source
+
+The org, sector, and location indexes are all projections of the same
+counts: how often each org turns up with each sector, location, and
+partner, and how often each sector turns up with each location, split
+by source. The cube keeps those counts once, and the indexer rolls them
+up into the published index files (see iati3w.indexer). A saved cube
+can also be sliced later without reading the activities again, e.g.
+the orgs working on health in an admin2 district, in the 3W only:
+
+    python3 -m iati3w.cube query cache/cube.pickle --by orgs --sector humanitarian:health --location admin2:belet-weyne --source 3w
+    python3 -m iati3w.cube info cache/cube.pickle
+
+Coordinates: each dimension has a table of coordinates, and the cells
+refer to them by position.
+
+orgs: (stub, scope, skip) for each org record
+
+sectors: (type, stub, named), where named is False for an empty sector
+  name (which gets a sector index entry, but isn't counted anywhere)
+
+locations: (type, name) with the name exactly as it is in the
+  activity (that's what the indexes count), and location_stubs holds
+  the stub of the location index entry for each one (or None)
+
+sources: the activity sources ("3W" or "IATI")
+
+Cuboids: each is a sparse dict from (coordinate ids..., source id) to a
+count. An activity adds the product of the number of times each
+coordinate appears in it (so an org listed in two roles counts twice),
+which is how the indexes have always counted. Because of that, the
+two-dimensional cuboids aren't sums of the three-dimensional one, so
+each is kept in its own right; the "all" facet in the indexes is the
+sum over the sources.
+
+orgs, sectors, locations: one dimension each
+
+org_sector, org_location, sector_location: two dimensions
+
+org_sector_location: all three (only used for slices, so it's left out
+  of a cube that's only rolled up into the indexes: see make_cube())
+
+partners: (org, reporting org), for the partner counts in the org index
+
+The cube also holds the entity tables for the three indexes (the
+entries without their counts: org info, activity lists, and so on), so
+that the indexer can update everything from a saved cube in a delta
+run. Cubes are saved as pickles, like the compiled lookup tables.
+
+"""
+
+import argparse, collections, pickle, sys
+
+from .common import *
+from .compiled_maps import write_atomically
+
+CUBE_VERSION = 1
+""" Bump this to ignore saved cubes after changing the layout """
+
+DIMENSIONS = ["orgs", "sectors", "locations",]
+""" The dimensions that slice_cube() can group by or filter on """
+
+CUBOIDS = {
+    "orgs": ("orgs",),
+    "sectors": ("sectors",),
+    "locations": ("locations",),
+    "org_sector": ("orgs", "sectors",),
+    "org_location": ("orgs", "locations",),
+    "sector_location": ("sectors", "locations",),
+    "org_sector_location": ("orgs", "sectors", "locations",),
+    "partners": ("orgs", "orgs",),
+}
+""" The dimensions of each cuboid (the source is always the last part of the key as well) """
+
+
+#
+# Building
+#
+
+SLICE_ONLY_CUBOIDS = ["org_sector_location",]
+""" The cuboids that only slice_cube() uses (none of the indexes roll them up) """
+
+def make_cube (slices=True):
+    """ Return a new, empty cube
+    If slices is False, leave out the cuboids that only slice_cube()
+    needs, for a cube that's only going to be rolled up into the indexes
+    (not saved or queried). The three-dimensional one is by far the
+    biggest and slowest to fill.
+
+    """
+    return {
+        "version": CUBE_VERSION,
+        "coordinates": {dimension: [] for dimension in ["sources"] + DIMENSIONS},
+        "ids": {dimension: {} for dimension in ["sources"] + DIMENSIONS},
+        "location_stubs": [],
+        "cuboids": {name: {} for name in CUBOIDS if slices or not name in SLICE_ONLY_CUBOIDS},
+        "entities": {name: {} for name in DIMENSIONS},
+    }
+
+def get_id (cube, dimension, coordinate):
+    """ Return the id for a coordinate, adding it to the dimension if necessary """
+    ids = cube["ids"][dimension]
+    id = ids.get(coordinate)
+    if id is None:
+        id = ids[coordinate] = len(cube["coordinates"][dimension])
+        cube["coordinates"][dimension].append(coordinate)
+    return id
+
+def get_location_id (cube, type, name, location):
+    """ Return the id for a location name, recording the stub of the location it resolves to (if any) """
+    id = get_id(cube, "locations", (type, name,))
+    if id == len(cube["location_stubs"]):
+        cube["location_stubs"].append(None if not location or location.get("skip", False) else location["stub"])
+    return id
+
+def add_cell (cuboid, key, count):
+    """ Add count (which may be negative) to a cell, dropping the cell if it falls to 0 """
+    count += cuboid.get(key, 0)
+    if count:
+        cuboid[key] = count
+    else:
+        cuboid.pop(key, None)
+
+def add_counts (cube, activity, resolved, weight=1):
+    """ Add an activity's counts to a cube (or subtract them, if weight is -1)
+    resolved is from iati3w.indexer.resolve_activity(). Doesn't touch the
+    entity tables (the indexer keeps those up to date).
+
+    """
+    source = get_id(cube, "sources", activity["source"])
+
+    orgs = collections.Counter()
+    for role in ROLES:
+        for org in resolved["orgs"].get(role, []):
+            if org is not None:
+                orgs[get_id(cube, "orgs", (org["stub"], org["scope"], org.get("skip", False),))] += 1
+
+    sectors = collections.Counter()
+    for type in SECTOR_TYPES:
+        for sector, stub in zip(activity["sectors"].get(type, []), resolved["sectors"].get(type, [])):
+            sectors[get_id(cube, "sectors", (type, stub, bool(sector),))] += 1
+
+    locations = collections.Counter()
+    for type in LOCATION_TYPES:
+        for name, location in zip(activity["locations"].get(type, []), resolved["locations"].get(type, [])):
+            if name:
+                locations[get_location_id(cube, type, name, location)] += 1
+
+    cuboids = cube["cuboids"]
+    org_sector_location = cuboids.get("org_sector_location")
+
+    for o, org_count in orgs.items():
+        n = org_count * weight
+        add_cell(cuboids["orgs"], (o, source,), n)
+        for s, sector_count in sectors.items():
+            add_cell(cuboids["org_sector"], (o, s, source,), n * sector_count)
+            if org_sector_location is not None:
+                for l, location_count in locations.items():
+                    add_cell(org_sector_location, (o, s, l, source,), n * sector_count * location_count)
+        for l, location_count in locations.items():
+            add_cell(cuboids["org_location"], (o, l, source,), n * location_count)
+
+    for s, sector_count in sectors.items():
+        n = sector_count * weight
+        add_cell(cuboids["sectors"], (s, source,), n)
+        for l, location_count in locations.items():
+            add_cell(cuboids["sector_location"], (s, l, source,), n * location_count)
+
+    for l, location_count in locations.items():
+        add_cell(cuboids["locations"], (l, source,), location_count * weight)
+
+    # each org is a partner of the reporting org (and vice versa)
+    reporter = resolved["reporting_org"]
+    if reporter is not None and not reporter.get("skip", False):
+        r = get_id(cube, "orgs", (reporter["stub"], reporter["scope"], False,))
+        for o, org_count in orgs.items():
+            stub, scope, skip = cube["coordinates"]["orgs"][o]
+            if not skip and stub != reporter["stub"]:
+                add_cell(cuboids["partners"], (o, r, source,), org_count * weight)
+
+
+#
+# Saving and loading
+#
+
+def save_cube (filename, cube):
+    """ Save a cube atomically """
+    write_atomically(filename, pickle.dumps(cube, protocol=pickle.HIGHEST_PROTOCOL))
+
+def load_cube (filename):
+    """ Load a saved cube, or return None if it's missing or has an old layout """
+    try:
+        with open(filename, "rb") as input:
+            cube = pickle.load(input)
+        if cube.get("version") == CUBE_VERSION:
+            return cube
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        pass
+    return None
+
+
+#
+# Slicing
+#
+
+def get_labels (cube, dimension):
+    """ Return the label for each coordinate in a dimension, as counted in the indexes
+    Orgs are labelled by stub; sectors and locations by (type, stub). The
+    label is None for coordinates that the indexes don't count (empty
+    sector names, and location names that don't resolve).
+
+    """
+    coordinates = cube["coordinates"][dimension]
+    if dimension == "orgs":
+        return [stub for stub, scope, skip in coordinates]
+    elif dimension == "sectors":
+        return [(type, stub,) if named else None for type, stub, named in coordinates]
+    else:
+        return [(type, stub,) if stub is not None else None for (type, name), stub in zip(coordinates, cube["location_stubs"])]
+
+def matches (label, value):
+    """ True if a label matches a filter value (an org stub, or a (type, stub) pair whose type may be None) """
+    if label is None:
+        return False
+    elif isinstance(value, tuple):
+        return label[1] == value[1] and (value[0] is None or label[0] == value[0])
+    else:
+        return label == value
+
+def slice_cube (cube, by, source=None, org=None, sector=None, location=None):
+    """ Count the orgs, sectors, or locations (by) in a slice of a cube
+    org is an org stub; sector and location are (type, stub) pairs,
+    where the type may be None to match any type; source is "3W" or
+    "IATI" (in any case), or None for both. Returns {stub: count} for
+    orgs, or {type: {stub: count}} for sectors and locations, with the
+    same counts as the index files (e.g. slicing by orgs for one sector
+    gives the org counts in that sector's entry, summed over scopes).
+    Locations are always matched and counted by the stub of the location
+    index entry, though the org and sector entries count each location
+    name separately. A filter on the dimension being counted (e.g. org
+    when slicing by orgs) leaves just the matching coordinates in the
+    result.
+
+    """
+    filters = {"orgs": org, "sectors": sector, "locations": location,}
+    dimensions = [by] + [dimension for dimension in DIMENSIONS if dimension != by and filters[dimension] is not None]
+    name = [name for name, axes in CUBOIDS.items() if name != "partners" and sorted(axes) == sorted(dimensions)][0]
+    axes = CUBOIDS[name]
+    if not name in cube["cuboids"]:
+        raise ValueError("This cube was made without slices (see make_cube())")
+
+    labels = {dimension: get_labels(cube, dimension) for dimension in axes}
+    source_ids = set(
+        id for id, name in enumerate(cube["coordinates"]["sources"]) if source is None or name.lower() == source.lower()
+    )
+
+    # check each filter once per coordinate, not once per cell
+    allowed = {}
+    for dimension in axes:
+        if filters[dimension] is not None:
+            allowed[dimension] = set(id for id, label in enumerate(labels[dimension]) if matches(label, filters[dimension]))
+
+    result = {}
+    by_position = axes.index(by)
+    for key, count in cube["cuboids"][name].items():
+        if not key[-1] in source_ids:
+            continue
+        if not all(key[i] in allowed[dimension] for i, dimension in enumerate(axes) if dimension in allowed):
+            continue
+        label = labels[by][key[by_position]]
+        if label is None:
+            continue
+        if by == "orgs":
+            result[label] = result.get(label, 0) + count
+        else:
+            counts = result.setdefault(label[0], {})
+            counts[label[1]] = counts.get(label[1], 0) + count
+    return result
+
+def describe_cube (cube):
+    """ Return the number of coordinates in each dimension and cells in each cuboid """
+    return {
+        "coordinates": {dimension: len(coordinates) for dimension, coordinates in cube["coordinates"].items()},
+        "cells": {name: len(cuboid) for name, cuboid in cube["cuboids"].items()},
+    }
+
+
+#
+# Script entry point
+#
+
+def parse_coordinate (s):
+    """ Parse a TYPE:STUB (or just STUB) command-line option into a (type, stub) pair """
+    if ":" in s:
+        return tuple(s.split(":", 1))
+    else:
+        return (None, s,)
+
+def sort_counts (counts):
+    """ Sort counts (or nested counts) by descending count, then by key """
+    if counts and isinstance(next(iter(counts.values())), dict):
+        return {key: sort_counts(value) for key, value in counts.items()}
+    return dict(sorted(counts.items(), key=lambda item: (-item[1], item[0],)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query a saved count cube (see iati3w.indexer --cube)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    info_parser = subparsers.add_parser("info", help="show the size of each dimension and cuboid")
+    info_parser.add_argument("cube", help="saved cube file")
+
+    query_parser = subparsers.add_parser("query", help="count orgs, sectors, or locations in a slice of the cube")
+    query_parser.add_argument("cube", help="saved cube file")
+    query_parser.add_argument("-b", "--by", choices=DIMENSIONS, required=True, help="what to count")
+    query_parser.add_argument("-o", "--org", help="only activities with this org (stub)")
+    query_parser.add_argument("-s", "--sector", type=parse_coordinate, help="only activities with this sector ([TYPE:]STUB, e.g. humanitarian:health)")
+    query_parser.add_argument("-l", "--location", type=parse_coordinate, help="only activities with this location ([TYPE:]STUB, e.g. admin2:banadir)")
+    query_parser.add_argument("--source", help="only activities from this source (3w or iati)")
+
+    args = parser.parse_args()
+
+    cube = load_cube(args.cube)
+    if cube is None:
+        print("Can't load a cube from {}".format(args.cube), file=sys.stderr)
+        sys.exit(1)
+
+    if args.command == "info":
+        dump_json(describe_cube(cube), sys.stdout)
+    else:
+        dump_json(sort_counts(slice_cube(cube, args.by, args.source, args.org, args.sector, args.location)), sys.stdout)
+    print("", file=sys.stdout)
+
+# end
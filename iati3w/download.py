@@ -0,0 +1,297 @@
+""" Download the 3W and IATI data, several requests at a time
+
+Usage:
+
+    python3 -m iati3w.download [--concurrency N] [--retries N] [--downloads DIR] [--threew-url URL] [--iati-url TEMPLATE]
+
+Fetches the Somalia 3W from the HXL Proxy as downloads/3w-som.csv, and
+the IATI activities from d-portal 100 at a time as
+downloads/iati-som-00000.xml, downloads/iati-som-00100.xml, etc., until
+a page comes back without any activities (the same files that
+admin-scripts/download-data.sh always produced).
+
+Up to --concurrency requests run at once: the IATI pages are requested
+ahead of the one being checked, so the end of the data is found without
+waiting for each page in turn. Failed requests (connection errors,
+timeouts, and HTTP 429 or 5xx) are retried with exponential backoff.
+If the server sent an ETag or Last-Modified header for a file last
+time, the request is conditional, and an unchanged file is kept as is
+(apart from its timestamp, so make still sees a fresh download). Every
+file is written atomically, and pages left over from an earlier, longer
+download are removed.
+
+The --iati-url template uses %d for the offset, so the script can be
+pointed at a local test server.
+
+"""
+
+import argparse, asyncio, functools, glob, json, os, re, sys, urllib.error, urllib.request
+
+from .compiled_maps import write_atomically
+
+THREEW_URL = "https://proxy.hxlstandard.org/data/8acb4c.csv"
+""" Where to get the Somalia 3W (HXL-tagged CSV) """
+
+IATI_URL = "http://www.d-portal.org/q.xml?from=act,country,dates&country_code=SO&day_end_gteq=2020-01-01&limit=100&offset=%d"
+""" Template for the d-portal queries (%d is the offset) """
+
+PAGE_SIZE = 100
+""" Activities per d-portal page """
+
+MAX_OFFSET = 1000000
+""" Stop here even if d-portal keeps sending activities """
+
+STATE_FILE = ".download-state.json"
+""" File in the downloads directory with the ETag and Last-Modified headers for each download """
+
+RETRY_STATUSES = (429, 500, 502, 503, 504,)
+""" HTTP statuses that are worth retrying """
+
+UMASK = os.umask(0o022)
+os.umask(UMASK)
+""" The process umask, for the permissions of downloaded files """
+
+class DownloadError (Exception):
+    """ A download failed, even after retrying """
+    pass
+
+
+#
+# Utility functions
+#
+
+def iati_filename (directory, offset):
+    """ Return the filename for the IATI page at an offset """
+    return os.path.join(directory, "iati-som-{:05d}.xml".format(offset))
+
+def has_activities (content):
+    """ True if a d-portal page contains any activities """
+    return b"<iati-activity" in content
+
+def write_file (filename, content):
+    """ Write a file atomically, with the usual permissions (like wget) rather than the temporary file's 0600 """
+    write_atomically(filename, content)
+    os.chmod(filename, 0o666 & ~UMASK)
+
+def load_state (directory):
+    """ Load the saved validators (ETag and Last-Modified) for each file """
+    try:
+        with open(os.path.join(directory, STATE_FILE), "r") as input:
+            return json.load(input)
+    except (OSError, ValueError):
+        return {}
+
+def save_state (directory, state):
+    """ Save the validators for each file """
+    write_file(os.path.join(directory, STATE_FILE), json.dumps(state, indent=4, sort_keys=True).encode("utf-8"))
+
+def fetch (url, headers, timeout):
+    """ Make one (blocking) HTTP GET request
+    Returns (status, body, response headers); body is None for 304 Not Modified.
+
+    """
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, response.read(), dict(response.headers)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return 304, None, dict(e.headers)
+        raise
+
+
+#
+# Downloading
+#
+
+class Downloader:
+    """ Fetch URLs concurrently, with retries and conditional requests """
+
+    def __init__ (self, directory, concurrency=8, retries=4, backoff=1.0, timeout=120):
+        self.directory = directory
+        self.semaphore = None
+        self.loop = None
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.state = load_state(directory)
+
+    def get_semaphore (self):
+        """ Return the semaphore limiting requests, for the running event loop
+        It's made here rather than in __init__(), because on Python 3.9 a
+        semaphore belongs to the loop that's current when it's made, and
+        the downloader is often built outside the loop (or in another
+        thread) from the one that runs the downloads.
+
+        """
+        loop = asyncio.get_running_loop()
+        if self.semaphore is None or self.loop is not loop:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+            self.loop = loop
+        return self.semaphore
+
+    async def get (self, url, filename):
+        """ Fetch a URL intended for a file
+        Returns (content, validators), where validators is None if the
+        file is unchanged (and content is its current contents), or
+        the ETag and Last-Modified headers to save with a new version.
+
+        """
+        key = os.path.basename(filename)
+        headers = {}
+        if key in self.state and os.path.exists(filename):
+            if self.state[key].get("etag"):
+                headers["If-None-Match"] = self.state[key]["etag"]
+            if self.state[key].get("last_modified"):
+                headers["If-Modified-Since"] = self.state[key]["last_modified"]
+
+        attempt = 0
+        while True:
+            try:
+                async with self.get_semaphore():
+                    status, body, response_headers = await asyncio.to_thread(fetch, url, headers, self.timeout)
+                break
+            except urllib.error.HTTPError as e:
+                if e.code not in RETRY_STATUSES or attempt >= self.retries:
+                    raise DownloadError("{}: HTTP {}".format(url, e.code))
+            except (urllib.error.URLError, OSError) as e:
+                if attempt >= self.retries:
+                    raise DownloadError("{}: {}".format(url, e))
+            delay = self.backoff * 2 ** attempt
+            print("Retrying {} in {:.1f}s".format(url, delay), file=sys.stderr)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+        if status == 304:
+            with open(filename, "rb") as input:
+                return input.read(), None
+
+        return body, {
+            "etag": response_headers.get("ETag"),
+            "last_modified": response_headers.get("Last-Modified"),
+        }
+
+    def save (self, filename, content, validators):
+        """ Save a download (or just refresh the timestamp of an unchanged file) """
+        key = os.path.basename(filename)
+        if validators is None:
+            os.utime(filename)
+            print("Unchanged {}".format(filename), file=sys.stderr)
+        else:
+            write_file(filename, content)
+            self.state[key] = validators
+            print("Downloaded {}".format(filename), file=sys.stderr)
+
+    def remove (self, filename):
+        """ Remove a file that's no longer part of the download """
+        self.state.pop(os.path.basename(filename), None)
+        if os.path.exists(filename):
+            os.remove(filename)
+            print("Removed {}".format(filename), file=sys.stderr)
+
+    async def download_3w (self, url):
+        """ Download the 3W """
+        filename = os.path.join(self.directory, "3w-som.csv")
+        content, validators = await self.get(url, filename)
+        self.save(filename, content, validators)
+
+    async def download_iati (self, template, on_page=None):
+        """ Download IATI pages until one is empty
+        Keeps up to concurrency requests ahead of the page being checked,
+        and saves pages strictly in order, so nothing past the first
+        empty page is ever written. As soon as any page comes back empty
+        (even ahead of the one being checked), nothing past it is
+        requested any more. If on_page is not None, it's called with the
+        filename of each page as soon as the page is saved (in offset
+        order). Returns the number of pages saved.
+
+        """
+        pending = {}
+        next_offset = 0
+        offset = 0
+        end = MAX_OFFSET
+
+        def check (page_offset, task):
+            """ Shrink the window when a page comes back empty """
+            nonlocal end
+            if task.cancelled() or task.exception() is not None or has_activities(task.result()[0]):
+                return
+            if page_offset < end:
+                end = page_offset
+                for later in [later for later in pending if later > end]:
+                    pending.pop(later).cancel()
+
+        try:
+            while offset <= end:
+                # keep the window full, up to the first empty page seen
+                while len(pending) < self.concurrency and next_offset <= end:
+                    task = asyncio.create_task(self.get(template % next_offset, iati_filename(self.directory, next_offset)))
+                    task.add_done_callback(functools.partial(check, next_offset))
+                    pending[next_offset] = task
+                    next_offset += PAGE_SIZE
+
+                content, validators = await pending.pop(offset)
+                if not has_activities(content):
+                    break
+                self.save(iati_filename(self.directory, offset), content, validators)
+                if on_page is not None:
+                    on_page(iati_filename(self.directory, offset))
+                offset += PAGE_SIZE
+        finally:
+            for task in pending.values():
+                task.cancel()
+
+        # remove the empty page and any pages left from an earlier download
+        for filename in glob.glob(os.path.join(self.directory, "iati-som-*.xml")):
+            match = re.search(r'iati-som-(\d+)\.xml$', filename)
+            if match and int(match.group(1)) >= offset:
+                self.remove(filename)
+
+        return offset // PAGE_SIZE
+
+    async def download_all (self, threew_url, iati_template, on_page=None):
+        """ Download the 3W and the IATI pages at the same time (see download_iati() for on_page) """
+        try:
+            results = await asyncio.gather(
+                self.download_3w(threew_url),
+                self.download_iati(iati_template, on_page),
+            )
+        finally:
+            save_state(self.directory, self.state)
+        return results[1]
+
+
+#
+# Script entry point
+#
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download the 3W and IATI data")
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="maximum requests at once (default: 8)")
+    parser.add_argument("-r", "--retries", type=int, default=4, help="retries for each failed request (default: 4)")
+    parser.add_argument("--backoff", type=float, default=1.0, help="seconds to wait before the first retry, doubling each time (default: 1)")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for each response (default: 120)")
+    parser.add_argument("-d", "--downloads", default="downloads", help="directory for the downloaded files (default: downloads)")
+    parser.add_argument("--threew-url", default=THREEW_URL, help="URL of the 3W CSV")
+    parser.add_argument("--iati-url", default=IATI_URL, help="template for the IATI page URLs, with %%d for the offset")
+    args = parser.parse_args()
+
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+
+    os.makedirs(args.downloads, exist_ok=True)
+
+    async def main ():
+        downloader = Downloader(args.downloads, args.concurrency, args.retries, args.backoff, args.timeout)
+        return await downloader.download_all(args.threew_url, args.iati_url)
+
+    try:
+        pages = asyncio.run(main())
+    except DownloadError as e:
+        print("Failed to download {}".format(e), file=sys.stderr)
+        sys.exit(1)
+
+    print("Downloaded the 3W and {} IATI pages".format(pages), file=sys.stderr)
+
+# end
@@ -0,0 +1,252 @@
+""" Reading and writing the intermediate activity files
+
+The activity files passed between stages (iati-data.json and
+3w-data.json) can be written in three formats:
+
+json: a JSON array of activity objects, indented (the original format)
+
+jsonl: JSON Lines, with one activity object per line
+
+compact: a line-oriented format for internal use. The first line is a
+  header object with the format name, a table of interned strings, and
+  a table of record shapes (key layouts). Each following line is a
+  JSON array for one activity: the shape number, then the values in
+  shape order. The source, the reporting org, and the org, sector, and
+  location lists are stored as integer indexes into the string table,
+  so each name is stored (and parsed) only once per file.
+
+read_activities() detects the format automatically, and produces
+exactly the same activity dicts (including key order) either way. It
+reads one activity at a time for all three formats (including JSON
+arrays), so a consumer that processes activities as they arrive never
+holds the whole corpus in memory.
+
+"""
+
+import json, re
+
+from .common import dump_json_list, encode_json
+
+FORMATS = ["json", "jsonl", "compact",]
+""" Formats that write_activities() supports """
+
+COMPACT_FORMAT = "iati3w-compact"
+""" Value of the "format" property in the header of a compact file """
+
+COMPACT_VERSION = 1
+""" Version of the compact format """
+
+INTERNED_VALUES = ["source", "reported_by",]
+""" Activity properties whose (string) value goes into the string table """
+
+INTERNED_GROUPS = ["orgs", "sectors", "locations",]
+""" Activity properties holding a dict of lists of strings that go into the string table """
+
+
+#
+# Writing
+#
+
+def write_activities (activities, output, format="json"):
+    """ Write activities to a stream in the format requested
+    Returns the number of activities written.
+
+    """
+    if format == "json":
+        return dump_json_list(activities, output)
+    elif format == "jsonl":
+        return write_jsonl(activities, output)
+    elif format == "compact":
+        return write_compact(activities, output)
+    else:
+        raise ValueError("Unknown activity format: {}".format(format))
+
+def write_jsonl (activities, output):
+    """ Write activities as JSON Lines, one at a time """
+    count = 0
+    for activity in activities:
+        output.write(encode_json(activity, "compact"))
+        output.write("\n")
+        count += 1
+    return count
+
+def write_compact (activities, output):
+    """ Write activities in the compact format
+    Needs to see all of the activities before it can write the string
+    table, so it keeps the encoded rows (but not the activities) in memory.
+
+    """
+    strings = {}
+    shapes = {}
+    rows = []
+
+    def intern (s):
+        if s is None:
+            return None
+        if not s in strings:
+            strings[s] = len(strings)
+        return strings[s]
+
+    for activity in activities:
+        shape = []
+        row = [None]
+        for key, value in activity.items():
+            if key in INTERNED_VALUES and (value is None or isinstance(value, str)):
+                shape.append((key, "s",))
+                row.append(intern(value))
+            elif key in INTERNED_GROUPS and is_string_lists(value):
+                shape.append((key, "g", tuple(value.keys()),))
+                row.append([[intern(s) for s in l] for l in value.values()])
+            else:
+                shape.append((key,))
+                row.append(value)
+        shape = tuple(shape)
+        if not shape in shapes:
+            shapes[shape] = len(shapes)
+        row[0] = shapes[shape]
+        rows.append(encode_json(row, "compact"))
+
+    output.write(encode_json({
+        "format": COMPACT_FORMAT,
+        "version": COMPACT_VERSION,
+        "strings": list(strings.keys()),
+        "shapes": list(shapes.keys()),
+    }, "compact"))
+    output.write("\n")
+    for row in rows:
+        output.write(row)
+        output.write("\n")
+
+    return len(rows)
+
+def is_string_lists (value):
+    """ True if a value is a dict whose values are all lists of strings """
+    return isinstance(value, dict) and all(
+        isinstance(l, list) and all(isinstance(s, str) for s in l) for l in value.values()
+    )
+
+
+#
+# Reading
+#
+
+def sniff_format (filename):
+    """ Return the format of an activity file ("json", "jsonl", or "compact") """
+    with open(filename, "r", encoding="utf-8") as input:
+        while True:
+            c = input.read(1)
+            if not c.isspace():
+                break
+        if c == "[" or c == "":
+            return "json"
+        elif c == "{":
+            header = json.loads(c + input.readline())
+            if header.get("format") == COMPACT_FORMAT:
+                return "compact"
+            else:
+                return "jsonl"
+    raise ValueError("Unrecognised activity file format: {}".format(filename))
+
+def read_activities (filename):
+    """ Generate the activities from an activity file in any supported format """
+    format = sniff_format(filename)
+    if format == "json":
+        with open(filename, "r", encoding="utf-8") as input:
+            yield from iterate_json_array(input)
+    elif format == "jsonl":
+        yield from read_jsonl(filename)
+    else:
+        yield from read_compact(filename)
+
+WHITESPACE = re.compile(r'\s*')
+
+def iterate_json_array (input, chunk_size=65536):
+    """ Generate the items of a top-level JSON array from a stream, one at a time
+    Keeps only the current item (plus a read buffer) in memory.
+
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+    state = "start" # start, first, next, or item
+
+    while True:
+        pos = WHITESPACE.match(buffer, pos).end()
+
+        if pos == len(buffer):
+            if eof:
+                raise ValueError("Unexpected end of JSON array")
+            buffer, pos, eof = read_more(input, buffer, pos, chunk_size)
+            continue
+
+        c = buffer[pos]
+
+        if state == "start":
+            if c != "[":
+                raise ValueError("Expected a JSON array")
+            pos += 1
+            state = "first"
+        elif state == "next" or (state == "first" and c == "]"):
+            if c == "]":
+                return
+            elif c != ",":
+                raise ValueError("Expected , or ] in JSON array")
+            pos += 1
+            state = "item"
+        else:
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+                # a number cut off at the end of the buffer still parses, so make sure we can see what follows
+                after = WHITESPACE.match(buffer, end).end()
+                complete = eof or (after < len(buffer) and buffer[after] in ",]")
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                complete = False
+            if not complete:
+                # the item may be incomplete, so read more and try again
+                buffer, pos, eof = read_more(input, buffer, pos, chunk_size)
+                continue
+            yield item
+            pos = end
+            state = "next"
+
+def read_more (input, buffer, pos, chunk_size):
+    """ Drop the consumed part of a read buffer and add more from the stream
+    Reads at least as much as is already buffered, so that re-parsing a
+    large item stays linear. Returns (buffer, pos, eof).
+
+    """
+    buffer = buffer[pos:]
+    chunk = input.read(max(chunk_size, len(buffer)))
+    return buffer + chunk, 0, chunk == ""
+
+def read_jsonl (filename):
+    """ Generate the activities from a JSON Lines file """
+    with open(filename, "r", encoding="utf-8") as input:
+        for line in input:
+            if not line.isspace():
+                yield json.loads(line)
+
+def read_compact (filename):
+    """ Generate the activities from a compact-format file """
+    with open(filename, "r", encoding="utf-8") as input:
+        header = json.loads(input.readline())
+        if header.get("version") != COMPACT_VERSION:
+            raise ValueError("Unsupported compact format version {} in {}".format(header.get("version"), filename))
+        strings = header["strings"]
+        shapes = header["shapes"]
+        for line in input:
+            row = json.loads(line)
+            activity = {}
+            for spec, value in zip(shapes[row[0]], row[1:]):
+                if len(spec) == 1:
+                    activity[spec[0]] = value
+                elif spec[1] == "s":
+                    activity[spec[0]] = None if value is None else strings[value]
+                else:
+                    activity[spec[0]] = {key: [strings[i] for i in l] for key, l in zip(spec[2], value)}
+            yield activity
+
+# end
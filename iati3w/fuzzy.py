@@ -0,0 +1,195 @@
+""" Approximate matching for org and location names, using a trigram index
+
+An exact lookup only finds a name if its token (see
+iati3w.common.make_token()) is in the map, so every misspelling in a 3W
+or IATI feed ("Norwegian Refugee Counsil") turns into an unrecognised
+stub. This module finds the closest tokens in a map instead, scored by
+the Dice coefficient of their character trigrams: 2 * shared /
+(trigrams in one + trigrams in the other), from 0 (nothing in common)
+to 1 (the same trigrams).
+
+The index maps each trigram to the tokens that contain it (build_index()),
+and is compiled and cached with the lookup tables (see
+iati3w.compiled_maps). search() only looks at tokens whose length could
+reach the threshold, and only at the posting lists for the rarest of
+the query's trigrams (any token that scores high enough must share at
+least one of them), so a lookup touches a few dozen candidates instead
+of the whole map.
+
+The lookups only use it if IATI3W_FUZZY_THRESHOLD is set (see
+iati3w.common.find_org() and find_location()). To see what it would
+match, and which names to add to the maps as synonyms, run a
+suggestion report over the extracted activities:
+
+    python3 -m iati3w.fuzzy suggest [--threshold 0.7] [--limit 3] output/iati-data.json output/3w-data.json > suggestions.csv
+
+"""
+
+import argparse, collections, csv, math, re, sys
+
+MIN_LENGTH = 5
+""" Don't try to match tokens shorter than this (acronyms are too close to each other) """
+
+SUGGEST_THRESHOLD = 0.7
+""" Default minimum score for the suggestion report """
+
+
+#
+# Trigram index
+#
+
+def trigrams (token):
+    """ Return the set of character trigrams in a token, padded so that the start and end of each word count """
+    padded = "  " + token.replace("-", "  ") + " "
+    return set(padded[i:i+3] for i in range(len(padded) - 2))
+
+def build_index (tokens):
+    """ Build a trigram index over an iterable of tokens (duplicates are ignored)
+    Returns {"tokens": [token...], "sizes": [trigram count...], "grams":
+    [trigram set...], "postings": {trigram: [token id...]}}. Each trigram
+    string is shared between the sets and the postings, so the index
+    pickles compactly.
+
+    """
+    result = {
+        "tokens": [],
+        "sizes": [],
+        "grams": [],
+        "postings": {},
+    }
+    shared = {}
+    for token in sorted(set(tokens)):
+        if len(token) < MIN_LENGTH:
+            continue
+        id = len(result["tokens"])
+        grams = frozenset(shared.setdefault(gram, gram) for gram in trigrams(token))
+        result["tokens"].append(token)
+        result["sizes"].append(len(grams))
+        result["grams"].append(grams)
+        for gram in grams:
+            result["postings"].setdefault(gram, []).append(id)
+    return result
+
+def search (index, token, threshold, limit=None):
+    """ Return [(score, token)] for the tokens in an index that score at least threshold (> 0), best first
+    Ties are broken alphabetically, so the result is deterministic.
+
+    """
+    if len(token) < MIN_LENGTH:
+        return []
+
+    query = trigrams(token)
+    size = len(query)
+    postings = index["postings"]
+    sizes = index["sizes"]
+    tokens = index["tokens"]
+    token_grams = index["grams"]
+
+    # a match with b trigrams needs b in [min_size, max_size] and at
+    # least min_shared trigrams in common, so at least one of any
+    # (size - min_shared + 1) of the query's trigrams
+    min_size = threshold * size / (2 - threshold)
+    max_size = (2 - threshold) * size / threshold
+    min_shared = max(1, math.ceil(threshold * size / (2 - threshold) - 1e-9))
+    grams = sorted(query, key=lambda gram: len(postings.get(gram, ())))
+
+    candidates = set()
+    for gram in grams[:size - min_shared + 1]:
+        for id in postings.get(gram, ()):
+            if min_size <= sizes[id] <= max_size:
+                candidates.add(id)
+
+    result = []
+    for id in candidates:
+        score = 2 * len(query & token_grams[id]) / (size + sizes[id])
+        if score >= threshold:
+            result.append((score, tokens[id],))
+    result.sort(key=lambda match: (-match[0], match[1],))
+    return result[:limit] if limit is not None else result
+
+
+#
+# Suggestion report
+#
+
+def find_unrecognised (filenames):
+    """ Count the org and location names in activity files that aren't in the maps
+    Returns a Counter keyed by ("org" or "location", name).
+
+    """
+    from .common import get_location_lookup_table, get_lookup_table, is_empty, make_token, ORG_BLOCKLIST
+    from .formats import read_activities
+
+    org_table = get_lookup_table("inputs/org-map.json")
+    location_table = get_location_lookup_table()
+
+    def is_org_known (name):
+        return make_token(name) in org_table or any(re.match(pattern, name, flags=re.I) for pattern in ORG_BLOCKLIST)
+
+    def is_location_known (name):
+        return make_token(name) in location_table
+
+    counts = collections.Counter()
+    for filename in filenames:
+        for activity in read_activities(filename):
+            names = [activity["reported_by"]] + [name for names in activity["orgs"].values() for name in names]
+            for name in names:
+                if name and not is_empty(name) and not is_org_known(name):
+                    counts[("org", name,)] += 1
+            for type, names in activity["locations"].items():
+                if type == "countries":
+                    continue
+                for name in names:
+                    if name and not is_empty(name) and not is_location_known(name):
+                        counts[("location", name,)] += 1
+    return counts
+
+def suggest (filenames, threshold=SUGGEST_THRESHOLD, limit=3):
+    """ Generate (kind, name, occurrences, suggested map entry, its stub, score) for each close match to an unrecognised name
+    Most frequent names first.
+
+    """
+    from .common import get_fuzzy_index, get_location_lookup_table, get_lookup_table, make_token
+
+    tables = {
+        "org": ("inputs/org-map.json", get_lookup_table("inputs/org-map.json"),),
+        "location": ("inputs/location-map.json", get_location_lookup_table(),),
+    }
+
+    counts = find_unrecognised(filenames)
+    for (kind, name), count in sorted(counts.items(), key=lambda item: (-item[1], item[0],)):
+        path, table = tables[kind]
+        seen = set()
+        for score, token in search(get_fuzzy_index(path), make_token(name), threshold):
+            info = table[token]
+            stub = info.get("stub", make_token(info.get("shortname", info["name"])))
+            # several tokens (synonyms) can lead to the same entry
+            if stub in seen:
+                continue
+            seen.add(stub)
+            yield (kind, name, count, info["name"], stub, round(score, 3),)
+            if len(seen) == limit:
+                break
+
+
+#
+# Script entry point
+#
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Suggest map entries for the unrecognised org and location names in activity files")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    suggest_parser = subparsers.add_parser("suggest", help="write a CSV report of the closest map entries for each unrecognised name")
+    suggest_parser.add_argument("-t", "--threshold", type=float, default=SUGGEST_THRESHOLD, help="minimum score, from 0 to 1 (default: {})".format(SUGGEST_THRESHOLD))
+    suggest_parser.add_argument("-l", "--limit", type=int, default=3, help="maximum suggestions for each name (default: 3)")
+    suggest_parser.add_argument("files", nargs="+", help="activity files (from iati3w.activities_iati or iati3w.activities_3w)")
+    args = parser.parse_args()
+
+    if not 0 < args.threshold <= 1:
+        parser.error("--threshold must be more than 0 and at most 1")
+
+    output = csv.writer(sys.stdout)
+    output.writerow(["Type", "Name", "Occurrences", "Suggested entry", "Stub", "Score"])
+    output.writerows(suggest(args.files, args.threshold, args.limit))
+
+# end
@@ -0,0 +1,180 @@
+""" Classify IATI activities as humanitarian, and record why
+
+An activity counts as humanitarian if any of these rules matches. They
+are checked in this order, cheapest first, and classify() returns the
+name of the first one that matches (or None):
+
+activity-flag: the activity has @humanitarian="1" (or "true", etc.)
+
+humanitarian-scope: the activity has a humanitarian-scope
+
+activity-cluster: an activity sector is a humanitarian cluster (vocabulary 10)
+
+activity-dac: an activity sector is a DAC humanitarian sector (vocabulary 1 or 2, code 7xx)
+
+transaction-flag: a transaction has @humanitarian="1"
+
+transaction-cluster, transaction-dac: as above, for a transaction's own sectors
+
+The transactions are read one at a time from the XML DOM, and only if
+none of the activity-level rules matched. A transaction without its own
+sectors inherits the activity's sectors, which have already been
+checked, so it's skipped. Large donors often report thousands of
+transactions per activity, so this is most of the saving.
+
+Verdicts can also be cached between runs, keyed by the activity
+identifier and @last-updated-datetime (see load_verdicts() and
+save_verdicts()), so an unchanged activity isn't classified again even
+if it moves to a different d-portal page.
+
+"""
+
+import json
+
+from . import instrument
+from .common import encode_json
+from .compiled_maps import hash_files, write_atomically
+
+RULES = [
+    "activity-flag",
+    "humanitarian-scope",
+    "activity-cluster",
+    "activity-dac",
+    "transaction-flag",
+    "transaction-cluster",
+    "transaction-dac",
+]
+""" Names of the rules, in the order they're checked """
+
+TRUTHY = ("1", "true", "yes", "t", "y",)
+""" Values that diterator treats as true for @humanitarian """
+
+
+#
+# Classification
+#
+
+def is_flagged (node):
+    """ True if an element has a true @humanitarian attribute """
+    return node.getAttribute("humanitarian").strip().lower() in TRUTHY
+
+def child_elements (node, name):
+    """ Generate the child elements of a DOM node with the name provided, one at a time """
+    for child in node.childNodes:
+        if child.nodeType == child.ELEMENT_NODE and child.tagName == name:
+            yield child
+
+def sector_rule (node, prefix):
+    """ Return the rule name if a sector element is humanitarian, otherwise None """
+    vocabulary = node.getAttribute("vocabulary")
+    if vocabulary == "10":
+        return prefix + "-cluster"
+    elif vocabulary in ("1", "2",) and node.getAttribute("code").startswith("7"):
+        return prefix + "-dac"
+    else:
+        return None
+
+@instrument.timed("humanitarian.classify")
+def classify (activity):
+    """ Return the name of the first rule that makes a diterator Activity humanitarian, or None if it isn't
+    Gives the same verdict as checking activity.humanitarian,
+    activity.humanitarian_scopes, activity.sectors, and then each of
+    activity.transactions and its sectors, without building any of those
+    objects.
+
+    """
+    node = activity.node
+
+    if is_flagged(node):
+        return "activity-flag"
+
+    for scope in child_elements(node, "humanitarian-scope"):
+        return "humanitarian-scope"
+
+    # collect the results first, so that a cluster always wins over a DAC sector
+    rules = set(sector_rule(sector, "activity") for sector in child_elements(node, "sector"))
+    for rule in ("activity-cluster", "activity-dac",):
+        if rule in rules:
+            return rule
+
+    for transaction in child_elements(node, "transaction"):
+        instrument.count("humanitarian.transactions_read")
+        if is_flagged(transaction):
+            return "transaction-flag"
+        for sector in child_elements(transaction, "sector"):
+            rule = sector_rule(sector, "transaction")
+            if rule is not None:
+                return rule
+
+    return None
+
+
+#
+# Cached verdicts
+#
+
+verdicts = {}
+""" Cached verdicts: [last-updated-datetime, rule] keyed by activity identifier """
+
+new_verdicts = {}
+""" Verdicts added since the last call to take_new_verdicts() """
+
+rules_hash = None
+""" Hash of this module, so that changing the rules invalidates the saved verdicts """
+
+def get_rules_hash ():
+    """ Return the hash of this module (computed once) """
+    global rules_hash
+    if rules_hash is None:
+        rules_hash = hash_files([__file__])
+    return rules_hash
+
+def classify_cached (activity):
+    """ Return the same as classify(), reusing the cached verdict if the activity hasn't been updated
+    Activities without an identifier or @last-updated-datetime are
+    always classified.
+
+    """
+    identifier = activity.identifier
+    last_updated = activity.node.getAttribute("last-updated-datetime")
+    if not identifier or not last_updated:
+        return classify(activity)
+
+    entry = verdicts.get(identifier)
+    if entry is not None and entry[0] == last_updated:
+        instrument.count("humanitarian.cached_verdicts")
+        return entry[1]
+
+    rule = classify(activity)
+    verdicts[identifier] = new_verdicts[identifier] = [last_updated, rule]
+    return rule
+
+def take_new_verdicts ():
+    """ Return the verdicts added since the last call (e.g. to send from a worker process back to the main one) """
+    global new_verdicts
+    result = new_verdicts
+    new_verdicts = {}
+    return result
+
+def add_verdicts (entries):
+    """ Add verdicts from take_new_verdicts() in another process """
+    verdicts.update(entries)
+
+def load_verdicts (filename):
+    """ Load saved verdicts, unless the file is missing or the rules have changed since it was saved """
+    try:
+        with open(filename, "r", encoding="utf-8") as input:
+            saved = json.load(input)
+        if saved["rules"] == get_rules_hash():
+            verdicts.update(saved["verdicts"])
+    except (OSError, ValueError, KeyError):
+        pass
+
+def save_verdicts (filename):
+    """ Save all of the verdicts """
+    write_atomically(filename, encode_json({
+        "rules": get_rules_hash(),
+        "verdicts": verdicts,
+    }, "compact").encode("utf-8"))
+
+# end
@@ -0,0 +1,1446 @@
+""" Build the org, sector, and location indexes (and the merged activities) in a single pass
+
+Reads each activity file once, looks up the orgs, sectors, and
+locations for each activity once, and fills all of the requested
+indexes at the same time.
+
+Usage:
+
+    python3 -m iati3w.indexer [--cube FILE] [--state FILE [--delta]] [--verify] [--json-mode pretty|compact] [--identifier-set exact|fingerprint|disk] output/ output/iati-data.json output/3w-data.json
+
+Writes org-index.json, sector-index.json, location-index.json, and
+activities.json to the output directory (the first argument). The
+activity files may be in any format that iati3w.formats can read.
+With --json-mode=compact (or IATI3W_JSON_MODE=compact), write the
+outputs without indentation: smaller, and much faster to write.
+
+The counts in the three indexes are all rolled up from one sparse count
+cube (see iati3w.cube and roll_up()); with --cube, the cube is saved so
+that it can be queried later with python3 -m iati3w.cube.
+
+With --delta, update the previous outputs from the changes since the
+last run instead of rebuilding from scratch (see apply_delta()). If no
+activity record has changed, nothing is written at all; otherwise only
+the entries that the added, removed, or changed records mention are
+built and rendered again, and the rest are copied from the previous
+files, so the cost depends on the size of the change (apart from
+reading and hashing the activity files). The outputs are the same as a
+full rebuild's, byte for byte. Falls back to a full rebuild if the
+state file is missing or doesn't match the outputs and the saved cube
+(so --delta requires --cube as well), or if the unchanged activities
+are in a different order. With --verify, also do a full rebuild and
+fail if any output differs from it at all (including the order of keys
+and lists), leaving the previous outputs as they were.
+
+Activities are read one at a time, and each merged activity is written
+to activities.json as soon as it's seen, so memory use depends on the
+size of the indexes rather than the size of the corpus. The
+identifiers already written are the one thing that grows with the
+corpus; with --identifier-set=fingerprint or disk, they take less
+memory or none. --state adds a hash of each activity record, with just
+the names that the indexes use from it (see RecordLog), rather than the
+records themselves, and where each entry and merged activity is in the
+output files.
+
+The iati3w.org_index, iati3w.sector_index, iati3w.location_index, and
+iati3w.merge scripts are thin wrappers around this module.
+
+Started 2021-03 by David Megginson
+
+"""
+
+import argparse, collections, copy, filecmp, hashlib, json, os, sqlite3, sys, tempfile
+from .common import * # common variables and functions
+from . import compiled_maps, instrument
+from .cube import add_counts, load_cube, make_cube, save_cube
+from .formats import read_activities
+
+INDEXES = ["orgs", "sectors", "locations", "activities",]
+""" The indexes that the engine knows how to build """
+
+OUTPUT_FILES = {
+    "orgs": "org-index.json",
+    "sectors": "sector-index.json",
+    "locations": "location-index.json",
+    "activities": "activities.json",
+}
+""" Default output filename for each index """
+
+ORG_TEMPLATE = {
+    "info": None,
+    "sources": [],
+    "humanitarian": False,
+    "activities": {
+        "implementing": [],
+        "programming": [],
+        "funding": [],
+    },
+    "partners": {
+        "all": {
+            "local": {},
+            "regional": {},
+            "international": {},
+            "unknown": {}
+        },
+        "3w": {
+            "local": {},
+            "regional": {},
+            "international": {},
+            "unknown": {}
+        },
+        "iati": {
+            "local": {},
+            "regional": {},
+            "international": {},
+            "unknown": {}
+        },
+    },
+    "sectors": {
+        "all": {
+            "humanitarian": {},
+            "dac": {},
+        },
+        "3w": {
+            "humanitarian": {},
+            "dac": {},
+        },
+        "iati": {
+            "humanitarian": {},
+            "dac": {},
+        },
+    },
+    "locations": {
+        "all": {
+            "admin1": {},
+            "admin2": {},
+            "unclassified": {},
+        },
+        "3w": {
+            "admin1": {},
+            "admin2": {},
+            "unclassified": {},
+        },
+        "iati": {
+            "admin1": {},
+            "admin2": {},
+            "unclassified": {},
+        },
+    },
+    "activity_totals": {
+        "all": 0,
+        "3w": 0,
+        "iati": 0,
+    },
+}
+""" Template for each entry in the org index """
+
+SECTOR_TEMPLATE = {
+    "name": None,
+    "type": None,
+    "stub": None,
+    "activities": [],
+    "orgs": {
+        "all": {
+            "local": {},
+            "regional": {},
+            "international": {},
+            "unknown": {},
+        },
+        "3w": {
+            "local": {},
+            "regional": {},
+            "international": {},
+            "unknown": {},
+        },
+        "iati": {
+            "local": {},
+            "regional": {},
+            "international": {},
+            "unknown": {},
+        },
+    },
+    "locations": {
+        "all": {
+            "admin1": {},
+            "admin2": {},
+            "unclassified": {},
+        },
+        "3w": {
+            "admin1": {},
+            "admin2": {},
+            "unclassified": {},
+        },
+        "iati": {
+            "admin1": {},
+            "admin2": {},
+            "unclassified": {},
+        },
+    },
+}
+""" Template for each entry in the sector index """
+
+LOCATION_TEMPLATE = {
+    "info": None,
+    "activities": [],
+    "orgs": {
+        "all": {
+            "local": {},
+            "regional": {},
+            "international": {},
+            "unknown": {},
+        },
+        "3w": {
+            "local": {},
+            "regional": {},
+            "international": {},
+            "unknown": {},
+        },
+        "iati": {
+            "local": {},
+            "regional": {},
+            "international": {},
+            "unknown": {},
+        },
+    },
+    "sectors": {
+        "all": {
+            "humanitarian": {},
+            "dac": {},
+        },
+        "3w": {
+            "humanitarian": {},
+            "dac": {},
+        },
+        "iati": {
+            "humanitarian": {},
+            "dac": {},
+        },
+    },
+}
+""" Template for each entry in the location index """
+
+COUNT_GROUPS = {
+    "orgs": ["partners", "sectors", "locations",],
+    "sectors": ["orgs", "locations",],
+    "locations": ["orgs", "sectors",],
+}
+""" The parts of each type of index entry that hold nested counts (see "Interned counts" below) """
+
+TEMPLATES = {
+    "orgs": ORG_TEMPLATE,
+    "sectors": SECTOR_TEMPLATE,
+    "locations": LOCATION_TEMPLATE,
+}
+""" The template for the entries in each type of index """
+
+
+#
+# Utility functions
+#
+
+def increment (counts, key, weight=1):
+    """ Add weight (which may be negative) to the count for key in a dict of counts
+    Drops the key if its count falls to 0.
+
+    """
+    count = counts.get(key, 0) + weight
+    if count:
+        counts[key] = count
+    else:
+        counts.pop(key, None)
+
+#
+# Interned counts
+#
+# While indexing, an entry holds everything except its nested counts
+# (the entity tables in the cube). roll_up() then adds all of the nested
+# counts (facet, then scope or type, then stub, then count) in one flat
+# Counter, keyed by (group, facet, type, id) where id is a dense integer
+# standing for the stub or name. That avoids deep-copying a tree of
+# empty dicts for every new entry (it saves time rather than memory: the
+# flat keys take about as much room as the nested dicts would). The
+# activity lists in the org and sector entries are kept as dicts (with
+# the identifiers as keys) so that adding one doesn't scan the list.
+# render_entry() turns an entry back into the nested JSON (with keys in
+# the same order as before), and write_index() does that one entry at a
+# time as it writes, so that there's never a second, nested copy of a
+# whole index in memory.
+#
+
+string_ids = {}
+""" Integer ID for each stub or name used as a count key """
+
+strings = []
+""" Stub or name for each integer ID """
+
+def intern_string (s):
+    """ Return the integer ID for a stub or name, assigning a new one if necessary """
+    id = string_ids.get(s)
+    if id is None:
+        id = string_ids[s] = len(strings)
+        strings.append(s)
+    return id
+
+def make_entry (name):
+    """ Return a new, empty entry for an index, without the nested counts (see roll_up()) """
+    groups = COUNT_GROUPS[name]
+    entry = {key: copy.deepcopy(value) for key, value in TEMPLATES[name].items() if not key in groups}
+    if name == "orgs":
+        entry["activities"] = {role: {} for role in entry["activities"]}
+    elif name == "sectors":
+        entry["activities"] = {}
+    return entry
+
+def render_entry (name, entry):
+    """ Return an index entry in its published (nested) form """
+    groups = COUNT_GROUPS[name]
+    result = {}
+    for key, value in TEMPLATES[name].items():
+        result[key] = copy.deepcopy(value) if key in groups else entry[key]
+    if name == "orgs":
+        result["activities"] = {role: list(identifiers) for role, identifiers in entry["activities"].items()}
+    elif name == "sectors":
+        result["activities"] = list(entry["activities"])
+    for (group, facet, type, id), count in entry["counts"].items():
+        result[group][facet][type][strings[id]] = count
+    return result
+
+def render_index (name, index):
+    """ Return an index in its published form (the merged activities are unchanged) """
+    if name == "orgs":
+        return {stub: render_entry(name, entry) for stub, entry in index.items()}
+    elif name in COUNT_GROUPS:
+        return {type: {stub: render_entry(name, entry) for stub, entry in entries.items()} for type, entries in index.items()}
+    else:
+        return index
+
+class PositionedOutput:
+    """ Wraps a text stream, counting the bytes of UTF-8 written so far (see write_index()) """
+
+    def __init__ (self, output):
+        self.output = output
+        self.position = 0
+
+    def write (self, text):
+        self.output.write(text)
+        self.position += len(text) if text.isascii() else len(text.encode("utf-8"))
+
+def write_value (writer, output, key, value, previous=None):
+    """ Write one property with a JSONObjectWriter on a PositionedOutput, and return the (start, end) bytes of its value
+    value is a dict to encode, or the (start, end) bytes of the same
+    value in previous (a file open in binary mode) to copy as it is.
+
+    """
+    writer.write_key(key)
+    start = output.position
+    if isinstance(value, dict):
+        output.write(writer.encode(value))
+    else:
+        previous.seek(value[0])
+        output.write(previous.read(value[1] - value[0]).decode("utf-8"))
+    return (start, output.position,)
+
+def write_index (name, index, output, previous=None):
+    """ Write an index to a stream in its published form, like dump_json(render_index(name, index), output)
+    Renders and writes one entry at a time, so the published form of the
+    whole index is never in memory at once. An entry (or merged
+    activity) can also be the (start, end) bytes of its text in
+    previous, an earlier output file for the same index open in binary
+    mode, to copy instead of rendering it again (see apply_delta()).
+    Returns the (start, end) bytes of each entry's text in the output,
+    keyed as in mentions() (or in a list, for the merged activities).
+
+    """
+    output = PositionedOutput(output)
+    writer = JSONObjectWriter(output)
+    if name == "orgs":
+        spans = {}
+        for stub, entry in index.items():
+            spans[stub] = write_value(writer, output, stub, render_entry(name, entry) if isinstance(entry, dict) else entry, previous)
+    elif name in COUNT_GROUPS:
+        spans = {}
+        for type, entries in index.items():
+            type_writer = writer.write_object(type)
+            for stub, entry in entries.items():
+                spans[(type, stub,)] = write_value(type_writer, output, stub, render_entry(name, entry) if isinstance(entry, dict) else entry, previous)
+            type_writer.close()
+    else:
+        spans = [write_value(writer, output, identifier, activity, previous) for identifier, activity in index.items()]
+    writer.close()
+    return spans
+
+
+@instrument.timed("resolve_activity")
+def resolve_activity (activity):
+    """ Look up all of the orgs, sectors, and locations in an activity once.
+    The lists in the result run parallel to the lists in the activity,
+    so each index can apply its own rules for empty or skipped entries.
+
+    """
+    org_names = [activity["reported_by"]] + [name for names in activity["orgs"].values() for name in names]
+    orgs = iter(lookup_orgs_batch((None, name,) for name in org_names))
+    resolved = {
+        "reporting_org": next(orgs),
+        "orgs": {
+            role: [next(orgs) for name in names] for role, names in activity["orgs"].items()
+        },
+        "sectors": {
+            type: [make_token(name) for name in names] for type, names in activity["sectors"].items()
+        },
+        "locations": {
+            type: lookup_locations_batch(names) for type, names in activity["locations"].items()
+        },
+    }
+    return resolved
+
+
+#
+# Org index
+#
+
+def get_org_entry (index, org):
+    """ Return the index entry for an org, creating the entry if necessary """
+    if org is None:
+        return None
+
+    stub = org["stub"]
+    if not stub in index:
+        index[stub] = make_entry("orgs")
+        index[stub]["info"] = org
+
+    return index[stub]
+
+def index_orgs (index, activity, resolved):
+    """ Add an activity to the org index
+    The partner, sector, and location counts come from the cube (see
+    roll_up()).
+
+    """
+
+    source = activity["source"]
+
+    # Make sure we have an entry for the reporting org
+    reporting_org = resolved["reporting_org"]
+    get_org_entry(index, reporting_org)
+
+    #
+    # Loop through the activity roles
+    #
+    for role in ROLES:
+
+        #
+        # Loop through each org and index it
+        #
+        for org in resolved["orgs"].get(role, []):
+
+            # The org we're working on
+            if org is None or org.get("skip", False):
+                continue
+
+            # This is the org index entry we'll be working on
+            entry = get_org_entry(index, org)
+
+            # True if we see the org involved in any humanitarian activity
+            if activity["humanitarian"]:
+                entry["humanitarian"] = True
+
+            # Count activities
+            entry["activity_totals"]["all"] += 1
+            entry["activity_totals"][source.lower()] += 1
+
+            # Note how we know about the org
+            add_unique(source, entry["sources"])
+
+            # Add this activity to the org's index
+            entry["activities"][role][activity["identifier"]] = None
+
+
+#
+# Sector index
+#
+
+def index_sectors (index, activity, resolved):
+    """ Add an activity to the sector index
+    The org and location counts come from the cube (see roll_up()).
+
+    """
+
+    #
+    # Loop through the sector types
+    #
+    for type in SECTOR_TYPES:
+        for sector, stub in zip(activity["sectors"][type], resolved["sectors"][type]):
+
+            # Set up this sector's entry (if it doesn't already exist)
+            index.setdefault(type, {})
+            if not stub in index[type]:
+                index[type][stub] = make_entry("sectors")
+                index[type][stub]["name"] = normalise_string(sector)
+                index[type][stub]["type"] = type
+                index[type][stub]["stub"] = stub
+            entry = index[type][stub]
+
+            # Add a brief summary of the activity
+            entry["activities"][activity["identifier"]] = None
+
+
+#
+# Location index
+#
+
+def index_locations (index, activity, resolved):
+    """ Add an activity to the location index
+    The org and sector counts come from the cube (see roll_up()).
+
+    """
+
+    #
+    # Loop through the subnational location types
+    #
+    for loctype in LOCATION_TYPES:
+
+        # Add the type if it's not in the index yet
+        index.setdefault(loctype, {})
+
+        #
+        # Loop through each location of each type
+        #
+        for location in resolved["locations"].get(loctype, []):
+
+            if not location or location.get("skip", False):
+                continue
+
+            # Add a default record if this is the first time we've seen the location
+            if not location["stub"] in index[loctype]:
+                index[loctype][location["stub"]] = make_entry("locations")
+                index[loctype][location["stub"]]["info"] = location
+
+            # This is the location index entry we'll be working on
+            entry = index[loctype][location["stub"]]
+
+            # Add this activity
+            entry["activities"].append(activity["identifier"])
+
+
+#
+# Roll-ups
+#
+# Each group of counts in an index entry is a two-dimensional cuboid of
+# the cube summed over the sources (for the "all" facet), with the
+# entity on one side: e.g. the sector counts in each org entry come from
+# the org_sector cuboid. The cells are in the order they were first
+# added, so the counts come out in the same order as if they'd been
+# counted straight into each entry. The org and sector entries count
+# each location name separately, but the location entries combine all
+# of the names that resolve to the same location.
+#
+
+def add_count (counts, group, type, id, source, count):
+    """ Add a cell's count to the "all" facet and the source's own facet """
+    counts[(group, "all", type, id,)] += count
+    counts[(group, source, type, id,)] += count
+
+def roll_up (name, cube):
+    """ Return an index with the counts rolled up from the cube into each entity
+    Returns the entries in the internal form (see render_index()).
+
+    """
+    coordinates = cube["coordinates"]
+    cuboids = cube["cuboids"]
+    sources = [source.lower() for source in coordinates["sources"]]
+
+    # interned ids for each coordinate (None if the indexes don't count it)
+    orgs = [(stub, scope, skip, intern_string(stub),) for stub, scope, skip in coordinates["orgs"]]
+    sectors = [(type, stub, intern_string(stub) if named else None,) for type, stub, named in coordinates["sectors"]]
+    locations = [(type, location_name, intern_string(location_name),) for type, location_name in coordinates["locations"]]
+
+    if name == "orgs":
+        index = {stub: dict(entity, counts=collections.Counter()) for stub, entity in cube["entities"][name].items()}
+
+        for (o, r, source), count in cuboids["partners"].items():
+            org, reporter = orgs[o], orgs[r]
+            if org[0] in index:
+                add_count(index[org[0]]["counts"], "partners", reporter[1], reporter[3], sources[source], count)
+            if reporter[0] in index:
+                add_count(index[reporter[0]]["counts"], "partners", org[1], org[3], sources[source], count)
+
+        for (o, s, source), count in cuboids["org_sector"].items():
+            stub, scope, skip, id = orgs[o]
+            type, sector_stub, sector_id = sectors[s]
+            if not skip and sector_id is not None and stub in index:
+                add_count(index[stub]["counts"], "sectors", type, sector_id, sources[source], count)
+
+        for (o, l, source), count in cuboids["org_location"].items():
+            stub, scope, skip, id = orgs[o]
+            type, location_name, location_id = locations[l]
+            if not skip and stub in index:
+                add_count(index[stub]["counts"], "locations", type, location_id, sources[source], count)
+
+    elif name == "sectors":
+        index = {
+            type: {stub: dict(entity, counts=collections.Counter()) for stub, entity in entities.items()}
+            for type, entities in cube["entities"][name].items()
+        }
+
+        def get_counts (s):
+            type, stub, id = sectors[s]
+            entry = index.get(type, {}).get(stub)
+            return None if entry is None else entry["counts"]
+
+        for (o, s, source), count in cuboids["org_sector"].items():
+            counts = get_counts(s)
+            if counts is not None:
+                add_count(counts, "orgs", orgs[o][1], orgs[o][3], sources[source], count)
+
+        for (s, l, source), count in cuboids["sector_location"].items():
+            counts = get_counts(s)
+            if counts is not None:
+                add_count(counts, "locations", locations[l][0], locations[l][2], sources[source], count)
+
+    else:
+        index = {
+            type: {stub: dict(entity, counts=collections.Counter()) for stub, entity in entities.items()}
+            for type, entities in cube["entities"][name].items()
+        }
+        location_stubs = cube["location_stubs"]
+
+        def get_counts (l):
+            stub = location_stubs[l]
+            entry = None if stub is None else index.get(locations[l][0], {}).get(stub)
+            return None if entry is None else entry["counts"]
+
+        for (o, l, source), count in cuboids["org_location"].items():
+            counts = get_counts(l)
+            if counts is not None:
+                add_count(counts, "orgs", orgs[o][1], orgs[o][3], sources[source], count)
+
+        for (s, l, source), count in cuboids["sector_location"].items():
+            type, stub, id = sectors[s]
+            counts = get_counts(l)
+            if counts is not None and id is not None:
+                add_count(counts, "sectors", type, id, sources[source], count)
+
+    return index
+
+
+#
+# Merged activities
+#
+
+canonical_stubs = None
+""" The org and location stubs that look up to themselves (see get_canonical_stubs()) """
+
+def get_canonical_stubs ():
+    """ Return (org stubs, location stubs): the stubs in the maps that look up to themselves, worked out once
+    The converters write these stubs for every recognised org and
+    location, so clean_activity() can keep them as they are instead of
+    looking them up again.
+
+    """
+    global canonical_stubs
+    if canonical_stubs is None:
+        org_table = get_lookup_table("inputs/org-map.json")
+        org_stubs = set()
+        for stub in set(info.get("stub") for info in org_table.values()):
+            if stub is not None and make_token(stub) in org_table:
+                org = lookup_org(stub, create=True)
+                if org is not None and org["stub"] == stub:
+                    org_stubs.add(stub)
+
+        # only names in the table, so that nothing is registered as unrecognised
+        location_table = get_location_lookup_table()
+        location_stubs = set()
+        for stub in set(info["stub"] for info in location_table.values()):
+            if make_token(stub) in location_table:
+                location = lookup_location(stub)
+                if location is not None and location["stub"] == stub:
+                    location_stubs.add(stub)
+
+        canonical_stubs = (org_stubs, location_stubs,)
+    return canonical_stubs
+
+def clean_activity (activity, resolved=None):
+    """ Return a copy of an activity with its orgs, sectors, and locations replaced by stubs
+    resolved is from resolve_activity(). Without it, only the names that
+    aren't already canonical stubs (see get_canonical_stubs()) are looked
+    up, which is all that the merged activities on their own need.
+
+    """
+    activity = dict(activity)
+    if resolved is None:
+        org_stubs, location_stubs = get_canonical_stubs()
+        activity["orgs"] = {
+            role: [name if name in org_stubs else lookup_org(name, create=True)["stub"] for name in names] for role, names in activity["orgs"].items()
+        }
+        activity["sectors"] = {type: [make_token(name) for name in names] for type, names in activity["sectors"].items()}
+        activity["locations"] = {
+            level: [name if name in location_stubs else lookup_location(name)["stub"] for name in names] for level, names in activity["locations"].items()
+        }
+    else:
+        activity["orgs"] = {role: [org["stub"] for org in orgs] for role, orgs in resolved["orgs"].items()}
+        activity["sectors"] = dict(resolved["sectors"])
+        activity["locations"] = {level: [location["stub"] for location in locations] for level, locations in resolved["locations"].items()}
+    return activity
+
+def index_activities (index, activity, resolved):
+    """ Add an activity to the merged activities, keeping the first one seen for each identifier """
+    if not activity["identifier"] in index:
+        index[activity["identifier"]] = clean_activity(activity, resolved)
+
+
+#
+# Remembering which identifiers have been written
+#
+# StreamingActivities only needs to know whether it has seen an
+# identifier before. "exact" keeps the identifiers themselves in a set;
+# "fingerprint" keeps a 64-bit hash of each instead, which takes less
+# memory but could (very rarely) mistake a new identifier for one it's
+# seen; and "disk" keeps them in a temporary SQLite database, so memory
+# use stays flat however many activities there are.
+#
+
+IDENTIFIER_SETS = ["exact", "fingerprint", "disk",]
+""" The kinds of identifier set (see make_identifier_set()) """
+
+IDENTIFIER_SET = os.environ.get("IATI3W_IDENTIFIER_SET", "exact")
+""" The default kind of identifier set """
+
+class ExactIdentifierSet (set):
+    """ A set of the identifiers themselves """
+
+    def close (self):
+        self.clear()
+
+class FingerprintSet:
+    """ A set of identifiers that keeps only a 64-bit fingerprint of each
+    The fingerprint is Python's own (SipHash) hash of the string, which
+    is cached on the string and only needs to be stable within one run.
+    Two identifiers have the same fingerprint with a chance of about
+    n * n / 2**65 for n identifiers (one in 30 million for a million
+    activities), and the second would then be dropped as a duplicate.
+
+    """
+
+    def __init__ (self):
+        self.fingerprints = set()
+
+    def __contains__ (self, identifier):
+        return hash(identifier) in self.fingerprints
+
+    def add (self, identifier):
+        self.fingerprints.add(hash(identifier))
+
+    def close (self):
+        self.fingerprints = set()
+
+class DiskIdentifierSet:
+    """ A set of identifiers kept in a private, temporary SQLite database (deleted when it's closed) """
+
+    def __init__ (self):
+        self.db = sqlite3.connect("")
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE identifiers (identifier TEXT PRIMARY KEY) WITHOUT ROWID")
+
+    def __contains__ (self, identifier):
+        return self.db.execute("SELECT 1 FROM identifiers WHERE identifier = ?", (identifier,)).fetchone() is not None
+
+    def add (self, identifier):
+        self.db.execute("INSERT OR IGNORE INTO identifiers VALUES (?)", (identifier,))
+
+    def close (self):
+        self.db.close()
+
+def make_identifier_set (kind=None):
+    """ Make an empty identifier set of the kind given (default IDENTIFIER_SET) """
+    kind = kind or IDENTIFIER_SET
+    if kind == "exact":
+        return ExactIdentifierSet()
+    elif kind == "fingerprint":
+        return FingerprintSet()
+    elif kind == "disk":
+        return DiskIdentifierSet()
+    else:
+        raise ValueError("Unknown identifier set {} (expected one of {})".format(kind, ", ".join(IDENTIFIER_SETS)))
+
+class StreamingActivities:
+    """ Stands in for the merged activities index, writing each activity out as soon as it's added
+    Keeps only the identifiers (in an identifier set, see
+    make_identifier_set()), and the (start, end) bytes of each activity's
+    text in the output if spans is a list to add them to (see
+    write_index()). Call close() at the end.
+
+    """
+
+    def __init__ (self, output, identifier_set=None, spans=None):
+        self.output = PositionedOutput(output)
+        self.writer = JSONObjectWriter(self.output)
+        self.identifiers = make_identifier_set(identifier_set)
+        self.spans = spans
+
+    def __contains__ (self, identifier):
+        return identifier in self.identifiers
+
+    def __setitem__ (self, identifier, activity):
+        self.identifiers.add(identifier)
+        span = write_value(self.writer, self.output, identifier, activity)
+        if self.spans is not None:
+            self.spans.append(span)
+
+    def close (self):
+        self.writer.close()
+        self.identifiers.close()
+
+
+#
+# The engine
+#
+
+INDEXERS = {
+    "orgs": index_orgs,
+    "sectors": index_sectors,
+    "locations": index_locations,
+    "activities": index_activities,
+}
+""" Function to add an activity to each type of index """
+
+def build_indexes (filenames, indexes=INDEXES, activities_output=None, cube=None, identifier_set=None, records=None, first=None, spans=None):
+    """ Read each activity file once and build all of the requested indexes together
+    Returns a dict of indexes, keyed by the names in INDEXES, in the
+    internal form (see render_index()). If activities_output is a stream, write the merged activities to it as
+    they're found (as a JSON object) instead of returning them, using
+    the kind of identifier set given to skip duplicates (see
+    make_identifier_set()). If cube
+    is not None, it should be a new cube from iati3w.cube.make_cube(),
+    and it's filled in along the way (for saving). If only the merged
+    activities are wanted, the activities aren't resolved in full (see
+    clean_activity()). If records is not None, it should be a RecordLog,
+    and each activity record is added to it along the way (for the state
+    file). If first is not None, it should have an empty dict for each
+    counted index, and it's filled in with where each entry is first
+    mentioned (see note_first_mentions()); if spans is a list, it's
+    filled in with where each merged activity is in activities_output
+    (see write_index()).
+
+    """
+
+    counted = [name for name in indexes if name in COUNT_GROUPS]
+    if cube is None and counted:
+        # only for rolling up, so without the cuboids for slices
+        cube = make_cube(slices=False)
+
+    result = {name: {} for name in indexes}
+    for name in counted:
+        result[name] = cube["entities"][name]
+    if activities_output is not None and "activities" in indexes:
+        result["activities"] = StreamingActivities(activities_output, identifier_set, spans)
+
+    # the merged activities on their own don't need the resolved records
+    resolve = counted or [name for name in indexes if name != "activities"]
+
+    position = 0
+    for filename in filenames:
+        for activity in instrument.timed_iter("read_activity", read_activities(filename)):
+            resolved = resolve_activity(activity) if resolve else None
+            if first is not None:
+                note_first_mentions(first, position, activity, resolved)
+                position += 1
+            for name in indexes:
+                INDEXERS[name](result[name], activity, resolved)
+            if counted:
+                add_counts(cube, activity, resolved)
+            if records is not None:
+                records.add(activity)
+
+    if activities_output is not None and "activities" in indexes:
+        result["activities"].close()
+        del result["activities"]
+
+    for name in counted:
+        result[name] = roll_up(name, cube)
+
+    return result
+
+#
+# Incremental maintenance
+#
+# The state file records a hash of each activity record behind the
+# current outputs, in order, with just the parts of the record that the
+# indexes use (see RecordLog); where each index entry is first mentioned
+# in those records (see mentions()) and where its text is in its output
+# file (see write_index()); and a hash of each output file and of the
+# saved cube. A delta run hashes the records in the activity files and
+# compares them with the recorded hashes, and if nothing has changed,
+# that's all it does. Otherwise it subtracts the recorded records for
+# removed or changed identifiers from the saved cube and adds the new
+# ones, then builds just the entries that those records mention again,
+# from just the records that mention them (see refresh_entries()). The
+# output files are written again with the entries in the same order as
+# a full build (the order they're first mentioned in), copying the text
+# of every other entry from the previous files instead of rendering it.
+#
+
+STATE_VERSION = 4
+""" Bump this to force a full rebuild after changing the state format """
+
+NEW_SUFFIX = ".new"
+""" Added to the name of each output file while it's written, until it's complete (and verified) """
+
+def hash_record (activity):
+    """ Return a 128-bit hash of an activity record (encoded as compact JSON) """
+    return hashlib.blake2b(encode_json(activity, "compact").encode("utf-8"), digest_size=16).hexdigest()
+
+def read_records (filenames, known=frozenset()):
+    """ Read activity files and return the (identifier, hash) of each record in order, and the new records
+    The new records are the ones whose hashes aren't in known, keyed by
+    position, so that a delta run doesn't usually have to read the files
+    twice.
+
+    """
+    hashes = []
+    fresh = {}
+    for filename in filenames:
+        for activity in read_activities(filename):
+            hash = hash_record(activity)
+            if not hash in known:
+                fresh[len(hashes)] = activity
+            hashes.append((activity["identifier"], hash,))
+    return hashes, fresh
+
+class RecordLog:
+    """ The activity records behind the indexes, in order, as kept in the state file
+    Each record is (identifier, hash, reporter, keys), where reporter and
+    keys have just the fields that the org, sector, and location indexes
+    and the cube use (see thin()), with each name replaced by its
+    position in a table of names. That's enough for a delta run to
+    subtract a record once it's gone from the activity files, without
+    keeping a second copy of the corpus. The keys are kept as compact
+    JSON text, which takes a fraction of the memory of the lists and
+    dicts, and gives the garbage collector nothing to walk.
+
+    """
+
+    def __init__ (self, names=(), records=()):
+        self.ids = {name: id for id, name in enumerate(names)}
+        self.names = list(names)
+        self.records = list(records)
+
+    def record (self, activity, hash=None):
+        """ Return the logged form of an activity record (hashing it unless hash is given) """
+        ids = self.ids
+        reporter = ids.setdefault(activity["reported_by"], len(ids))
+        keys = [activity["source"], activity["humanitarian"],]
+        for field in ("orgs", "sectors", "locations",):
+            keys.append({key: [ids.setdefault(name, len(ids)) for name in names] for key, names in activity[field].items()})
+        return (activity["identifier"], hash or hash_record(activity), reporter, encode_json(keys, "compact"),)
+
+    def add (self, activity, hash=None):
+        """ Add an activity record to the end of the log """
+        self.records.append(self.record(activity, hash))
+
+    def get_names (self):
+        """ Return the table of names, by position """
+        if len(self.names) < len(self.ids):
+            self.names = list(self.ids)
+        return self.names
+
+    def thin (self, record):
+        """ Return a logged record as an activity with just the fields that the indexes use """
+        identifier, hash, reporter, keys = record
+        source, humanitarian, orgs, sectors, locations = json.loads(keys)
+        names = self.get_names()
+        return {
+            "identifier": identifier,
+            "source": source,
+            "humanitarian": humanitarian,
+            "reported_by": names[reporter],
+            "orgs": {role: [names[id] for id in ids] for role, ids in orgs.items()},
+            "sectors": {type: [names[id] for id in ids] for type, ids in sectors.items()},
+            "locations": {type: [names[id] for id in ids] for type, ids in locations.items()},
+        }
+
+    def groups (self):
+        """ Return the record hashes grouped by identifier, in the order first seen """
+        groups = {}
+        for record in self.records:
+            groups.setdefault(record[0], []).append(record[1])
+        return groups
+
+    def compact (self):
+        """ Drop the names that the records no longer use (after removing records) """
+        log = RecordLog()
+        for record in self.records:
+            log.add(self.thin(record), record[1])
+        self.ids, self.names, self.records = log.ids, log.get_names(), log.records
+
+def mentions (name, activity, resolved):
+    """ Return the keys of the entries in a counted index that an activity adds to, in the order the indexer gets to them
+    The keys are stubs in the org index, and (type, stub) in the sector
+    and location indexes; a key can come more than once.
+
+    """
+    if name == "orgs":
+        keys = [] if resolved["reporting_org"] is None else [resolved["reporting_org"]["stub"]]
+        for role in ROLES:
+            keys.extend(org["stub"] for org in resolved["orgs"].get(role, []) if org is not None and not org.get("skip", False))
+        return keys
+    elif name == "sectors":
+        return [(type, stub,) for type in SECTOR_TYPES for stub in resolved["sectors"].get(type, [])]
+    else:
+        return [
+            (type, location["stub"],) for type in LOCATION_TYPES
+            for location in resolved["locations"].get(type, []) if location and not location.get("skip", False)
+        ]
+
+def note_first_mentions (first, position, activity, resolved):
+    """ Note where each entry that an activity mentions is first mentioned, if it's not noted yet
+    first has a dict for each counted index, from entry key (see
+    mentions()) to (position, rank): the position of the activity record
+    and the order of the entry among the ones it mentions. A full build
+    adds the entries in that order, so sorting on it puts any set of
+    entries in the same order as a full build.
+
+    """
+    for name, seen in first.items():
+        for rank, key in enumerate(mentions(name, activity, resolved)):
+            if not key in seen:
+                seen[key] = (position, rank,)
+
+def get_entry (index, key):
+    """ Return the entry for a key (see mentions()) in an index or entity table, or None """
+    if isinstance(key, tuple):
+        return index.get(key[0], {}).get(key[1])
+    return index.get(key)
+
+def hash_output (output_dir):
+    """ Return a SHA-256 hash of each output file, keyed by index name """
+    return {name: compiled_maps.hash_files([os.path.join(output_dir, OUTPUT_FILES[name])]) for name in INDEXES}
+
+@instrument.timed("write_outputs")
+def write_outputs (result, output_dir, names=INDEXES, suffix=""):
+    """ Write each index to its usual file in the output directory, with suffix added to the name
+    Entries given as spans are copied from the file without the suffix
+    (see write_index()). Returns the spans of the entries in each file
+    written, keyed by index name.
+
+    """
+    spans = {}
+    for name in names:
+        filename = os.path.join(output_dir, OUTPUT_FILES[name])
+        with open(filename + suffix, "w", encoding="utf-8") as output:
+            previous = open(filename, "rb") if os.path.exists(filename) else None
+            try:
+                spans[name] = write_index(name, result[name], output, previous)
+            finally:
+                if previous is not None:
+                    previous.close()
+    return spans
+
+def replace_outputs (output_dir, suffix=NEW_SUFFIX, keep=True):
+    """ Move the output files with suffix over the usual ones (or just remove them, if keep is False) """
+    for name in INDEXES:
+        filename = os.path.join(output_dir, OUTPUT_FILES[name])
+        if keep:
+            os.replace(filename + suffix, filename)
+        elif os.path.exists(filename + suffix):
+            os.remove(filename + suffix)
+
+def load_state (output_dir, state_file, cube_file):
+    """ Load the state from the last run, or return None if it's missing or doesn't match the outputs and the saved cube """
+    try:
+        with open(state_file, "r", encoding="utf-8") as input:
+            state = json.load(input)
+        if state.get("version") != STATE_VERSION or state.get("mode") != JSON_MODE:
+            return None
+        if state.get("outputs") != hash_output(output_dir) or state.get("cube") != compiled_maps.hash_files([cube_file]):
+            return None
+        return state
+    except (OSError, ValueError):
+        return None
+
+def save_state (state_file, output_dir, cube_file, log, layout):
+    """ Save the state for the next delta run (call after writing the outputs and the cube)
+    layout has, for each counted index, a dict from entry key (see
+    mentions()) to (position, rank, start, end), where the entry is
+    first mentioned and where its text is in its output file, in the
+    order of the file; and a list of the (start, end) of each merged
+    activity.
+
+    """
+    entries = {}
+    for name in COUNT_GROUPS:
+        if name == "orgs":
+            entries[name] = layout[name]
+        else:
+            entries[name] = {}
+            for (type, stub), value in layout[name].items():
+                entries[name].setdefault(type, {})[stub] = value
+    compiled_maps.write_atomically(state_file, encode_json({
+        "version": STATE_VERSION,
+        "mode": JSON_MODE,
+        "outputs": hash_output(output_dir),
+        "cube": compiled_maps.hash_files([cube_file]),
+        "names": log.get_names(),
+        "records": log.records,
+        "entries": entries,
+        "activities": layout["activities"],
+    }, "compact").encode("utf-8"))
+
+def load_layout (state):
+    """ Return the layout of the previous outputs from the state (see save_state()) """
+    layout = {"activities": state["activities"]}
+    for name, entries in state["entries"].items():
+        if name == "orgs":
+            layout[name] = entries
+        else:
+            layout[name] = {(type, stub,): value for type, values in entries.items() for stub, value in values.items()}
+    return layout
+
+def diff_records (old, new):
+    """ Compare two sets of record hashes, grouped by identifier (see RecordLog.groups())
+    Returns lists of added, removed, and changed identifiers.
+
+    """
+    added = [identifier for identifier in new if not identifier in old]
+    removed = [identifier for identifier in old if not identifier in new]
+    changed = [identifier for identifier in new if identifier in old and old[identifier] != new[identifier]]
+    return added, removed, changed
+
+def plan_delta (log, hashes):
+    """ Compare the logged records with the records in the activity files
+    hashes has the (identifier, hash) of each record in the files (see
+    read_records()). Returns lists of added, removed, and changed
+    identifiers, or None if the records for the other identifiers aren't
+    in the same order as before (so that a delta can't keep the order of
+    a full build).
+
+    """
+    groups = {}
+    for identifier, hash in hashes:
+        groups.setdefault(identifier, []).append(hash)
+    added, removed, changed = diff_records(log.groups(), groups)
+    updated = set(added + changed)
+    gone = set(removed + changed)
+    kept = [record[0] for record in log.records if not record[0] in gone]
+    if kept != [identifier for identifier, hash in hashes if not identifier in updated]:
+        return None
+    return added, removed, changed
+
+def apply_delta (cube, log, hashes, fresh, filenames, layout, changes):
+    """ Update the cube and the log for the activity files, and return the outputs to write
+    hashes and fresh are from read_records(), layout is from
+    load_layout(), and changes is from plan_delta(). The records for new
+    or changed identifiers that aren't in fresh are read from the files
+    again. Returns (indexes, first): the indexes to write (see
+    write_outputs()), with the entries that haven't changed as spans of
+    the previous output files and the rest in the internal form (see
+    render_index()), and where each entry is first mentioned (see
+    note_first_mentions()).
+
+    """
+
+    added, removed, changed = changes
+    updated = set(added + changed)
+    gone = set(removed + changed)
+
+    positions = [position for position, (identifier, hash) in enumerate(hashes) if identifier in updated]
+    missing = set(position for position in positions if not position in fresh)
+    if missing:
+        activities = (activity for filename in filenames for activity in read_activities(filename))
+        fresh.update((position, activity) for position, activity in enumerate(activities) if position in missing)
+
+    # The new records in their logged form, and the merged activities for them
+    old_records = log.records
+    logged = {}
+    cleaned = {}
+    for position in positions:
+        activity = fresh[position]
+        logged[position] = log.record(activity, hashes[position][1])
+        if not activity["identifier"] in cleaned:
+            cleaned[activity["identifier"]] = clean_activity(activity, resolve_activity(activity))
+
+    # A change that the counted indexes can't see (e.g. to a title) only
+    # needs the merged activity again, as long as the records stay put
+    before = {}
+    after = {}
+    for record in old_records:
+        if record[0] in gone:
+            before.setdefault(record[0], []).append(tuple(record[2:]))
+    for position in positions:
+        after.setdefault(logged[position][0], []).append(tuple(logged[position][2:]))
+    same = set(identifier for identifier in changed if before[identifier] == after[identifier])
+    if same and [record[0] for record in old_records if not record[0] in gone or record[0] in same] != [
+            identifier for identifier, hash in hashes if not identifier in updated or identifier in same
+    ]:
+        same = set()
+
+    # Subtract the old records and add the new ones, noting the entries they mention
+    touched = {name: set() for name in COUNT_GROUPS}
+    subtract = [log.thin(record) for record in old_records if record[0] in gone and not record[0] in same]
+    add = [fresh[position] for position in positions if not hashes[position][0] in same]
+    for weight, activities in ((-1, subtract), (1, add),):
+        for activity in activities:
+            resolved = resolve_activity(activity)
+            for name in touched:
+                touched[name].update(mentions(name, activity, resolved))
+            add_counts(cube, activity, resolved, weight)
+
+    # an unrecognised location's info comes from the first mention of its name at any level
+    stubs = set(stub for type, stub in touched["locations"])
+    touched["locations"] = set((type, stub,) for type in LOCATION_TYPES for stub in stubs)
+
+    # Log the current records in order, noting where each record that the indexes saw before has moved to
+    previous = iter(record for record in old_records if not record[0] in gone)
+    log.records = [logged[position] if identifier in updated else next(previous) for position, (identifier, hash) in enumerate(hashes)]
+    moved = iter(position for position, record in enumerate(log.records) if not record[0] in updated or record[0] in same)
+    remap = [next(moved) if not record[0] in gone or record[0] in same else None for record in old_records]
+    if len(gone) * 4 > len(log.records):
+        # only now and then, since it goes through every record
+        log.compact()
+
+    # The records that mention the touched entries now: the kept ones from their activity lists, and the new ones
+    identifiers = updated - same
+    for name, keys in touched.items():
+        for key in keys:
+            entity = get_entry(cube["entities"][name], key)
+            if entity is None:
+                continue
+            elif name == "orgs":
+                identifiers.update(identifier for role in ROLES for identifier in entity["activities"][role])
+            else:
+                identifiers.update(entity["activities"])
+    # reporting orgs aren't in their entries' activities
+    names = log.get_names()
+    reporters = set()
+    for reporter in set(record[2] for record in log.records) if touched["orgs"] else ():
+        org = lookup_org(names[reporter], create=True) if names[reporter] is not None else None
+        if org is not None and org["stub"] in touched["orgs"]:
+            reporters.add(reporter)
+    candidates = [position for position, record in enumerate(log.records) if record[0] in identifiers or record[2] in reporters]
+
+    entries, first = refresh_entries(cube, log, touched, candidates)
+
+    # Put the new entries among the old ones in the order of a full build
+    indexes = {}
+    for name in COUNT_GROUPS:
+        items = [
+            ((remap[position], rank,), key, (start, end,),) for key, (position, rank, start, end) in layout[name].items()
+            if not key in touched[name]
+        ]
+        items.extend((first[name][key], key, entry,) for key, entry in entries[name].items())
+        items.sort(key=lambda item: item[0])
+        first[name] = {key: order for order, key, entry in items}
+        if name == "orgs":
+            indexes[name] = {key: entry for order, key, entry in items}
+        else:
+            # the sector types are in the order they're first mentioned, but every location type is there
+            indexes[name] = {type: {} for type in LOCATION_TYPES} if name == "locations" and log.records else {}
+            for order, (type, stub), entry in items:
+                indexes[name].setdefault(type, {})[stub] = entry
+
+    # The merged activities: the first record for each identifier
+    old_identifiers = {}
+    for record in old_records:
+        old_identifiers.setdefault(record[0], None)
+    spans = {identifier: span for identifier, span in zip(old_identifiers, layout["activities"]) if not identifier in gone}
+    indexes["activities"] = {}
+    for identifier, hash in hashes:
+        if not identifier in indexes["activities"]:
+            indexes["activities"][identifier] = cleaned[identifier] if identifier in updated else spans[identifier]
+
+    return indexes, first
+
+def refresh_entries (cube, log, touched, candidates):
+    """ Build the touched entries again from the records that mention them
+    touched has the keys (see mentions()) of the entries in each counted
+    index that a delta added or subtracted records for, and candidates
+    has the positions in log of all of the current records that mention
+    any of them, in order. They're indexed again into a scratch cube,
+    from fresh lookups (see forget_lookups()), so that each entry gets
+    its fields from the first record to mention it, as in a full build,
+    and unrecognised locations get the record for their first name. The
+    counts have to be rolled up from the scratch cube too, since they're
+    in the order that their cells were added. Updates the entity tables
+    in cube to match. Returns (entries, first): the touched entries that
+    are still mentioned, and where each is first mentioned (see
+    note_first_mentions()).
+
+    """
+    forget_lookups()
+    scratch = make_cube(slices=False)
+    first = {name: {} for name in touched}
+    for position in candidates:
+        activity = log.thin(log.records[position])
+        resolved = resolve_activity(activity)
+        note_first_mentions(first, position, activity, resolved)
+        for name in touched:
+            INDEXERS[name](scratch["entities"][name], activity, resolved)
+        add_counts(scratch, activity, resolved)
+
+    entries = {}
+    for name, keys in touched.items():
+        entities = cube["entities"][name]
+        for key in keys:
+            entity = get_entry(scratch["entities"][name], key)
+            if name == "orgs":
+                if entity is None:
+                    entities.pop(key, None)
+                else:
+                    entities[key] = entity
+            else:
+                type, stub = key
+                if entity is None:
+                    entities.get(type, {}).pop(stub, None)
+                    if name == "sectors" and type in entities and not entities[type]:
+                        del entities[type]
+                else:
+                    entities.setdefault(type, {})[stub] = entity
+        index = roll_up(name, scratch)
+        entries[name] = {key: get_entry(index, key) for key in keys if get_entry(index, key) is not None}
+    return entries, first
+
+def find_difference (a, b, path=""):
+    """ Return the path of the first difference between two JSON values (counting the order of keys and lists), or None if they're the same """
+    if isinstance(a, dict) and isinstance(b, dict):
+        for (key_a, value_a), (key_b, value_b) in zip(a.items(), b.items()):
+            if key_a != key_b:
+                return "{}/{}".format(path, key_a)
+            difference = find_difference(value_a, value_b, "{}/{}".format(path, key_a))
+            if difference is not None:
+                return difference
+        if len(a) != len(b):
+            return "{}/{}".format(path, list(a if len(a) > len(b) else b)[min(len(a), len(b))])
+        return None
+    elif isinstance(a, list) and isinstance(b, list):
+        for i, (value_a, value_b) in enumerate(zip(a, b)):
+            difference = find_difference(value_a, value_b, "{}/{}".format(path, i))
+            if difference is not None:
+                return difference
+        return None if len(a) == len(b) else "{}/{}".format(path, min(len(a), len(b)))
+    else:
+        return None if a == b else path or "/"
+
+def verify_outputs (output_dir, filenames, suffix=""):
+    """ Compare the output files (with suffix added to their names) with a full rebuild from the activity files
+    Returns a list of (index name, path) for each file that differs,
+    where path is where the JSON first differs, counting the order of
+    keys and lists (see find_difference()), or "/" if only the layout
+    differs.
+
+    """
+    problems = []
+    # start from fresh lookups, as a separate full build would
+    forget_lookups()
+    with tempfile.TemporaryDirectory() as rebuild_dir:
+        with open(os.path.join(rebuild_dir, OUTPUT_FILES["activities"]), "w", encoding="utf-8") as output:
+            rebuilt = build_indexes(filenames, activities_output=output)
+        write_outputs(rebuilt, rebuild_dir, list(COUNT_GROUPS))
+        for name in INDEXES:
+            filename = os.path.join(output_dir, OUTPUT_FILES[name]) + suffix
+            rebuilt_filename = os.path.join(rebuild_dir, OUTPUT_FILES[name])
+            if not filecmp.cmp(filename, rebuilt_filename, shallow=False):
+                with open(filename, "r", encoding="utf-8") as a, open(rebuilt_filename, "r", encoding="utf-8") as b:
+                    problems.append((name, find_difference(json.load(a), json.load(b)) or "/",))
+    return problems
+
+
+def run_single (name, argv):
+    """ Entry point for the single-index wrapper scripts: build one index and dump it to stdout """
+    if len(argv) < 2:
+        print("Usage: {} <activity-file...>".format(argv[0]), file=sys.stderr)
+        sys.exit(2)
+
+    instrument.start(os.path.splitext(os.path.basename(argv[0]))[0])
+
+    if name == "activities":
+        build_indexes(argv[1:], indexes=[name], activities_output=sys.stdout)
+    else:
+        result = build_indexes(argv[1:], indexes=[name])
+        write_index(name, result[name], sys.stdout)
+
+
+#
+# Script entry point
+#
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Build the org, sector, and location indexes and the merged activities")
+    parser.add_argument("--cube", help="save the count cube to this file (for iati3w.cube queries and --delta runs)")
+    parser.add_argument("--state", help="state file for incremental (--delta) runs; updated after every run (requires --cube)")
+    parser.add_argument("--delta", action="store_true", help="update the previous outputs from the changes since the last run, if possible")
+    parser.add_argument("--verify", action="store_true", help="check the result against a full rebuild, and fail if they differ")
+    parser.add_argument("--json-mode", choices=JSON_MODES, help="layout of the output files (default: pretty, or $IATI3W_JSON_MODE)")
+    parser.add_argument("--identifier-set", choices=IDENTIFIER_SETS, help="how to remember the merged activities' identifiers (default: exact, or $IATI3W_IDENTIFIER_SET)")
+    parser.add_argument("output_dir", help="directory for the index files")
+    parser.add_argument("files", nargs="+", help="activity files to index")
+    args = parser.parse_args()
+
+    if args.delta and args.state is None:
+        parser.error("--delta requires --state")
+    if args.state is not None and args.cube is None:
+        parser.error("--state requires --cube")
+
+    instrument.start("indexer")
+
+    if args.json_mode:
+        set_json_mode(args.json_mode)
+
+    state = load_state(args.output_dir, args.state, args.cube) if args.delta else None
+    changes = None
+
+    if state is not None:
+        log = RecordLog(state["names"], state["records"])
+        hashes, fresh = read_records(args.files, set(record[1] for record in log.records))
+        changes = plan_delta(log, hashes)
+        if changes is None:
+            print("The unchanged activities are in a different order; doing a full rebuild", file=sys.stderr)
+        elif not any(changes):
+            print("No changes since the last run; the outputs are up to date", file=sys.stderr)
+            problems = verify_outputs(args.output_dir, args.files) if args.verify else []
+            for name, path in problems:
+                print("*** {} differs from a full rebuild at {}".format(OUTPUT_FILES[name], path), file=sys.stderr)
+            sys.exit(1 if problems else 0)
+
+    cube = load_cube(args.cube) if changes is not None else None
+
+    if cube is not None:
+        indexes, first = apply_delta(cube, log, hashes, fresh, args.files, load_layout(state), changes)
+        print("Applied delta: {} added, {} removed, {} changed identifiers".format(*map(len, changes)), file=sys.stderr)
+        spans = write_outputs(indexes, args.output_dir, INDEXES, NEW_SUFFIX)
+    else:
+        if args.delta and changes is None and state is None:
+            print("No usable previous state; doing a full rebuild", file=sys.stderr)
+        # the cuboids that are only for slices aren't needed unless the cube is saved
+        cube = make_cube(slices=args.cube is not None)
+        log = RecordLog() if args.state is not None else None
+        first = {name: {} for name in COUNT_GROUPS} if log is not None else None
+        activity_spans = [] if log is not None else None
+        # stream the merged activities straight to their file
+        with open(os.path.join(args.output_dir, OUTPUT_FILES["activities"]) + NEW_SUFFIX, "w", encoding="utf-8") as output:
+            result = build_indexes(
+                args.files, activities_output=output, cube=cube, identifier_set=args.identifier_set,
+                records=log, first=first, spans=activity_spans
+            )
+        spans = write_outputs(result, args.output_dir, list(COUNT_GROUPS), NEW_SUFFIX)
+        spans["activities"] = activity_spans
+
+    if args.verify:
+        problems = verify_outputs(args.output_dir, args.files, NEW_SUFFIX)
+        for name, path in problems:
+            print("*** {} differs from a full rebuild at {}".format(OUTPUT_FILES[name], path), file=sys.stderr)
+        if problems:
+            replace_outputs(args.output_dir, keep=False)
+            sys.exit(1)
+
+    replace_outputs(args.output_dir)
+
+    if args.cube is not None:
+        save_cube(args.cube, cube)
+
+    if args.state is not None:
+        layout = {name: {key: first[name][key] + span for key, span in spans[name].items()} for name in COUNT_GROUPS}
+        layout["activities"] = spans["activities"]
+        save_state(args.state, args.output_dir, args.cube, log, layout)
+
+# end
@@ -0,0 +1,220 @@
+""" Opt-in instrumentation: counters, timers, and profiling for each script run
+
+Off by default, and free when it's off (timed() hands back the original
+function). Set IATI3W_INSTRUMENT to a directory to turn it on. Each
+script then writes a JSON report named after its stage (for example,
+activities_iati.instrument.json) to that directory when it exits, with:
+
+timers: calls and total seconds for each instrumented function or
+  step. Times are inclusive, so lookup_org includes its make_token calls.
+
+counters: counts of events such as skipped activities.
+
+lookup_caches: hits and misses for the memoised lookups.
+
+max_rss_kb: peak memory use of the process.
+
+Set IATI3W_PROFILE to "cprofile", "tracemalloc", or "cprofile,tracemalloc"
+to capture a profile as well. The cProfile data is saved as a .prof file
+next to the report (for pstats or snakeviz), with the top functions
+summarised in the report; tracemalloc adds the peak traced memory and
+the top allocation sites.
+
+Only the main process is measured, so use --processes=1 when
+instrumenting activities_iati (--threads is fine, but the timers add up
+the time spent in every thread).
+
+Usage:
+
+    IATI3W_INSTRUMENT=cache/instrument make all
+
+"""
+
+import atexit, functools, json, os, resource, sys, threading, time
+
+from .compiled_maps import write_atomically
+
+REPORT_DIR = os.environ.get("IATI3W_INSTRUMENT") or None
+""" Directory for the reports, or None if instrumentation is off """
+
+ENABLED = REPORT_DIR is not None
+""" True if instrumentation is on """
+
+PROFILE = [mode.strip() for mode in os.environ.get("IATI3W_PROFILE", "").split(",") if mode.strip()]
+""" Extra capture modes to use ("cprofile" and/or "tracemalloc") """
+
+TOP_COUNT = 30
+""" Number of functions or allocation sites to list in the report """
+
+timers = {}
+""" Calls and total seconds for each timer, keyed by name """
+
+counters = {}
+""" Total for each counter, keyed by name """
+
+run = None
+""" The current run: stage name, start time, and any profilers """
+
+lock = threading.Lock()
+""" Held while updating a timer or counter (they may be updated from several threads) """
+
+
+#
+# Timers and counters
+#
+
+def add_time (name, seconds):
+    """ Add one call of the given duration to a timer """
+    with lock:
+        entry = timers.get(name)
+        if entry is None:
+            entry = timers[name] = [0, 0.0]
+        entry[0] += 1
+        entry[1] += seconds
+
+def timed (name):
+    """ Decorator to time every call to a function under the given name """
+    def decorator (f):
+        if not ENABLED:
+            return f
+
+        @functools.wraps(f)
+        def wrapper (*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                add_time(name, time.perf_counter() - start)
+
+        return wrapper
+    return decorator
+
+def timed_iter (name, iterable):
+    """ Time each step of an iterator (such as parsing the next activity) under the given name """
+    if not ENABLED:
+        return iterable
+
+    def generate ():
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                add_time(name, time.perf_counter() - start)
+            yield item
+
+    return generate()
+
+def count (name, n=1):
+    """ Add n to a counter """
+    if ENABLED:
+        with lock:
+            counters[name] = counters.get(name, 0) + n
+
+
+#
+# Runs and reports
+#
+
+def start (stage):
+    """ Start instrumenting a script run (does nothing if instrumentation is off)
+    The report is written when the process exits.
+
+    """
+    global run
+    if not ENABLED or run is not None:
+        return
+
+    run = {
+        "stage": stage,
+        "started": time.time(),
+        "clock": time.perf_counter(),
+        "profiler": None,
+    }
+
+    if "tracemalloc" in PROFILE:
+        import tracemalloc
+        tracemalloc.start()
+
+    if "cprofile" in PROFILE:
+        import cProfile
+        run["profiler"] = cProfile.Profile()
+        run["profiler"].enable()
+
+    atexit.register(write_report)
+
+def summarise_profile (profiler, filename):
+    """ Save cProfile data to a file and return the top functions by cumulative time """
+    import pstats
+    profiler.disable()
+    profiler.dump_stats(filename)
+    stats = pstats.Stats(profiler).stats
+    result = []
+    for (file, line, function), (primitive_calls, calls, own_seconds, cumulative_seconds, callers) in stats.items():
+        result.append({
+            "function": "{}:{}({})".format(file, line, function),
+            "calls": calls,
+            "own_seconds": round(own_seconds, 6),
+            "cumulative_seconds": round(cumulative_seconds, 6),
+        })
+    result.sort(key=lambda entry: entry["cumulative_seconds"], reverse=True)
+    return result[:TOP_COUNT]
+
+def summarise_memory ():
+    """ Return the peak traced memory and the top allocation sites still held """
+    import tracemalloc
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    return {
+        "current_bytes": current,
+        "peak_bytes": peak,
+        "top": [{
+            "location": "{}:{}".format(stat.traceback[0].filename, stat.traceback[0].lineno),
+            "size_bytes": stat.size,
+            "count": stat.count,
+        } for stat in snapshot.statistics("lineno")[:TOP_COUNT]],
+    }
+
+def make_report ():
+    """ Return the report for the current run as a dict """
+    from .common import lookup_cache_stats
+
+    report = {
+        "stage": run["stage"],
+        "argv": sys.argv,
+        "started": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(run["started"])),
+        "seconds": round(time.perf_counter() - run["clock"], 3),
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "timers": {name: {
+            "calls": calls,
+            "seconds": round(seconds, 6),
+        } for name, (calls, seconds) in sorted(timers.items())},
+        "counters": dict(sorted(counters.items())),
+        "lookup_caches": lookup_cache_stats(),
+    }
+
+    if run["profiler"] is not None:
+        filename = os.path.join(REPORT_DIR, run["stage"] + ".prof")
+        report["profile"] = {
+            "file": filename,
+            "top": summarise_profile(run["profiler"], filename),
+        }
+
+    if "tracemalloc" in PROFILE:
+        report["memory"] = summarise_memory()
+
+    return report
+
+def write_report ():
+    """ Write the report for the current run to the report directory """
+    os.makedirs(REPORT_DIR, exist_ok=True)
+    report = make_report()
+    filename = os.path.join(REPORT_DIR, run["stage"] + ".instrument.json")
+    write_atomically(filename, json.dumps(report, indent=4).encode("utf-8"))
+    print("Wrote instrumentation report {}".format(filename), file=sys.stderr)
+
+# end
@@ -4,39 +4,21 @@ Usage:
 
     python3 -m iati3w.merge output/3w-data.json output/iati-data.json > output/activities.json
 
+This is a thin wrapper around iati3w.indexer, which can also produce the
+merged activities in the same pass as the indexes. The activities are
+streamed from the inputs to the output one at a time, and only the names
+that aren't already canonical stubs are looked up again (see
+iati3w.indexer.clean_activity()). Set IATI3W_IDENTIFIER_SET to
+"fingerprint" or "disk" to remember the identifiers already written in
+less memory (see iati3w.indexer.make_identifier_set()).
+
 """
 
-import json, sys
+import sys
 
-from .common import *
+from .indexer import run_single
 
 if __name__ == "__main__":
+    run_single("activities", sys.argv)
 
-    if len(sys.argv) < 2:
-        print("Usage: {} <file> [file ...]".format(sys.argv[0]), file=sys.stderr)
-        sys.exit(2)
-
-    result = {}
-
-    def clean_activity (activity):
-        for role, stub_list in activity["orgs"].items():
-            activity["orgs"][role] = [lookup_org(stub, create=True)["stub"] for stub in stub_list]
-        for type, stub_list in activity["sectors"].items():
-            activity["sectors"][type] = [make_token(stub) for stub in stub_list]
-        for level, stub_list in activity["locations"].items():
-            activity["locations"][level] = [lookup_location(stub, loctype=level)["stub"] for stub in stub_list]
-        return activity
-
-    for i, filename in enumerate(sys.argv[1:]):
-        with open(filename, "r") as input:
-            activities = json.load(input)
-        for activity in activities:
-            result.setdefault(activity["identifier"], clean_activity(activity))
-
-    json.dump(result, sys.stdout, indent=4)
-
-
-
-
-
-
+# end
@@ -0,0 +1,254 @@
+""" Serve single index entries and activities from the built outputs over HTTP
+
+Usage:
+
+    python3 -m iati3w.serve [--port 8000] [--cache-size N] [--reload-interval SECONDS] output/
+
+Loads org-index.json, sector-index.json, location-index.json, and
+activities.json from the output directory once, and then answers
+read-only requests for one entry at a time, so a page for a single org
+or district doesn't have to download the whole index:
+
+    /orgs/STUB
+    /sectors/TYPE/STUB (e.g. /sectors/humanitarian/health)
+    /locations/TYPE/STUB (e.g. /locations/admin2/belet-weyne)
+    /activities/IDENTIFIER (URL-encoded if necessary)
+    /orgs, /sectors, /locations: the stubs and names of all the entries
+    /: the number of entries of each kind, and when they were loaded
+
+Responses are compact JSON, with an ETag (a hash of the body), so a
+client that sends If-None-Match gets a 304 Not Modified while the
+entry is unchanged. The rendered responses are kept in an LRU cache
+(--cache-size entries) for the current version of the outputs.
+
+The server checks the output files' timestamps and sizes at most once
+every --reload-interval seconds (on the next request), and when they've
+changed and then stayed the same for one more check (so that it
+doesn't load them while the indexer is still writing), loads them again
+in a background thread with a new cache, and swaps them in once
+they're complete. Requests carry on being answered from the previous
+version in the meantime, and if the new files can't be loaded,
+the server keeps the previous version and tries again later.
+
+"""
+
+import argparse, datetime, functools, hashlib, http.server, json, os, sys, threading, time, urllib.parse
+
+from .common import encode_json
+from .indexer import OUTPUT_FILES
+
+CACHE_SIZE = 4096
+""" Default number of rendered responses to cache """
+
+RELOAD_INTERVAL = 2.0
+""" Default seconds between checks for new output files """
+
+
+#
+# The loaded outputs
+#
+
+def get_signature (output_dir):
+    """ Return the (modification time, size) of each output file, or None if any is missing """
+    signature = []
+    try:
+        for name in sorted(OUTPUT_FILES):
+            info = os.stat(os.path.join(output_dir, OUTPUT_FILES[name]))
+            signature.append((info.st_mtime_ns, info.st_size,))
+    except OSError:
+        return None
+    return tuple(signature)
+
+class Snapshot:
+    """ One version of the outputs, with its own cache of rendered responses """
+
+    def __init__ (self, output_dir, signature, cache_size=CACHE_SIZE):
+        self.signature = signature
+        self.indexes = {}
+        for name, filename in OUTPUT_FILES.items():
+            with open(os.path.join(output_dir, filename), "r", encoding="utf-8") as input:
+                self.indexes[name] = json.load(input)
+        self.loaded = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+        self.render = functools.lru_cache(maxsize=cache_size)(self.render_uncached)
+
+    def find (self, parts):
+        """ Return the value for the parts of a request path, or None if there isn't one """
+        indexes = self.indexes
+        if not parts:
+            return {
+                "orgs": len(indexes["orgs"]),
+                "sectors": sum(len(entries) for entries in indexes["sectors"].values()),
+                "locations": sum(len(entries) for entries in indexes["locations"].values()),
+                "activities": len(indexes["activities"]),
+                "loaded": self.loaded,
+            }
+
+        kind, keys = parts[0], parts[1:]
+        if kind == "orgs":
+            if not keys:
+                return {stub: entry["info"].get("name") for stub, entry in indexes["orgs"].items()}
+            elif len(keys) == 1:
+                return indexes["orgs"].get(keys[0])
+        elif kind == "sectors":
+            if not keys:
+                return {type: {stub: entry["name"] for stub, entry in entries.items()} for type, entries in indexes["sectors"].items()}
+            elif len(keys) == 2:
+                return indexes["sectors"].get(keys[0], {}).get(keys[1])
+        elif kind == "locations":
+            if not keys:
+                return {type: {stub: entry["info"].get("name") for stub, entry in entries.items()} for type, entries in indexes["locations"].items()}
+            elif len(keys) == 2:
+                return indexes["locations"].get(keys[0], {}).get(keys[1])
+        elif kind == "activities":
+            # IATI identifiers may contain slashes
+            if keys:
+                return indexes["activities"].get("/".join(keys))
+        return None
+
+    def render_uncached (self, path):
+        """ Return (body, ETag) for a decoded request path, or None if there's nothing there """
+        value = self.find([part for part in path.split("/") if part])
+        if value is None:
+            return None
+        body = encode_json(value, "compact").encode("utf-8")
+        return body, '"{}"'.format(hashlib.sha1(body).hexdigest())
+
+class Outputs:
+    """ The current snapshot of the outputs, reloaded in the background when the files change """
+
+    def __init__ (self, output_dir, cache_size=CACHE_SIZE, reload_interval=RELOAD_INTERVAL):
+        self.output_dir = output_dir
+        self.cache_size = cache_size
+        self.reload_interval = reload_interval
+        self.lock = threading.Lock()
+        self.last_check = time.monotonic()
+        self.pending = None
+        self.loading = False
+        signature = get_signature(output_dir)
+        if signature is None:
+            raise OSError("Missing output files in {}".format(output_dir))
+        self.snapshot = Snapshot(output_dir, signature, cache_size)
+
+    def get (self):
+        """ Return the current snapshot, starting a reload if the files have changed and settled
+        The reload runs in its own thread (see load()), so the request
+        that notices the change is answered straight away from the
+        current snapshot, like the others.
+
+        """
+        now = time.monotonic()
+        if now - self.last_check >= self.reload_interval and self.lock.acquire(blocking=False):
+            try:
+                self.last_check = now
+                if not self.loading:
+                    signature = get_signature(self.output_dir)
+                    if signature is None or signature == self.snapshot.signature:
+                        self.pending = None
+                    elif signature != self.pending:
+                        # changed since the last check: wait until it stops changing
+                        self.pending = signature
+                    else:
+                        self.pending = None
+                        self.loading = True
+                        threading.Thread(target=self.load, args=(signature,), daemon=True).start()
+            finally:
+                self.lock.release()
+        return self.snapshot
+
+    def load (self, signature):
+        """ Load a new snapshot, and swap it in once it's complete """
+        try:
+            snapshot = Snapshot(self.output_dir, signature, self.cache_size)
+        except (OSError, ValueError) as e:
+            print("Can't reload {} yet: {}".format(self.output_dir, e), file=sys.stderr)
+            snapshot = None
+        with self.lock:
+            if snapshot is not None:
+                self.snapshot = snapshot
+            self.loading = False
+        if snapshot is not None:
+            print("Reloaded {}".format(self.output_dir), file=sys.stderr)
+
+
+#
+# HTTP
+#
+
+class Handler (http.server.BaseHTTPRequestHandler):
+    """ Answer GET and HEAD requests from the outputs in self.server.outputs """
+
+    server_version = "iati3w"
+
+    def do_GET (self):
+        self.respond(send_body=True)
+
+    def do_HEAD (self):
+        self.respond(send_body=False)
+
+    def respond (self, send_body):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        result = self.server.outputs.get().render(path)
+
+        if result is None:
+            self.send_json(404, b'{"error":"not found"}', None, send_body)
+        elif self.headers.get("If-None-Match") in (result[1], "*",):
+            self.send_response(304)
+            self.send_header("ETag", result[1])
+            self.end_headers()
+        else:
+            self.send_json(200, result[0], result[1], send_body)
+
+    def send_json (self, status, body, etag, send_body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        if etag is not None:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def log_message (self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+def make_server (output_dir, host="127.0.0.1", port=8000, cache_size=CACHE_SIZE, reload_interval=RELOAD_INTERVAL, quiet=False):
+    """ Load the outputs and return a server, ready for serve_forever() """
+    server = http.server.ThreadingHTTPServer((host, port,), Handler)
+    server.daemon_threads = True
+    server.outputs = Outputs(output_dir, cache_size, reload_interval)
+    server.quiet = quiet
+    return server
+
+
+#
+# Script entry point
+#
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve single index entries and activities from the built outputs over HTTP")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("-p", "--port", type=int, default=8000, help="port to listen on (default: 8000)")
+    parser.add_argument("--cache-size", type=int, default=CACHE_SIZE, help="rendered responses to cache (default: {})".format(CACHE_SIZE))
+    parser.add_argument("--reload-interval", type=float, default=RELOAD_INTERVAL, help="seconds between checks for new outputs (default: {})".format(RELOAD_INTERVAL))
+    parser.add_argument("-q", "--quiet", action="store_true", help="don't log each request")
+    parser.add_argument("output_dir", nargs="?", default="output", help="directory with the indexer's outputs (default: output)")
+    args = parser.parse_args()
+
+    try:
+        server = make_server(args.output_dir, args.host, args.port, args.cache_size, args.reload_interval, args.quiet)
+    except (OSError, ValueError) as e:
+        print("Can't start the server: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+
+    print("Serving {} on http://{}:{}/".format(args.output_dir, args.host, args.port), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+# end
@@ -0,0 +1,267 @@
+""" Load the merged activities and the index relations into a SQLite database
+
+Usage:
+
+    python3 -m iati3w.store build [--output-dir output] cache/activities.sqlite
+    python3 -m iati3w.store query cache/activities.sqlite "SELECT scope, COUNT(*) FROM orgs GROUP BY scope"
+
+The build reads the published outputs from the indexer (activities.json,
+org-index.json, sector-index.json, and location-index.json) once, and
+writes them to a new database with bulk inserts in a single transaction,
+then creates the indexes and swaps the finished database into place, so
+a reader never sees a half-built one. It's an optional stage: nothing
+else depends on it, but ad hoc questions (e.g. which unknown-scope orgs
+have the most activities) become quick SQL queries instead of loading
+the whole JSON outputs. The query command prints the results as CSV.
+
+Tables (see SCHEMA):
+
+activities: one row per merged activity, with the full activity as JSON
+  in the data column (use SQLite's json_extract() or json_each() for the
+  rest)
+
+orgs, sectors, locations: one row per index entry
+
+org_activities, sector_activities, location_activities: the activity
+  lists from the index entries (one row for each activity in each
+  entry, by role for orgs)
+
+"""
+
+import argparse, csv, json, os, sqlite3, sys
+
+# Only the build imports iati3w.indexer (see load_output()), so that a
+# query doesn't spend longer loading the lookup tables and libhxl than
+# it does running.
+
+SCHEMA = [
+    """CREATE TABLE activities (
+        identifier TEXT PRIMARY KEY,
+        source TEXT,
+        reported_by TEXT,
+        humanitarian INTEGER,
+        active INTEGER,
+        title TEXT,
+        start_date TEXT,
+        end_date TEXT,
+        data TEXT
+    )""",
+    """CREATE TABLE orgs (
+        stub TEXT PRIMARY KEY,
+        name TEXT,
+        shortname TEXT,
+        scope TEXT,
+        skip INTEGER,
+        humanitarian INTEGER,
+        activities INTEGER,
+        info TEXT
+    )""",
+    "CREATE TABLE org_activities (org TEXT, role TEXT, identifier TEXT)",
+    "CREATE TABLE sectors (type TEXT, stub TEXT, name TEXT, PRIMARY KEY (type, stub))",
+    "CREATE TABLE sector_activities (type TEXT, sector TEXT, identifier TEXT)",
+    "CREATE TABLE locations (type TEXT, stub TEXT, name TEXT, admin1 TEXT, pcode TEXT, info TEXT, PRIMARY KEY (type, stub))",
+    "CREATE TABLE location_activities (type TEXT, location TEXT, identifier TEXT)",
+]
+""" Statements to create the tables """
+
+INDEXES = [
+    "CREATE INDEX activities_source ON activities (source)",
+    "CREATE INDEX activities_humanitarian ON activities (humanitarian)",
+    "CREATE INDEX activities_reported_by ON activities (reported_by)",
+    "CREATE INDEX orgs_scope ON orgs (scope)",
+    "CREATE INDEX org_activities_org ON org_activities (org, role)",
+    "CREATE INDEX org_activities_identifier ON org_activities (identifier)",
+    "CREATE INDEX sector_activities_sector ON sector_activities (sector, type)",
+    "CREATE INDEX sector_activities_identifier ON sector_activities (identifier)",
+    "CREATE INDEX location_activities_location ON location_activities (location, type)",
+    "CREATE INDEX location_activities_identifier ON location_activities (identifier)",
+]
+""" Statements to create the indexes (after the bulk inserts, which is much faster than updating them row by row) """
+
+
+#
+# Building
+#
+
+def to_json (value):
+    """ Encode a value as JSON for a data or info column """
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":",))
+
+def load_output (output_dir, name):
+    """ Load one of the indexer's published outputs """
+    from .indexer import OUTPUT_FILES
+    with open(os.path.join(output_dir, OUTPUT_FILES[name]), "r", encoding="utf-8") as input:
+        return json.load(input)
+
+def activity_rows (activities):
+    """ Generate a row for each merged activity """
+    for identifier, activity in activities.items():
+        dates = activity.get("dates", {})
+        yield (
+            identifier,
+            activity["source"],
+            activity["reported_by"],
+            int(bool(activity["humanitarian"])),
+            int(bool(activity.get("active"))),
+            activity.get("title"),
+            dates.get("start"),
+            dates.get("end"),
+            to_json(activity),
+        )
+
+def org_rows (orgs):
+    """ Generate a row for each org index entry """
+    for stub, entry in orgs.items():
+        info = entry["info"]
+        yield (
+            stub,
+            info.get("name"),
+            info.get("shortname"),
+            info.get("scope"),
+            int(bool(info.get("skip", False))),
+            int(bool(entry["humanitarian"])),
+            entry["activity_totals"]["all"],
+            to_json(info),
+        )
+
+def org_activity_rows (orgs):
+    """ Generate an (org, role, identifier) row for each activity in each org index entry """
+    for stub, entry in orgs.items():
+        for role, identifiers in entry["activities"].items():
+            for identifier in identifiers:
+                yield (stub, role, identifier,)
+
+def sector_rows (sectors):
+    """ Generate a row for each sector index entry """
+    for type, entries in sectors.items():
+        for stub, entry in entries.items():
+            yield (type, stub, entry["name"],)
+
+def sector_activity_rows (sectors):
+    """ Generate a (type, sector, identifier) row for each activity in each sector index entry """
+    for type, entries in sectors.items():
+        for stub, entry in entries.items():
+            for identifier in entry["activities"]:
+                yield (type, stub, identifier,)
+
+def location_rows (locations):
+    """ Generate a row for each location index entry """
+    for type, entries in locations.items():
+        for stub, entry in entries.items():
+            info = entry["info"]
+            yield (type, stub, info.get("name"), info.get("admin1"), info.get("pcode"), to_json(info),)
+
+def location_activity_rows (locations):
+    """ Generate a (type, location, identifier) row for each activity in each location index entry
+    The location entries list an activity once for each time it
+    mentions the location, but each gets only one row here.
+
+    """
+    for type, entries in locations.items():
+        for stub, entry in entries.items():
+            for identifier in dict.fromkeys(entry["activities"]):
+                yield (type, stub, identifier,)
+
+def build_store (filename, output_dir):
+    """ Build a new database from the published outputs in output_dir, replacing filename atomically
+    Returns the number of rows in each table.
+
+    """
+    temp_filename = filename + ".tmp"
+    if os.path.exists(temp_filename):
+        os.remove(temp_filename)
+
+    db = sqlite3.connect(temp_filename)
+    try:
+        # nothing to recover if the build fails part way, so skip the journal
+        db.execute("PRAGMA journal_mode = OFF")
+        db.execute("PRAGMA synchronous = OFF")
+
+        with db:
+            for statement in SCHEMA:
+                db.execute(statement)
+
+            activities = load_output(output_dir, "activities")
+            db.executemany("INSERT INTO activities VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", activity_rows(activities))
+            del activities
+
+            orgs = load_output(output_dir, "orgs")
+            db.executemany("INSERT INTO orgs VALUES (?, ?, ?, ?, ?, ?, ?, ?)", org_rows(orgs))
+            db.executemany("INSERT INTO org_activities VALUES (?, ?, ?)", org_activity_rows(orgs))
+            del orgs
+
+            sectors = load_output(output_dir, "sectors")
+            db.executemany("INSERT INTO sectors VALUES (?, ?, ?)", sector_rows(sectors))
+            db.executemany("INSERT INTO sector_activities VALUES (?, ?, ?)", sector_activity_rows(sectors))
+            del sectors
+
+            locations = load_output(output_dir, "locations")
+            db.executemany("INSERT INTO locations VALUES (?, ?, ?, ?, ?, ?)", location_rows(locations))
+            db.executemany("INSERT INTO location_activities VALUES (?, ?, ?)", location_activity_rows(locations))
+            del locations
+
+            for statement in INDEXES:
+                db.execute(statement)
+
+        db.execute("ANALYZE")
+        counts = {}
+        for (table,) in db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY rowid"):
+            counts[table] = db.execute("SELECT COUNT(*) FROM {}".format(table)).fetchone()[0]
+    finally:
+        db.close()
+
+    os.replace(temp_filename, filename)
+    return counts
+
+
+#
+# Querying
+#
+
+def connect (filename):
+    """ Open an existing database read-only (fails if it hasn't been built) """
+    return sqlite3.connect("file:{}?mode=ro".format(filename), uri=True)
+
+def query (filename, sql, params=()):
+    """ Run a query against a database, and return (column names, rows) """
+    db = connect(filename)
+    try:
+        cursor = db.execute(sql, params)
+        return [column[0] for column in cursor.description or []], cursor.fetchall()
+    finally:
+        db.close()
+
+
+#
+# Script entry point
+#
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the merged activities and indexes into SQLite, or query them")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="(re)build the database from the indexer's outputs")
+    build_parser.add_argument("-o", "--output-dir", default="output", help="directory with the indexer's outputs (default: output)")
+    build_parser.add_argument("db", help="database file to create")
+
+    query_parser = subparsers.add_parser("query", help="run an SQL query and print the result as CSV")
+    query_parser.add_argument("db", help="database file")
+    query_parser.add_argument("sql", help="SQL query (use ? for parameters)")
+    query_parser.add_argument("params", nargs="*", help="query parameters")
+
+    args = parser.parse_args()
+
+    if args.command == "build":
+        counts = build_store(args.db, args.output_dir)
+        print("Built {}: {}".format(args.db, ", ".join("{} {}".format(count, table) for table, count in counts.items())), file=sys.stderr)
+    else:
+        try:
+            columns, rows = query(args.db, args.sql, args.params)
+        except sqlite3.Error as e:
+            print("Query failed: {}".format(e), file=sys.stderr)
+            sys.exit(1)
+        output = csv.writer(sys.stdout)
+        output.writerow(columns)
+        output.writerows(rows)
+
+# end
@@ -0,0 +1,59 @@
+""" Tests for iati3w.activities_3w
+
+Run from the top-level directory (the maps are read from inputs/):
+
+    python3 -m unittest discover tests
+
+"""
+
+import csv, os, tempfile, unittest
+
+from iati3w import activities_3w, common
+
+HEADERS = [
+    ["Programme", "Project", "Status", "Cluster", "Region", "District", "Location", "Implementing", "Programming", "Funding",],
+    ["#activity+programme", "#activity+project", "#status", "#sector", "#adm1+name", "#adm2+name", "#loc+name", "#org+impl", "#org+prog", "#org+funding",],
+]
+""" Text and HXL header rows for the test 3W file """
+
+
+class TestParity (unittest.TestCase):
+    """ The output must be the same however the activities are built """
+
+    def setUp (self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp.name, "3w.csv")
+        with open(self.filename, "w", encoding="utf-8", newline="") as output:
+            writer = csv.writer(output)
+            writer.writerows(HEADERS)
+            # the same district, spelt differently in the later rows
+            for i in range(30):
+                district = "Nowhere District" if i < 15 else "NOWHERE DISTRICT"
+                writer.writerow(["Programme {}".format(i), "Project {}".format(i), "Ongoing", "Health", "Banadir", district, "Xyzzy Village", "Save the Children", "UNICEF", "ECHO",])
+        self.serial = self.fetch()
+
+    def tearDown (self):
+        self.tmp.cleanup()
+
+    def fetch (self, **options):
+        """ Convert the file as if in a new process, 10 rows to a chunk """
+        common.forget_lookups()
+        return list(activities_3w.iterate_3w([self.filename], chunk_size=10, **options))
+
+    def test_serial_names (self):
+        """ The first spelling seen is used for every activity """
+        for activity in self.serial:
+            self.assertEqual(activity["locations"]["admin2"], ["Nowhere District"])
+        self.assertEqual(len(set(activity["identifier"] for activity in self.serial)), 30)
+
+    def test_process_pool (self):
+        self.assertEqual(self.fetch(processes=3), self.serial)
+
+    def test_thread_pool (self):
+        self.assertEqual(self.fetch(threads=3), self.serial)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# end
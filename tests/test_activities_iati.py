@@ -0,0 +1,128 @@
+""" Tests for iati3w.activities_iati
+
+Run from the top-level directory (the maps are read from inputs/):
+
+    python3 -m unittest discover tests
+
+"""
+
+import glob, json, os, tempfile, unittest
+
+from iati3w import activities_iati, common, humanitarian
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+PAGES = sorted(glob.glob(os.path.join(DATA_DIR, "iati-page-*.xml")))
+""" Small IATI pages, with a last-updated-datetime on every activity """
+
+CASE_ACTIVITY = """<iati-activity last-updated-datetime="2021-01-01T00:00:00" humanitarian="1">
+<iati-identifier>XX-CASE-{0:04d}</iati-identifier>
+<reporting-org ref="XM-DAC-41122"><narrative>UNICEF</narrative></reporting-org>
+<title><narrative>Case activity {0}</narrative></title><description><narrative>Case description {0}</narrative></description>
+<activity-status code="2"/>
+<recipient-country code="so"/>
+<location><name><narrative>{1}</narrative></name></location>
+<location><name><narrative>Jilib</narrative></name></location>
+<sector vocabulary="1" code="72010"/>
+</iati-activity>
+"""
+""" An activity with an unrecognised location name, and a recognised one """
+
+def write_case_pages (dir, pages):
+    """ Write a page for each list of location names given (one activity for each), and return the filenames """
+    files = []
+    count = 0
+    for page, names in enumerate(pages):
+        file = os.path.join(dir, "iati-case-{}.xml".format(page))
+        with open(file, "w", encoding="utf-8") as output:
+            output.write('<?xml version="1.0"?>\n<iati-activities version="2.03">\n')
+            for name in names:
+                output.write(CASE_ACTIVITY.format(count, name))
+                count += 1
+            output.write("</iati-activities>\n")
+        files.append(file)
+    return files
+
+class TestVerdictCache (unittest.TestCase):
+
+    def setUp (self):
+        humanitarian.verdicts.clear()
+        humanitarian.take_new_verdicts()
+
+    def load_saved_verdicts (self, cache_dir):
+        with open(os.path.join(cache_dir, activities_iati.VERDICT_CACHE), "r", encoding="utf-8") as input:
+            return json.load(input)["verdicts"]
+
+    def test_process_pool_keeps_verdicts (self):
+        """ A second run with the pages already cached must not lose the saved verdicts """
+        with tempfile.TemporaryDirectory() as cache_dir:
+            first = activities_iati.fetch_activities(PAGES, processes=2, cache_dir=cache_dir)
+            saved = self.load_saved_verdicts(cache_dir)
+            self.assertEqual(sorted(saved), sorted(activity["identifier"] for activity in first))
+
+            # forget the verdicts in this process, as a new run would
+            humanitarian.verdicts.clear()
+            second = activities_iati.fetch_activities(PAGES, processes=2, cache_dir=cache_dir)
+            self.assertEqual(second, first)
+            self.assertEqual(self.load_saved_verdicts(cache_dir), saved)
+
+
+class TestParity (unittest.TestCase):
+    """ The output must be the same however the pages are converted """
+
+    def setUp (self):
+        self.tmp = tempfile.TemporaryDirectory()
+        # the same place, spelt differently on later pages (and first named
+        # at the end of a longer page, so the other pages are likely to get
+        # there first in a pool)
+        self.files = write_case_pages(self.tmp.name, [["Baidoa"] * 100 + ["Zzq Town"]] + [["ZZQ TOWN"] * 3] * 3)
+        self.serial = self.fetch()
+
+    def tearDown (self):
+        self.tmp.cleanup()
+
+    def fetch (self, **options):
+        """ Convert the pages as if in a new process """
+        common.forget_lookups()
+        return activities_iati.fetch_activities(self.files, **options)
+
+    def test_serial_names (self):
+        """ The first spelling seen is used for every activity """
+        for activity in self.serial[100:]:
+            self.assertEqual(activity["locations"]["unclassified"], ["Zzq Town"])
+
+    def test_process_pool (self):
+        self.assertEqual(self.fetch(processes=4), self.serial)
+
+    def test_thread_pool (self):
+        """ The threads share one registry, so the names mustn't depend on which thread gets there first """
+        for run in range(5):
+            self.assertEqual(self.fetch(threads=4), self.serial)
+
+
+class TestPageCache (unittest.TestCase):
+    """ Pages from the cache must give the same output as converting them again """
+
+    def test_names_from_earlier_pages (self):
+        """ A cached page mustn't keep the names that an earlier page decided """
+        with tempfile.TemporaryDirectory() as dir:
+            cache_dir = os.path.join(dir, "cache")
+            os.mkdir(cache_dir)
+            files = write_case_pages(dir, [["Zzq Town"], ["ZZQ TOWN"] * 3])
+            common.forget_lookups()
+            activities_iati.fetch_activities(files, cache_dir=cache_dir)
+
+            # the first page no longer names the place, so the second page's spelling is first now
+            write_case_pages(dir, [["Baidoa"], ["ZZQ TOWN"] * 3])
+            common.forget_lookups()
+            fresh = activities_iati.fetch_activities(files)
+            self.assertEqual(fresh[1]["locations"]["unclassified"], ["ZZQ TOWN"])
+            for options in ({}, {"processes": 2}, {"threads": 2},):
+                common.forget_lookups()
+                self.assertEqual(activities_iati.fetch_activities(files, cache_dir=cache_dir, **options), fresh)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# end
@@ -0,0 +1,70 @@
+""" Tests for iati3w.benchmark's synthetic data and report
+
+Run from the top-level directory (the maps are read from inputs/):
+
+    python3 -m unittest discover tests
+
+"""
+
+import contextlib, csv, filecmp, io, os, re, tempfile, unittest
+
+from iati3w import benchmark
+
+
+class TestGenerate (unittest.TestCase):
+
+    def setUp (self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown (self):
+        self.tmp.cleanup()
+
+    def generate (self, name, count=250, seed=1):
+        return benchmark.generate(os.path.join(self.tmp.name, name), count, seed)
+
+    def test_same_seed (self):
+        """ The same seed always gives the same files, and another seed doesn't """
+        first = self.generate("first")
+        second = self.generate("second")
+        other = self.generate("other", seed=2)
+        for a, b, c in zip(first[0] + [first[1]], second[0] + [second[1]], other[0] + [other[1]]):
+            self.assertTrue(filecmp.cmp(a, b, shallow=False), a)
+            self.assertFalse(filecmp.cmp(a, c, shallow=False), a)
+
+    def test_sizes (self):
+        """ The activities come in pages of PAGE_SIZE, and the 3W rows under the two header rows """
+        iati_files, threew_file = self.generate("data")
+        self.assertEqual([os.path.basename(filename) for filename in iati_files], ["iati-som-00000.xml", "iati-som-00100.xml", "iati-som-00200.xml",])
+        identifiers = []
+        for filename in iati_files:
+            with open(filename, "r") as input:
+                identifiers += re.findall(r'<iati-identifier>(.*?)</iati-identifier>', input.read())
+        self.assertEqual(len(identifiers), 250)
+        # some repeats, for the de-duplication
+        self.assertLess(len(set(identifiers)), 250)
+        with open(threew_file, "r", newline="") as input:
+            rows = list(csv.reader(input))
+        self.assertEqual(len(rows), 252)
+        self.assertTrue(rows[1][0].startswith("#"))
+
+
+class TestRun (unittest.TestCase):
+
+    def test_converters (self):
+        """ The converters accept the generated data, and the report counts what they found """
+        with tempfile.TemporaryDirectory() as work_dir, contextlib.redirect_stderr(io.StringIO()):
+            report = benchmark.run_benchmark(work_dir, 150, stages=["activities_iati", "activities_3w",])
+        self.assertEqual([stage["stage"] for stage in report["stages"]], ["activities_iati", "activities_3w",])
+        # the repeated identifiers aren't counted twice
+        self.assertTrue(0 < report["records"]["iati"] < 150)
+        self.assertEqual(report["records"]["3w"], 150)
+        for stage in report["stages"]:
+            self.assertEqual(stage["input_activities"], 150)
+            self.assertGreater(stage["max_rss_kb"], 0)
+            self.assertGreater(stage["seconds"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# end
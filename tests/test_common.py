@@ -0,0 +1,204 @@
+""" Tests for the lookups in iati3w.common
+
+Run from the top-level directory (the maps are read from inputs/):
+
+    python3 -m unittest discover tests
+
+"""
+
+import copy, json, pickle, unittest
+
+from iati3w import common
+
+def make_3w_rows ():
+    """ Return (admin1, admin2, loc) names like those in 3W rows, from the location map, with repeats """
+    with open("inputs/location-map.json", "r", encoding="utf-8") as input:
+        regions = json.load(input)["admin1"]
+    rows = []
+    names = list(regions)
+    for i, (admin1_name, admin1) in enumerate(regions.items()):
+        # the next region along, to conflict with the district
+        other_name = names[(i + 1) % len(names)]
+        for admin2_name, admin2 in admin1.get("admin2", {}).items():
+            rows.append((admin1_name, admin2_name, "",))
+            rows.append((other_name, admin2_name, "",))
+            rows.append((admin1_name, "", admin2_name,))
+            rows.append((admin1_name, admin2_name, "Xyzzy Village",))
+            for loc_name in admin2.get("unclassified", {}):
+                rows.append((admin1_name, admin2_name, loc_name,))
+                rows.append((other_name, "Nowhere District", loc_name,))
+    rows.append(("Nowhere Region", "Nowhere District", "Xyzzy Village",))
+    return rows + rows
+
+
+class TestReconcile (unittest.TestCase):
+
+    def setUp (self):
+        self.cache_size = common.LOOKUP_CACHE_SIZE
+
+    def tearDown (self):
+        common.set_lookup_cache_size(self.cache_size)
+        common.forget_lookups()
+
+    def reconcile_all (self, rows, cache_size):
+        """ Reconcile the rows in a fresh run with the given cache size, and return the results and cache stats """
+        common.set_lookup_cache_size(cache_size)
+        common.forget_lookups()
+        results = [common.reconcile_locations(*row) for row in rows]
+        return results, common.lookup_cache_stats()["reconcile_locations"]
+
+    def test_memoised (self):
+        """ The memoised results are the same as working each row out again """
+        rows = make_3w_rows()
+        uncached, stats = self.reconcile_all(rows, 0)
+        self.assertEqual(stats["hits"], 0)
+        cached, stats = self.reconcile_all(rows, self.cache_size)
+        self.assertGreaterEqual(stats["hits"], len(rows) // 2)
+        self.assertEqual(cached, uncached)
+        # and with a cache too small to hold them all
+        evicting, stats = self.reconcile_all(rows, 16)
+        self.assertEqual(evicting, uncached)
+
+    def test_conflict (self):
+        """ The district wins over a conflicting region, however often the row is seen """
+        for i in range(2):
+            self.assertEqual(common.reconcile_locations("Bay", "Hodan", ""), (("admin1", "banadir-mogadishu",), ("admin2", "hodan",),))
+            self.assertEqual(common.reconcile_locations("Banadir", "", "Hodan"), (("admin1", "banadir-mogadishu",), ("admin2", "hodan",),))
+
+
+ORG_PAIRS = [
+    ("UNICEF", "United Nations Children's Fund",),
+    ("XX-NOBODY-1", "Save the Children",),
+    (None, "Zzyzx Relief Collective",),
+    (None, "ZZYZX RELIEF COLLECTIVE",),
+    ("XX-NOBODY-2", None,),
+    (None, None,),
+    (None, "Allocation 2 (Standard)",),
+    ("NRC", None,),
+]
+""" (ref, name) pairs, recognised, unrecognised, empty, and blocklisted """
+
+LOCATION_NAMES = ["Baidoa", "Qwertyville North", "", "Baydhaba", "QWERTYVILLE NORTH", "Hodan", None, "Plugh",]
+""" Location names, recognised, unrecognised (in two spellings), and empty """
+
+
+class TestBatch (unittest.TestCase):
+    """ The batch lookups give the same records as one lookup at a time, in input order """
+
+    def setUp (self):
+        common.forget_lookups()
+
+    def tearDown (self):
+        common.forget_lookups()
+
+    def test_orgs (self):
+        pairs = ORG_PAIRS * 3
+        batch = common.lookup_orgs_batch(pairs)
+        self.assertEqual(len(batch), len(pairs))
+        for (ref, name), record in zip(pairs, batch):
+            single = common.lookup_org(ref) if ref is not None else None
+            if single is None and name is not None:
+                single = common.lookup_org(name, True)
+            self.assertEqual(record, single, (ref, name,))
+        self.assertEqual(batch[0]["stub"], "unicef")
+        self.assertEqual(batch[1]["stub"], "sci")
+        self.assertIsNone(batch[5])
+        self.assertIsNone(batch[6])
+
+    def test_locations (self):
+        names = LOCATION_NAMES * 3
+        batch = common.lookup_locations_batch(names)
+        common.forget_lookups()
+        single = [None if common.is_empty(name) else common.lookup_location(name) for name in names]
+        self.assertEqual(batch, single)
+        self.assertEqual(batch[0]["stub"], "baydhaba")
+        self.assertIsNone(batch[2])
+        # the first spelling seen names an unrecognised location from then on
+        self.assertEqual(batch[4]["name"], "Qwertyville North")
+
+    def test_locations_unregistered (self):
+        """ Unrecognised names keep their own spelling when they aren't registered """
+        batch = common.lookup_locations_batch(LOCATION_NAMES, register=False)
+        self.assertEqual(batch[1]["name"], "Qwertyville North")
+        self.assertEqual(batch[4]["name"], "QWERTYVILLE NORTH")
+        self.assertEqual(batch[0], common.lookup_location("Baidoa"))
+
+
+class TestRecords (unittest.TestCase):
+    """ Lookup records are shared, so nothing can change them """
+
+    def setUp (self):
+        self.record = common.freeze({"name": "Baydhaba", "synonyms": ["Baidoa"], "info": {"codes": ["SO24"]}})
+
+    def test_record (self):
+        record = self.record
+        for change in (
+                lambda: record.__setitem__("name", "Baidoa"),
+                lambda: record.__delitem__("name"),
+                lambda: record.update(name="Baidoa"),
+                lambda: record.setdefault("stub", "baydhaba"),
+                lambda: record.pop("name"),
+                lambda: record.popitem(),
+                lambda: record.clear(),
+        ):
+            self.assertRaises(TypeError, change)
+        with self.assertRaises(TypeError):
+            record |= {"name": "Baidoa"}
+        self.assertEqual(record, {"name": "Baydhaba", "synonyms": ["Baidoa"], "info": {"codes": ["SO24"]}})
+
+    def test_nested (self):
+        """ The lists and dicts inside a record are frozen too """
+        synonyms = self.record["synonyms"]
+        self.assertIsInstance(synonyms, common.FrozenList)
+        self.assertIsInstance(self.record["info"], common.Record)
+        for change in (
+                lambda: synonyms.append("Baidoa"),
+                lambda: synonyms.extend(["Baidoa"]),
+                lambda: synonyms.insert(0, "Baidoa"),
+                lambda: synonyms.__setitem__(0, "Baidoa"),
+                lambda: synonyms.__delitem__(0),
+                lambda: synonyms.pop(),
+                lambda: synonyms.remove("Baidoa"),
+                lambda: synonyms.sort(),
+                lambda: synonyms.reverse(),
+                lambda: synonyms.clear(),
+                lambda: self.record["info"]["codes"].append("SO25"),
+        ):
+            self.assertRaises(TypeError, change)
+        with self.assertRaises(TypeError):
+            synonyms += ["Baidoa"]
+        with self.assertRaises(TypeError):
+            synonyms *= 2
+        self.assertEqual(self.record["synonyms"], ["Baidoa"])
+
+    def test_copies (self):
+        """ Copies are the same record, pickles stay read-only, and JSON is unchanged """
+        self.assertIs(copy.copy(self.record), self.record)
+        self.assertIs(copy.deepcopy(self.record), self.record)
+        unpickled = pickle.loads(pickle.dumps(self.record))
+        self.assertEqual(unpickled, self.record)
+        self.assertIsInstance(unpickled, common.Record)
+        self.assertIsInstance(unpickled["synonyms"], common.FrozenList)
+        self.assertRaises(TypeError, unpickled["synonyms"].append, "Baidoa")
+        self.assertEqual(json.dumps(self.record), json.dumps({"name": "Baydhaba", "synonyms": ["Baidoa"], "info": {"codes": ["SO24"]}}))
+        # a plain copy can be changed
+        plain = dict(self.record)
+        plain["name"] = "Baidoa"
+        self.assertEqual(self.record["name"], "Baydhaba")
+
+    def test_lookups (self):
+        """ The lookups return the shared records, which callers can't change """
+        org = common.lookup_org("UNICEF")
+        self.assertIsInstance(org, common.Record)
+        self.assertIs(common.lookup_org("unicef"), org)
+        self.assertRaises(TypeError, org.__setitem__, "scope", "local")
+        location = common.lookup_location("Baidoa")
+        self.assertIsInstance(location["synonyms"], common.FrozenList)
+        self.assertRaises(TypeError, location["synonyms"].append, "Baydhabo")
+        self.assertEqual(common.lookup_location("Baidoa")["synonyms"], ["Baidoa"])
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# end
@@ -0,0 +1,53 @@
+""" Tests for iati3w.cube
+
+Run from the top-level directory (the maps are read from inputs/):
+
+    python3 -m unittest discover tests
+
+"""
+
+import unittest
+
+from iati3w import cube, indexer
+
+
+def make_activity (identifier, sector, orgs):
+    """ Make a small merged-format activity with one sector and some implementing orgs """
+    return {
+        "identifier": identifier,
+        "source": "IATI",
+        "reported_by": "oxfam-germany",
+        "humanitarian": True,
+        "orgs": {"implementing": orgs, "programming": [], "funding": []},
+        "sectors": {"dac": [], "humanitarian": [sector]},
+        "locations": {"unclassified": [], "admin2": [], "admin1": [], "countries": ["SO"]},
+    }
+
+
+class TestSlice (unittest.TestCase):
+
+    def setUp (self):
+        self.cube = cube.make_cube()
+        for activity in (
+                make_activity("XX-TEST-1", "Education", ["Save the Children", "UNICEF"]),
+                make_activity("XX-TEST-2", "Education", ["Save the Children"]),
+                make_activity("XX-TEST-3", "Health", ["UNICEF"]),
+        ):
+            cube.add_counts(self.cube, activity, indexer.resolve_activity(activity))
+
+    def test_by_orgs (self):
+        self.assertEqual(cube.slice_cube(self.cube, "orgs", sector=(None, "education")), {"sci": 2, "unicef": 1})
+
+    def test_org_filter_by_orgs (self):
+        """ Filtering on the dimension being counted leaves just the matches """
+        self.assertEqual(cube.slice_cube(self.cube, "orgs", org="unicef"), {"unicef": 2})
+        self.assertEqual(cube.slice_cube(self.cube, "orgs", org="unicef", sector=("humanitarian", "health")), {"unicef": 1})
+
+    def test_sector_filter_by_sectors (self):
+        self.assertEqual(cube.slice_cube(self.cube, "sectors", sector=(None, "health")), {"humanitarian": {"health": 1}})
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# end
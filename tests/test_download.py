@@ -0,0 +1,140 @@
+""" Tests for iati3w.download, against a local HTTP server
+
+Run from the top-level directory:
+
+    python3 -m unittest discover tests
+
+"""
+
+import asyncio, contextlib, http.server, io, os, tempfile, threading, time, unittest, urllib.parse
+
+from iati3w import download
+
+THREEW = b"Programme,Project\n#activity+programme,#activity+project\n"
+""" Body of the test 3W file """
+
+def make_page (offset):
+    """ Return the body of a d-portal page with activities """
+    return "<iati-activities><iati-activity><iati-identifier>XX-TEST-{}</iati-identifier></iati-activity></iati-activities>".format(offset).encode("utf-8")
+
+EMPTY_PAGE = b"<iati-activities></iati-activities>"
+""" Body of a d-portal page past the end of the data """
+
+
+class Handler (http.server.BaseHTTPRequestHandler):
+    """ Serves the 3W and the IATI pages described by the server's attributes (see TestDownload.setUp()) """
+
+    def do_GET (self):
+        url = urllib.parse.urlparse(self.path)
+        server = self.server
+        if url.path == "/3w.csv":
+            body = THREEW
+            etag = '"3w"'
+        else:
+            offset = int(urllib.parse.parse_qs(url.query)["offset"][0])
+            with server.lock:
+                server.offsets.append(offset)
+                if offset in server.failures:
+                    server.failures.remove(offset)
+                    self.send_error(503)
+                    return
+            time.sleep(server.delays.get(offset, 0))
+            body = make_page(offset) if offset < server.pages * download.PAGE_SIZE else EMPTY_PAGE
+            etag = '"page-{}-{}"'.format(offset, len(body))
+
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message (self, format, *args):
+        pass
+
+
+class TestDownload (unittest.TestCase):
+
+    def setUp (self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.lock = threading.Lock()
+        self.server.pages = 3
+        self.server.offsets = []
+        self.server.failures = set()
+        self.server.delays = {}
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def tearDown (self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def download (self, concurrency=4):
+        """ Download everything into the temporary directory, and return (pages, messages) """
+        downloader = download.Downloader(self.tmp.name, concurrency=concurrency, retries=2, backoff=0.01, timeout=10)
+        messages = io.StringIO()
+        with contextlib.redirect_stderr(messages):
+            pages = asyncio.run(downloader.download_all(self.base_url + "/3w.csv", self.base_url + "/q.xml?offset=%d"))
+        return pages, messages.getvalue()
+
+    def read (self, filename):
+        with open(os.path.join(self.tmp.name, filename), "rb") as input:
+            return input.read()
+
+    def test_files (self):
+        """ The pages up to the first empty one are saved under the usual names """
+        pages, messages = self.download()
+        self.assertEqual(pages, 3)
+        self.assertEqual(
+            sorted(os.listdir(self.tmp.name)),
+            [download.STATE_FILE, "3w-som.csv", "iati-som-00000.xml", "iati-som-00100.xml", "iati-som-00200.xml",]
+        )
+        self.assertEqual(self.read("3w-som.csv"), THREEW)
+        self.assertEqual(self.read("iati-som-00100.xml"), make_page(100))
+
+    def test_retry (self):
+        """ A 503 is retried """
+        self.server.failures = {100}
+        pages, messages = self.download()
+        self.assertEqual(pages, 3)
+        self.assertEqual(self.server.offsets.count(100), 2)
+        self.assertIn("Retrying", messages)
+        self.assertEqual(self.read("iati-som-00100.xml"), make_page(100))
+
+    def test_unchanged (self):
+        """ A second run sends the saved ETags, and keeps the files the server says are unchanged """
+        self.download()
+        pages, messages = self.download()
+        self.assertEqual(pages, 3)
+        self.assertIn("Unchanged {}".format(os.path.join(self.tmp.name, "3w-som.csv")), messages)
+        self.assertIn("Unchanged {}".format(os.path.join(self.tmp.name, "iati-som-00200.xml")), messages)
+        self.assertNotIn("Downloaded", messages)
+        self.assertEqual(self.read("iati-som-00000.xml"), make_page(0))
+
+    def test_stale_pages (self):
+        """ Pages left from a longer download are removed """
+        self.download()
+        self.server.pages = 1
+        pages, messages = self.download()
+        self.assertEqual(pages, 1)
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), [download.STATE_FILE, "3w-som.csv", "iati-som-00000.xml",])
+        self.assertIn("Removed {}".format(os.path.join(self.tmp.name, "iati-som-00200.xml")), messages)
+
+    def test_window (self):
+        """ Nothing past an empty page is requested once it's seen, even while waiting for an earlier page """
+        self.server.delays = {0: 0.3, 100: 0.6}
+        pages, messages = self.download(concurrency=4)
+        self.assertEqual(pages, 3)
+        self.assertEqual(max(self.server.offsets), 300)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# end
@@ -0,0 +1,94 @@
+""" Tests for iati3w.fuzzy, and approximate matching in the lookups
+
+Run from the top-level directory (the maps are read from inputs/):
+
+    python3 -m unittest discover tests
+
+"""
+
+import unittest
+
+from iati3w import common, fuzzy
+
+TOKENS = [
+    "norwegian-refugee-council", "danish-refugee-council", "norwegian-church-aid",
+    "save-the-children", "save-somali-women-and-children", "world-vision",
+    "world-food-programme", "mercy-corps", "mercy-usa", "baydhaba", "beledweyne",
+    "belet-weyne", "belet-xaawo", "unicef", "who",
+]
+""" Tokens to index (a few like those in the maps, some close to each other) """
+
+QUERIES = [
+    "norwegian-refugee-counsil", "save-the-childrens", "world-visoin", "beletweyne",
+    "mercy-corp", "baydhabo", "unicef", "international-rescue-committee", "zzyzx-relief",
+]
+""" Tokens to look up """
+
+def score (a, b):
+    """ Score two tokens the slow way, for comparison """
+    grams_a, grams_b = fuzzy.trigrams(a), fuzzy.trigrams(b)
+    return 2 * len(grams_a & grams_b) / (len(grams_a) + len(grams_b))
+
+
+class TestSearch (unittest.TestCase):
+
+    def setUp (self):
+        self.index = fuzzy.build_index(TOKENS)
+
+    def test_exhaustive (self):
+        """ The pruned search finds exactly the matches that scoring every token would """
+        for threshold in (0.3, 0.5, 0.7, 0.85, 1.0,):
+            for query in QUERIES:
+                expected = sorted(
+                    ((score(query, token), token,) for token in TOKENS if len(token) >= fuzzy.MIN_LENGTH and score(query, token) >= threshold),
+                    key=lambda match: (-match[0], match[1],)
+                )
+                self.assertEqual(fuzzy.search(self.index, query, threshold), expected, (query, threshold,))
+
+    def test_ranking (self):
+        """ The closest token comes first, and the limit keeps the best """
+        matches = fuzzy.search(self.index, "norwegian-refugee-counsil", 0.3)
+        self.assertEqual(matches[0][1], "norwegian-refugee-council")
+        self.assertEqual([token for score, token in matches[:2]], ["norwegian-refugee-council", "danish-refugee-council",])
+        self.assertEqual(fuzzy.search(self.index, "norwegian-refugee-counsil", 0.3, limit=1), matches[:1])
+        self.assertEqual(fuzzy.search(self.index, "unicef", 0.5), [(1.0, "unicef",)])
+
+    def test_ties (self):
+        """ Equal scores are in alphabetical order """
+        index = fuzzy.build_index(["abcdef-x", "abcdef-y", "abcdef-w",])
+        self.assertEqual([token for score, token in fuzzy.search(index, "abcdef", 0.5)], ["abcdef-w", "abcdef-x", "abcdef-y",])
+
+    def test_threshold (self):
+        """ Nothing below the threshold, and nothing for short tokens """
+        for match_score, token in fuzzy.search(self.index, "belet-weyn", 0.6):
+            self.assertGreaterEqual(match_score, 0.6)
+        self.assertEqual(fuzzy.search(self.index, "international-rescue-committee", 0.7), [])
+        self.assertEqual(fuzzy.search(self.index, "whoo", 0.1), [])
+        self.assertNotIn("who", self.index["tokens"])
+
+
+class TestLookups (unittest.TestCase):
+    """ The lookups use the closest match only when a threshold is set """
+
+    def tearDown (self):
+        common.set_fuzzy_threshold(0)
+
+    def test_org (self):
+        self.assertEqual(common.lookup_org("Norwegian Refugee Counsil", True)["stub"], "norwegian-refugee-counsil")
+        common.set_fuzzy_threshold(0.7)
+        self.assertEqual(common.lookup_org("Norwegian Refugee Counsil", True)["stub"], "nrc")
+        # identifiers stay exact
+        self.assertIsNone(common.lookup_org("Norwegian Refugee Counsil"))
+        common.set_fuzzy_threshold(0.99)
+        self.assertTrue(common.lookup_org("Norwegian Refugee Counsil", True).get("unrecognised"))
+
+    def test_location (self):
+        self.assertTrue(common.lookup_location("Baydhabo").get("unrecognised"))
+        common.set_fuzzy_threshold(0.7)
+        self.assertEqual(common.lookup_location("Baydhabo")["stub"], "baydhaba")
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# end
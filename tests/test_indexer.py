@@ -0,0 +1,210 @@
+""" Tests for iati3w.indexer
+
+Run from the top-level directory (the maps are read from inputs/):
+
+    python3 -m unittest discover tests
+
+"""
+
+import json, os, subprocess, sys, tempfile, unittest
+
+from iati3w import indexer
+
+
+def make_activity (identifier, sector, org, location):
+    """ Make a small merged-format activity naming one (possibly unrecognised) sector, org, and location """
+    return {
+        "identifier": identifier,
+        "source": "IATI",
+        "reported_by": "oxfam-germany",
+        "humanitarian": True,
+        "title": "Title {}".format(identifier),
+        "description": "Description {}".format(identifier),
+        "active": True,
+        "orgs": {"implementing": [org], "programming": [], "funding": []},
+        "sectors": {"dac": [], "humanitarian": [sector]},
+        "locations": {"unclassified": [location], "admin2": [], "admin1": [], "countries": ["SO"]},
+        "dates": {"start": "2021-01-01", "end": None},
+        "modalities": [],
+        "targeted": {},
+    }
+
+FIRST = make_activity("XX-TEST-1", "Housing, Land and Property", "Zzyzx Relief Collective", "Qwertyville North")
+SECOND = make_activity("XX-TEST-2", "HOUSING LAND AND PROPERTY", "ZZYZX RELIEF COLLECTIVE", "QWERTYVILLE NORTH")
+OTHER = make_activity("XX-TEST-3", "Education", "Save the Children", "Baidoa")
+
+OUTPUT_FILES = ["org-index.json", "sector-index.json", "location-index.json", "activities.json",]
+
+SECTOR_STUB = "housing-land-and-property"
+ORG_STUB = "zzyzx-relief-collective"
+LOCATION_STUB = "qwertyville-north"
+
+
+class TestDelta (unittest.TestCase):
+    """ A delta run must give the same indexes as a full rebuild (checked with --verify) """
+
+    def setUp (self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.output_dir = os.path.join(self.tmp.name, "output")
+        os.mkdir(self.output_dir)
+
+    def tearDown (self):
+        self.tmp.cleanup()
+
+    def index (self, activities, *options, output_dir=None):
+        """ Write the activities to a file and run the indexer on it (keeping its state, unless output_dir is given) """
+        filename = os.path.join(self.tmp.name, "activities.json")
+        with open(filename, "w", encoding="utf-8") as output:
+            json.dump(activities, output)
+        if output_dir is None:
+            output_dir = self.output_dir
+            options = ("--cube", os.path.join(self.tmp.name, "cube.pickle"), "--state", os.path.join(self.tmp.name, "state.json"),) + options
+        process = subprocess.run([sys.executable, "-m", "iati3w.indexer", *options, output_dir, filename], capture_output=True, text=True)
+        self.assertEqual(process.returncode, 0, process.stderr)
+        return process.stderr
+
+    def read_outputs (self, output_dir=None):
+        """ Return the bytes of each output file """
+        outputs = {}
+        for filename in OUTPUT_FILES:
+            with open(os.path.join(output_dir or self.output_dir, filename), "rb") as input:
+                outputs[filename] = input.read()
+        return outputs
+
+    def assert_full_build (self, activities):
+        """ Check that the outputs are exactly what a full build of the activities writes """
+        full_dir = os.path.join(self.tmp.name, "full")
+        os.makedirs(full_dir, exist_ok=True)
+        self.index(activities, output_dir=full_dir)
+        self.assertEqual(self.read_outputs(), self.read_outputs(full_dir))
+
+    def load_index (self, name):
+        with open(os.path.join(self.output_dir, "{}-index.json".format(name)), "r", encoding="utf-8") as input:
+            return json.load(input)
+
+    def assert_first_seen (self, activity):
+        """ Check that the entries have their fields from the activity given """
+        sectors = self.load_index("sector")
+        self.assertEqual(sectors["humanitarian"][SECTOR_STUB]["name"], activity["sectors"]["humanitarian"][0])
+        orgs = self.load_index("org")
+        self.assertEqual(orgs[ORG_STUB]["info"]["name"], activity["orgs"]["implementing"][0])
+        locations = self.load_index("location")
+        self.assertEqual(locations["unclassified"][LOCATION_STUB]["info"]["name"], activity["locations"]["unclassified"][0])
+
+    def test_remove_first (self):
+        """ Removing the activity that first named an entry takes the fields from the next one """
+        self.index([FIRST, SECOND, OTHER])
+        self.assert_first_seen(FIRST)
+        self.assertIn("Applied delta", self.index([SECOND, OTHER], "--delta", "--verify"))
+        self.assert_first_seen(SECOND)
+
+    def test_change_first (self):
+        """ Changing or adding activities ahead of the first one to name an entry takes the fields from the new first """
+        self.index([FIRST, SECOND, OTHER])
+        changed = make_activity("XX-TEST-1", "Education", "Save the Children", "Baidoa")
+        self.assertIn("Applied delta", self.index([changed, SECOND, OTHER], "--delta", "--verify"))
+        self.assert_first_seen(SECOND)
+
+        added = make_activity("XX-TEST-0", "Housing land and property", "Zzyzx relief collective", "Qwertyville north")
+        self.assertIn("Applied delta", self.index([added, changed, SECOND, OTHER], "--delta", "--verify"))
+        self.assert_first_seen(added)
+
+    def test_full_build_order (self):
+        """ Entries and activities that a delta adds ahead of the others come first, as in a full build """
+        self.index([FIRST, SECOND, OTHER])
+        ahead = make_activity("XX-TEST-0", "Education", "Save the Children", "Baidoa")
+        changed = make_activity("XX-TEST-2", "Protection", "Zzyzx Relief Collective", "Jowhar")
+        activities = [ahead, FIRST, changed, OTHER]
+        self.assertIn("Applied delta", self.index(activities, "--delta", "--verify"))
+        self.assert_full_build(activities)
+        self.assertEqual(list(self.load_index("sector")["humanitarian"])[:2], ["education", SECTOR_STUB])
+
+    def test_title_change (self):
+        """ A change that the counted indexes can't see still updates the merged activity """
+        self.index([FIRST, SECOND, OTHER])
+        changed = dict(SECOND, title="A new title")
+        self.assertIn("Applied delta", self.index([FIRST, changed, OTHER], "--delta", "--verify"))
+        self.assert_full_build([FIRST, changed, OTHER])
+
+    def test_no_changes (self):
+        """ A delta with nothing to do doesn't write anything """
+        self.index([FIRST, SECOND, OTHER])
+        filenames = [os.path.join(self.output_dir, filename) for filename in OUTPUT_FILES] + [os.path.join(self.tmp.name, "state.json")]
+        times = [os.stat(filename).st_mtime_ns for filename in filenames]
+        self.assertIn("up to date", self.index([FIRST, SECOND, OTHER], "--delta", "--verify"))
+        self.assertEqual([os.stat(filename).st_mtime_ns for filename in filenames], times)
+
+    def test_reordered (self):
+        """ Moving the unchanged activities around means a full rebuild """
+        self.index([FIRST, SECOND, OTHER])
+        self.assertIn("full rebuild", self.index([OTHER, SECOND, FIRST], "--delta", "--verify"))
+        self.assert_full_build([OTHER, SECOND, FIRST])
+
+    def test_state_without_records (self):
+        """ The state file keeps hashes and index keys, not the activities themselves """
+        self.index([FIRST, SECOND, OTHER])
+        with open(os.path.join(self.tmp.name, "state.json"), "r", encoding="utf-8") as input:
+            state = input.read()
+        for activity in (FIRST, SECOND, OTHER,):
+            self.assertIn(activity["identifier"], state)
+            self.assertNotIn(activity["title"], state)
+            self.assertNotIn(activity["description"], state)
+
+    def test_identifier_sets (self):
+        """ Every kind of identifier set keeps the first activity for each identifier, with the same outputs """
+        duplicate = dict(FIRST, title="Another title")
+        activities = [FIRST, OTHER, duplicate, SECOND]
+        for kind in indexer.IDENTIFIER_SETS:
+            output_dir = os.path.join(self.tmp.name, kind)
+            os.mkdir(output_dir)
+            self.index(activities, "--identifier-set", kind, output_dir=output_dir)
+            self.assertEqual(self.read_outputs(output_dir), self.read_outputs(os.path.join(self.tmp.name, "exact")), kind)
+        with open(os.path.join(self.tmp.name, "disk", "activities.json"), "r", encoding="utf-8") as input:
+            merged = json.load(input)
+        self.assertEqual(list(merged), ["XX-TEST-1", "XX-TEST-3", "XX-TEST-2",])
+        self.assertEqual(merged["XX-TEST-1"]["title"], FIRST["title"])
+
+
+class TestIdentifierSets (unittest.TestCase):
+    """ The compact identifier sets agree with a plain set on membership """
+
+    def test_membership (self):
+        identifiers = ["XX-TEST-{}".format(i) for i in range(2000)]
+        identifiers += ["", "XX-TEST-1 ", "xx-test-1", "SO-ÇÀ-1", "XX/TEST/1", "X" * 1000,]
+        for kind in indexer.IDENTIFIER_SETS:
+            identifier_set = indexer.make_identifier_set(kind)
+            expected = set()
+            try:
+                # add every other identifier, checking them all as we go
+                for i, identifier in enumerate(identifiers):
+                    self.assertEqual(identifier in identifier_set, identifier in expected, (kind, identifier,))
+                    if i % 2 == 0:
+                        identifier_set.add(identifier)
+                        identifier_set.add(identifier)
+                        expected.add(identifier)
+                for identifier in identifiers:
+                    self.assertEqual(identifier in identifier_set, identifier in expected, (kind, identifier,))
+            finally:
+                identifier_set.close()
+
+    def test_unknown (self):
+        self.assertRaises(ValueError, indexer.make_identifier_set, "bloom")
+
+
+class TestFindDifference (unittest.TestCase):
+    """ --verify has to notice when only the order differs """
+
+    def test_key_order (self):
+        self.assertEqual(indexer.find_difference({"a": 1, "b": 2}, {"b": 2, "a": 1}), "/a")
+
+    def test_list_order (self):
+        self.assertEqual(indexer.find_difference({"a": ["x", "y"]}, {"a": ["y", "x"]}), "/a/0")
+
+    def test_same (self):
+        self.assertIsNone(indexer.find_difference({"a": ["x", {"b": None}]}, {"a": ["x", {"b": None}]}))
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# end
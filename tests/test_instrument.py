@@ -0,0 +1,88 @@
+""" Tests for iati3w.instrument, which is off unless IATI3W_INSTRUMENT is set
+
+Run from the top-level directory (the maps are read from inputs/):
+
+    python3 -m unittest discover tests
+
+"""
+
+import json, os, subprocess, sys, tempfile, unittest
+
+ACTIVITY = {
+    "identifier": "XX-TEST-1",
+    "source": "IATI",
+    "reported_by": "oxfam-germany",
+    "humanitarian": True,
+    "title": "Title",
+    "description": "Description",
+    "active": True,
+    "orgs": {"implementing": ["Save the Children"], "programming": [], "funding": []},
+    "sectors": {"dac": [], "humanitarian": ["Education"]},
+    "locations": {"unclassified": [], "admin2": ["Baidoa"], "admin1": [], "countries": ["SO"]},
+    "dates": {"start": "2021-01-01", "end": None},
+    "modalities": [],
+    "targeted": {},
+}
+""" A small merged-format activity to index """
+
+CHECK_DISABLED = """
+from iati3w import instrument
+def f ():
+    pass
+assert not instrument.ENABLED
+assert instrument.timed("f")(f) is f
+items = [1, 2]
+assert instrument.timed_iter("items", items) is items
+instrument.count("things")
+instrument.start("test")
+assert instrument.counters == {} and instrument.timers == {} and instrument.run is None
+"""
+""" Script to check that nothing is wrapped or counted with instrumentation off """
+
+
+class TestInstrument (unittest.TestCase):
+
+    def setUp (self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp.name, "activities.json")
+        with open(self.filename, "w", encoding="utf-8") as output:
+            json.dump([ACTIVITY], output)
+        self.output_dir = os.path.join(self.tmp.name, "output")
+        os.mkdir(self.output_dir)
+        self.report_dir = os.path.join(self.tmp.name, "reports")
+
+    def tearDown (self):
+        self.tmp.cleanup()
+
+    def run_python (self, args, **env):
+        """ Run Python with the instrumentation variables removed from the environment, and any in env added """
+        environ = {key: value for key, value in os.environ.items() if not key.startswith("IATI3W_INSTRUMENT") and key != "IATI3W_PROFILE"}
+        environ.update(env)
+        process = subprocess.run([sys.executable, *args], env=environ, capture_output=True, text=True)
+        self.assertEqual(process.returncode, 0, process.stderr)
+        return process.stderr
+
+    def test_off (self):
+        """ Without IATI3W_INSTRUMENT, nothing is timed, counted, or reported """
+        self.run_python(["-c", CHECK_DISABLED])
+        messages = self.run_python(["-m", "iati3w.indexer", self.output_dir, self.filename], IATI3W_PROFILE="cprofile")
+        self.assertNotIn("instrumentation", messages)
+        self.assertFalse(os.path.exists(self.report_dir))
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), ["activities.json", "output",])
+
+    def test_on (self):
+        """ With IATI3W_INSTRUMENT, the stage writes its report there """
+        messages = self.run_python(["-m", "iati3w.indexer", self.output_dir, self.filename], IATI3W_INSTRUMENT=self.report_dir)
+        self.assertIn("Wrote instrumentation report", messages)
+        self.assertEqual(os.listdir(self.report_dir), ["indexer.instrument.json"])
+        with open(os.path.join(self.report_dir, "indexer.instrument.json"), "r", encoding="utf-8") as input:
+            report = json.load(input)
+        self.assertEqual(report["stage"], "indexer")
+        self.assertEqual(report["timers"]["resolve_activity"]["calls"], 1)
+        self.assertIn("find_org", report["lookup_caches"])
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# end
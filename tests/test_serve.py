@@ -0,0 +1,129 @@
+""" Tests for iati3w.serve, against the server on a local port
+
+Run from the top-level directory:
+
+    python3 -m unittest discover tests
+
+"""
+
+import contextlib, io, json, os, tempfile, threading, time, unittest, unittest.mock, urllib.error, urllib.request
+
+from iati3w import indexer, serve
+
+def make_outputs (name):
+    """ Return small outputs with one org, called name """
+    return {
+        "orgs": {"unicef": {"info": {"name": name}, "activities": []}},
+        "sectors": {"humanitarian": {"health": {"name": "Health", "activities": []}}},
+        "locations": {"admin2": {}},
+        "activities": {"XX-TEST/1": {"identifier": "XX-TEST/1"}},
+    }
+
+
+class TestServe (unittest.TestCase):
+
+    def setUp (self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.write_outputs("UNICEF")
+        self.server = serve.make_server(self.tmp.name, port=0, reload_interval=0, quiet=True)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def tearDown (self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def write_outputs (self, name):
+        for key, value in make_outputs(name).items():
+            with open(os.path.join(self.tmp.name, indexer.OUTPUT_FILES[key]), "w", encoding="utf-8") as output:
+                json.dump(value, output)
+
+    def fetch (self, path, etag=None):
+        """ Return (status, body, ETag) for a GET request """
+        request = urllib.request.Request(self.base_url + path, headers=({"If-None-Match": etag} if etag else {}))
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, response.read(), response.headers.get("ETag")
+        except urllib.error.HTTPError as e:
+            return e.code, e.read(), e.headers.get("ETag")
+
+    def test_entries (self):
+        status, body, etag = self.fetch("/orgs/unicef")
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)["info"]["name"], "UNICEF")
+        self.assertTrue(etag)
+        self.assertEqual(self.fetch("/sectors/humanitarian/health")[0], 200)
+        self.assertEqual(json.loads(self.fetch("/activities/XX-TEST%2F1")[1]), {"identifier": "XX-TEST/1"})
+
+    def test_not_found (self):
+        self.assertEqual(self.fetch("/orgs/nobody")[0], 404)
+        self.assertEqual(self.fetch("/sectors/health")[0], 404)
+        self.assertEqual(self.fetch("/nothing")[0], 404)
+
+    def test_not_modified (self):
+        status, body, etag = self.fetch("/orgs/unicef")
+        status, body, same_etag = self.fetch("/orgs/unicef", etag)
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b"")
+        self.assertEqual(same_etag, etag)
+        self.assertEqual(self.fetch("/orgs/unicef", '"other"')[0], 200)
+
+    def test_reload (self):
+        """ Changed outputs are served once they've settled and loaded """
+        old_etag = self.fetch("/orgs/unicef")[2]
+        self.write_outputs("United Nations Children's Fund")
+        deadline = time.monotonic() + 10
+        with contextlib.redirect_stderr(io.StringIO()):
+            while time.monotonic() < deadline:
+                status, body, etag = self.fetch("/orgs/unicef", old_etag)
+                if status == 200:
+                    break
+                time.sleep(0.05)
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)["info"]["name"], "United Nations Children's Fund")
+
+
+class TestOutputs (unittest.TestCase):
+
+    def setUp (self):
+        self.tmp = tempfile.TemporaryDirectory()
+        for key, value in make_outputs("UNICEF").items():
+            with open(os.path.join(self.tmp.name, indexer.OUTPUT_FILES[key]), "w", encoding="utf-8") as output:
+                json.dump(value, output)
+
+    def tearDown (self):
+        self.tmp.cleanup()
+
+    def test_background_reload (self):
+        """ The request that notices the change doesn't wait for the new snapshot to load """
+        outputs = serve.Outputs(self.tmp.name, reload_interval=0)
+        old = outputs.get()
+        with open(os.path.join(self.tmp.name, indexer.OUTPUT_FILES["orgs"]), "a", encoding="utf-8") as output:
+            output.write("\n")
+
+        loaded = threading.Event()
+        class SlowSnapshot (serve.Snapshot):
+            def __init__ (self, *args):
+                time.sleep(0.5)
+                super().__init__(*args)
+                loaded.set()
+
+        with unittest.mock.patch.object(serve, "Snapshot", SlowSnapshot), unittest.mock.patch("sys.stderr"):
+            self.assertIs(outputs.get(), old) # noticed the change
+            started = time.monotonic()
+            self.assertIs(outputs.get(), old) # settled: starts loading
+            self.assertIs(outputs.get(), old) # still loading
+            self.assertLess(time.monotonic() - started, 0.4)
+            self.assertTrue(loaded.wait(5))
+            deadline = time.monotonic() + 5
+            while outputs.get() is old and time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.assertIsNot(outputs.get(), old)
+        self.assertEqual(outputs.get().signature, serve.get_signature(self.tmp.name))
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# end
@@ -0,0 +1,120 @@
+""" Tests for iati3w.store
+
+Run from the top-level directory (the maps are read from inputs/):
+
+    python3 -m unittest discover tests
+
+"""
+
+import json, os, sqlite3, subprocess, sys, tempfile, unittest
+
+from iati3w import store
+
+def make_activity (identifier, org, location, humanitarian):
+    """ Make a small merged-format activity with one org and one location, in Baidoa district """
+    return {
+        "identifier": identifier,
+        "source": "IATI",
+        "reported_by": "oxfam-germany",
+        "humanitarian": humanitarian,
+        "title": "Title {}".format(identifier),
+        "description": "Description {}".format(identifier),
+        "active": True,
+        "orgs": {"implementing": [org], "programming": [], "funding": ["UNICEF"]},
+        "sectors": {"dac": [], "humanitarian": ["Education"]},
+        "locations": {"unclassified": [location], "admin2": ["Baidoa"], "admin1": [], "countries": ["SO"]},
+        "dates": {"start": "2021-01-01", "end": None},
+        "modalities": [],
+        "targeted": {},
+    }
+
+ACTIVITIES = [
+    make_activity("XX-TEST-1", "Save the Children", "Baidoa", True),
+    make_activity("XX-TEST-2", "Zzyzx Relief Collective", "Qwertyville North", False),
+    make_activity("XX-TEST-3", "Save the Children", "Qwertyville North", True),
+]
+
+# the first activity names Baidoa twice, so the index lists it twice
+ACTIVITIES[0]["locations"]["admin2"].append("Baydhaba")
+
+
+class TestStore (unittest.TestCase):
+
+    @classmethod
+    def setUpClass (cls):
+        """ Index the activities once, for all of the tests """
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.output_dir = os.path.join(cls.tmp.name, "output")
+        os.mkdir(cls.output_dir)
+        filename = os.path.join(cls.tmp.name, "activities.json")
+        with open(filename, "w", encoding="utf-8") as output:
+            json.dump(ACTIVITIES, output)
+        subprocess.run([sys.executable, "-m", "iati3w.indexer", cls.output_dir, filename], check=True, capture_output=True)
+        cls.outputs = {}
+        for name in ("activities", "orgs", "sectors", "locations",):
+            cls.outputs[name] = store.load_output(cls.output_dir, name)
+
+    @classmethod
+    def tearDownClass (cls):
+        cls.tmp.cleanup()
+
+    def setUp (self):
+        self.filename = os.path.join(self.tmp.name, "activities.sqlite")
+        self.counts = store.build_store(self.filename, self.output_dir)
+
+    def tearDown (self):
+        os.remove(self.filename)
+
+    def query (self, sql, *params):
+        return store.query(self.filename, sql, params)[1]
+
+    def test_counts (self):
+        self.assertEqual(self.counts["activities"], 3)
+        self.assertEqual(self.counts["orgs"], len(self.outputs["orgs"]))
+        self.assertFalse(os.path.exists(self.filename + ".tmp"))
+
+    def test_activities (self):
+        """ Each activity comes back whole from the data column """
+        for identifier, activity in self.outputs["activities"].items():
+            rows = self.query("SELECT humanitarian, title, data FROM activities WHERE identifier = ?", identifier)
+            self.assertEqual(rows, [(int(activity["humanitarian"]), activity["title"], json.dumps(activity, ensure_ascii=False, separators=(",", ":",)),)])
+            self.assertEqual(json.loads(rows[0][2]), activity)
+        self.assertEqual(self.query("SELECT COUNT(*) FROM activities WHERE humanitarian"), [(2,)])
+
+    def test_relations (self):
+        """ The relation tables list the same activities as the index entries """
+        for stub, entry in self.outputs["orgs"].items():
+            for role, identifiers in entry["activities"].items():
+                rows = self.query("SELECT identifier FROM org_activities WHERE org = ? AND role = ? ORDER BY rowid", stub, role)
+                self.assertEqual([row[0] for row in rows], identifiers)
+        for type, entries in self.outputs["sectors"].items():
+            for stub, entry in entries.items():
+                rows = self.query("SELECT identifier FROM sector_activities WHERE type = ? AND sector = ? ORDER BY rowid", type, stub)
+                self.assertEqual([row[0] for row in rows], entry["activities"])
+        for type, entries in self.outputs["locations"].items():
+            for stub, entry in entries.items():
+                rows = self.query("SELECT identifier FROM location_activities WHERE type = ? AND location = ? ORDER BY rowid", type, stub)
+                # once for each activity, however often it names the location
+                self.assertEqual([row[0] for row in rows], list(dict.fromkeys(entry["activities"])))
+        self.assertEqual(self.query("SELECT COUNT(*) FROM location_activities WHERE location = 'baydhaba' AND type = 'admin2'"), [(3,)])
+
+    def test_join (self):
+        rows = self.query(
+            "SELECT a.identifier FROM org_activities o JOIN activities a ON a.identifier = o.identifier"
+            " WHERE o.org = ? AND o.role = 'implementing' ORDER BY a.identifier", "sci"
+        )
+        self.assertEqual(rows, [("XX-TEST-1",), ("XX-TEST-3",)])
+
+    def test_rebuild (self):
+        """ A rebuild replaces the database, and it can't be written through a query """
+        self.assertEqual(store.build_store(self.filename, self.output_dir), self.counts)
+        with self.assertRaises(sqlite3.OperationalError):
+            self.query("DELETE FROM activities")
+        with self.assertRaises(sqlite3.OperationalError):
+            store.query(os.path.join(self.tmp.name, "missing.sqlite"), "SELECT 1")
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# end